@@ -0,0 +1,90 @@
+import asyncio
+import os
+import time
+
+from dotenv import load_dotenv
+
+from app.logger_utils import logger
+from app.metrics_utils import Counter, Gauge, Histogram
+from app.redis_utils import redis_conn
+
+load_dotenv()
+
+# Messages processed at once by one worker; the rest wait briefly, then are shed
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "24"))
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "48"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+# Messages a user may send per window (shared across workers through Redis)
+USER_RATE_LIMIT = int(os.getenv("USER_RATE_LIMIT", "10"))
+USER_RATE_WINDOW = int(os.getenv("USER_RATE_WINDOW", "60"))
+# Shed messages that look like a product get an Open Food Facts-only answer, at most this many at once
+DEGRADED_MAX_IN_FLIGHT = int(os.getenv("DEGRADED_MAX_IN_FLIGHT", "8"))
+DEGRADED_TIMEOUT = float(os.getenv("DEGRADED_TIMEOUT", "4"))
+
+BUSY_MESSAGE = """NOURA: EVIDENCE-BASED WELLBEING™
+
+⏳ Estoy atendiendo muchas consultas en este momento. Por favor, intenta de nuevo en unos minutos."""
+
+RATE_LIMITED_MESSAGE = """NOURA: EVIDENCE-BASED WELLBEING™
+
+⏳ Recibí varios mensajes seguidos. Dame un momento y vuelve a escribirme en un minuto."""
+
+in_flight = Gauge('noura_webhook_in_flight', 'Messages being processed by this worker')
+queued = Gauge('noura_webhook_queued', 'Messages waiting for a processing slot in this worker')
+shed = Counter('noura_webhook_shed_total', 'Messages not run through the full pipeline, by reason and reply')
+queue_time = Histogram('noura_webhook_queue_seconds', 'Time spent waiting for a processing slot',
+                       buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+
+
+class AdmissionController:
+    """Caps the messages a worker processes concurrently.
+
+    A message waits at most `queue_timeout` seconds for a slot, and only while
+    fewer than `max_queued` others are waiting; otherwise it is shed at once.
+    """
+
+    def __init__(self, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_queued: int = ADMISSION_MAX_QUEUED,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._waiting = 0
+
+    async def acquire(self) -> bool:
+        if self._slots.locked() and self._waiting >= self.max_queued:
+            return False
+        start = time.monotonic()
+        self._waiting += 1
+        queued.inc()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiting -= 1
+            queued.dec()
+            queue_time.observe(time.monotonic() - start)
+        in_flight.inc()
+        return True
+
+    def release(self):
+        in_flight.dec()
+        self._slots.release()
+
+
+admission = AdmissionController()
+degraded_slots = asyncio.Semaphore(DEGRADED_MAX_IN_FLIGHT)
+
+
+def count_user_message(phone_no: str) -> int:
+    """Messages from this user in the current rate window, including this one (0 if Redis is down)."""
+    key = f"noura_rate_{phone_no}_{int(time.time() // USER_RATE_WINDOW)}"
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, USER_RATE_WINDOW)
+        count, _ = pipe.execute()
+        return int(count)
+    except Exception as e:
+        logger.error(f"Rate limit check failed: {e}")
+        return 0
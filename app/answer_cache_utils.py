@@ -0,0 +1,164 @@
+"""Cache of web-search-grounded answers, shared by all workers through Redis.
+
+Standalone questions ("¿dónde compro leche sin lactosa?") are answered the same
+way for every user in a country, so the answer and its citations are stored
+under the normalized question, the country, the search context size and the
+system prompt template; a prompt edit starts a fresh cache. Only a conversation's
+first question is standalone: later ones can refer to earlier turns without a
+single telling word ("¿tiene gluten?" after asking about Nutella), so they and
+turns with images always call the model.
+
+    python -m app.answer_cache_utils    # hit ratio and estimated cost saved, all workers
+"""
+import hashlib
+import os
+import re
+import time
+import unicodedata
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.cookies_utils import get_cookies, set_cookies
+from app.logger_utils import logger
+from app.metrics_utils import Counter
+from app.redis_utils import redis_conn
+
+load_dotenv()
+
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") == "1"
+# Web results go stale; cached answers are served for at most this long
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(6 * 3600)))
+# gpt-4o-search-preview prices in USD, used to estimate what each hit saved
+SEARCH_INPUT_PRICE = float(os.getenv("SEARCH_INPUT_PRICE", "2.50"))  # per million tokens
+SEARCH_OUTPUT_PRICE = float(os.getenv("SEARCH_OUTPUT_PRICE", "10.00"))  # per million tokens
+SEARCH_CALL_PRICES = {'low': 0.030, 'medium': 0.035, 'high': 0.050}  # per search
+
+STATS_KEY = 'noura_answer_cache_stats'
+
+# Words that point back at earlier turns; a question containing one is not standalone
+HISTORY_REFERENCE = re.compile(
+    r"^(y|e|pero|entonces|and|but|so)\b"
+    r"|\b(eso|esto|ese|esa|esos|esas|este|esta|estos|estas|anterior|mismo|misma|otro|otra|otros|otras|"
+    r"más|mas|también|tambien|it|that|this|these|those|them|more|same|other|another)\b"
+)
+
+answer_cache_requests = Counter('noura_answer_cache_requests_total', 'Web-search answer cache lookups, by result')
+answer_cache_saved_usd = Counter('noura_answer_cache_saved_usd_total', 'Estimated OpenAI spend avoided by cache hits')
+answer_cache_saved_seconds = Counter('noura_answer_cache_saved_seconds_total',
+                                     'Model latency avoided by cache hits')
+
+
+def normalize_query(query: str) -> str:
+    text = unicodedata.normalize('NFKC', query).lower()
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip(" ¿?¡!.,;:")
+
+
+def has_prior_turn(history: list) -> bool:
+    return any(msg.get('role') == 'user' for msg in history)
+
+
+def depends_on_history(query: str, history: list) -> bool:
+    """Whether `query` explicitly refers back to the earlier turns in `history` ("¿y eso?", "dame otra").
+
+    Enough for a photo, which is its own subject; text questions also need has_prior_turn().
+    """
+    if not has_prior_turn(history):
+        return False
+    return bool(HISTORY_REFERENCE.search(normalize_query(query)))
+
+
+def call_cost(entry: dict, context_size: str) -> float:
+    return (SEARCH_CALL_PRICES.get(context_size, SEARCH_CALL_PRICES['medium'])
+            + entry.get('prompt_tokens', 0) * SEARCH_INPUT_PRICE / 1e6
+            + entry.get('completion_tokens', 0) * SEARCH_OUTPUT_PRICE / 1e6)
+
+
+def _count(result: str, saved_usd: float = 0.0, saved_seconds: float = 0.0):
+    answer_cache_requests.inc(result=result)
+    if saved_usd:
+        answer_cache_saved_usd.inc(saved_usd)
+        answer_cache_saved_seconds.inc(saved_seconds)
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hincrby(STATS_KEY, result, 1)
+        if saved_usd:
+            pipe.hincrbyfloat(STATS_KEY, 'saved_usd', saved_usd)
+            pipe.hincrbyfloat(STATS_KEY, 'saved_seconds', saved_seconds)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Answer cache stats update failed: {e}")
+
+
+def lookup_answer(prompt_template: str, query: str, history: list, user_location: Optional[dict],
+                  context_size: str, has_images: bool = False) -> Tuple[Optional[str], Optional[dict]]:
+    """Return (cache key, cached entry).
+
+    The key is None when the turn must not be cached (images, not the conversation's
+    first question, cache disabled); the entry is None on a miss. Pass the history before the current turn.
+    """
+    if not ANSWER_CACHE:
+        return None, None
+    # "¿tiene gluten?" after a Nutella turn is about Nutella: the subject can be implied
+    if has_images or has_prior_turn(history):
+        _count('bypass')
+        return None, None
+
+    country = (user_location or {}).get('country') or 'Unknown'
+    template_hash = hashlib.sha1(prompt_template.encode('utf-8')).hexdigest()[:12]
+    digest = hashlib.sha1(f"{template_hash}|{country}|{context_size}|{normalize_query(query)}".encode('utf-8')).hexdigest()
+    key = f"noura_answer_{digest}"
+    try:
+        entry = get_cookies(redis_conn, key)
+    except Exception as e:
+        logger.error(f"Answer cache read failed: {e}")
+        return key, None
+
+    if entry is None:
+        _count('miss')
+        return key, None
+    saved = call_cost(entry, context_size)
+    _count('hit', saved, entry.get('seconds', 0.0))
+    logger.info(f"Answer cache hit ({country}, {context_size}), saved ~${saved:.3f}")
+    return key, entry
+
+
+def store_answer(key: str, response, seconds: float):
+    """Cache a web-search response (other models' answers, e.g. the fallback, are not stored)."""
+    if not key or 'search' not in (getattr(response, 'model', '') or ''):
+        return
+    message = response.choices[0].message
+    citations = []
+    for annotation in getattr(message, 'annotations', None) or []:
+        citation = getattr(annotation, 'url_citation', None)
+        if citation is not None:
+            citations.append({'url': citation.url, 'title': getattr(citation, 'title', '')})
+    usage = getattr(response, 'usage', None)
+    entry = {
+        'answer': message.content.strip(),
+        'citations': citations,
+        'model': response.model,
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+        'seconds': round(seconds, 3),
+        'created_at': time.time(),
+    }
+    try:
+        set_cookies(redis_conn, key, entry, ttl=ANSWER_CACHE_TTL)
+    except Exception as e:
+        logger.error(f"Answer cache write failed: {e}")
+
+
+def cache_report() -> str:
+    stats = {k.decode(): float(v) for k, v in redis_conn.hgetall(STATS_KEY).items()}
+    hits, misses, bypass = stats.get('hit', 0), stats.get('miss', 0), stats.get('bypass', 0)
+    lookups = hits + misses
+    return (f"lookups {lookups:.0f}, hits {hits:.0f}, misses {misses:.0f}, bypassed {bypass:.0f}\n"
+            f"hit ratio {hits / lookups if lookups else 0:.1%} of cacheable turns, "
+            f"{hits / (lookups + bypass) if lookups + bypass else 0:.1%} of all chat turns\n"
+            f"saved ~${stats.get('saved_usd', 0):.2f} and {stats.get('saved_seconds', 0):.0f} s of model time")
+
+
+if __name__ == '__main__':
+    print(cache_report())
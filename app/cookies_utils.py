@@ -1,20 +1,84 @@
 import json
-from typing import Any
+import os
+import threading
+from typing import Any, Optional
 
+import msgpack
+from dotenv import load_dotenv
 
-def set_cookies(redis_client, name: str, value: Any):
-    serialized_list = json.dumps(value)
-    redis_client.set(name, serialized_list)
+from app.logger_utils import logger
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def get_cookies(redis_client, name: str):
-    serialized_list = redis_client.get(name)
-    if serialized_list:
-        my_list = json.loads(serialized_list)
-        return my_list
-    else:
+load_dotenv()
+
+# Per-user keys expire after this long without activity; every read or write pushes the expiry back
+HISTORY_TTL = int(os.getenv("HISTORY_TTL", str(30 * 24 * 3600)))
+LOCATION_TTL = int(os.getenv("LOCATION_TTL", str(180 * 24 * 3600)))
+CONTEXT_TTL = int(os.getenv("CONTEXT_TTL", "1800"))
+# zstd-compress values at least this large (requires the zstandard package)
+COOKIES_ZSTD = os.getenv("COOKIES_ZSTD", "1") == "1"
+COOKIES_ZSTD_MIN_BYTES = int(os.getenv("COOKIES_ZSTD_MIN_BYTES", "512"))
+COOKIES_ZSTD_LEVEL = int(os.getenv("COOKIES_ZSTD_LEVEL", "3"))
+
+# Values start with 0xc1, a byte msgpack never emits and JSON never starts with, followed by the codec
+MAGIC = b'\xc1'
+CODEC_MSGPACK = b'\x00'
+CODEC_ZSTD = b'\x01'
+
+if COOKIES_ZSTD and zstandard is None:
+    logger.warning("COOKIES_ZSTD is on but zstandard is not installed; storing values uncompressed")
+
+_zstd = threading.local()
+
+
+def _compressor():
+    # zstandard contexts are not thread safe; keep one per thread
+    if not hasattr(_zstd, 'compressor'):
+        _zstd.compressor = zstandard.ZstdCompressor(level=COOKIES_ZSTD_LEVEL)
+        _zstd.decompressor = zstandard.ZstdDecompressor()
+    return _zstd.compressor
+
+
+def encode_cookie(value: Any) -> bytes:
+    packed = msgpack.packb(value, use_bin_type=True)
+    if COOKIES_ZSTD and zstandard is not None and len(packed) >= COOKIES_ZSTD_MIN_BYTES:
+        return MAGIC + CODEC_ZSTD + _compressor().compress(packed)
+    return MAGIC + CODEC_MSGPACK + packed
+
+
+def decode_cookie(data: bytes) -> Any:
+    if data[:1] != MAGIC:
+        # Written before the binary encoding: JSON, usually a JSON string holding the JSON value
+        value = json.loads(data)
+        return json.loads(value) if isinstance(value, str) else value
+    payload = data[2:]
+    if data[1:2] == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("value is zstd-compressed but zstandard is not installed")
+        _compressor()
+        payload = _zstd.decompressor.decompress(payload)
+    return msgpack.unpackb(payload, raw=False)
+
+
+def set_cookies(redis_client, name: str, value: Any, ttl: Optional[int] = None):
+    redis_client.set(name, encode_cookie(value), ex=ttl)
+
+
+def get_cookies(redis_client, name: str, ttl: Optional[int] = None):
+    """Stored value, or None. With `ttl`, reading also resets the key's expiry (sliding expiry)."""
+    data = redis_client.getex(name, ex=ttl) if ttl else redis_client.get(name)
+    if not data:
+        return None
+    try:
+        return decode_cookie(data)
+    except Exception as e:
+        logger.error(f"Could not decode {name}: {e}")
         return None
 
 
 def clear_cookies(redis_client, name: str):
-    redis_client.delete(name)
\ No newline at end of file
+    redis_client.delete(name)
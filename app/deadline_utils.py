@@ -0,0 +1,123 @@
+"""Time budget of one incoming message, shared by every call made to answer it.
+
+The webhook opens a Deadline as soon as a message arrives (the queue worker when it
+picks a job up) and runs the pipeline `within()` it. The deadline lives in a
+contextvar, so stage tasks and the threads started with asyncio.to_thread see it
+too. Each stage gets what is left of the budget (see pipeline_utils), and calls
+with their own timeout take `remaining(own_timeout)` instead. Steps with a cheaper
+alternative ask `has_time()` first: no FDA check, no web search, no fallback model
+or retry when too little time is left.
+
+A stage cut short is counted once per message in noura_deadline_misses_total;
+skipped or cheapened steps in noura_deadline_degraded_total. Code run outside a
+request (batch jobs, scripts) has no deadline and keeps its own timeouts.
+"""
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from app.logger_utils import logger
+from app.metrics_utils import Counter
+
+load_dotenv()
+
+# Seconds from receiving a message to having its reply ready
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "25"))
+# Budget a step needs to be worth starting; below it the cheaper path is taken
+DEADLINE_WEB_SEARCH_MIN = float(os.getenv("DEADLINE_WEB_SEARCH_MIN", "12"))
+DEADLINE_FALLBACK_MIN = float(os.getenv("DEADLINE_FALLBACK_MIN", "6"))
+DEADLINE_RETRY_MIN = float(os.getenv("DEADLINE_RETRY_MIN", "8"))
+DEADLINE_RECALLS_MIN = float(os.getenv("DEADLINE_RECALLS_MIN", "3"))
+# Several clients (aiohttp among them) read a 0 timeout as "no timeout"
+MIN_TIMEOUT = 0.001
+
+TIMEOUT_MESSAGE = """NOURA: EVIDENCE-BASED WELLBEING™
+
+⏳ Tu consulta está tardando más de lo normal. Por favor, intenta de nuevo en unos minutos."""
+
+deadline_misses = Counter('noura_deadline_misses_total', 'Messages whose time budget ran out in a stage, by stage')
+deadline_degraded = Counter('noura_deadline_degraded_total',
+                            'Steps skipped or made cheaper for lack of time budget, by step')
+
+_deadline: ContextVar[Optional['Deadline']] = ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """The message's time budget ran out before the stage finished."""
+
+
+class Deadline:
+    def __init__(self, seconds: float = REQUEST_DEADLINE):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+        self.missed = set()
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+
+@contextmanager
+def within(deadline: Deadline):
+    """Run the enclosed code (and tasks/threads started from it) under `deadline`."""
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def remaining(cap: Optional[float] = None) -> Optional[float]:
+    """Timeout for a call: what is left of the budget, at most `cap` (`cap` alone outside a request)."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return cap
+    left = max(MIN_TIMEOUT, deadline.remaining())
+    return left if cap is None else min(cap, left)
+
+
+def has_time(seconds: float, step: str) -> bool:
+    """Whether at least `seconds` of budget are left; if not, `step` is counted as degraded."""
+    deadline = _deadline.get()
+    if deadline is None or deadline.remaining() >= seconds:
+        return True
+    deadline_degraded.inc(step=step)
+    logger.info(f"{deadline.remaining():.1f} s left of the message's budget; degrading {step}")
+    return False
+
+
+def record_miss(stage: str) -> bool:
+    """Count `stage` as a deadline miss if the budget is spent; False when the timeout was the call's own."""
+    deadline = _deadline.get()
+    if deadline is None or not deadline.expired:
+        return False
+    if stage not in deadline.missed:
+        deadline.missed.add(stage)
+        deadline_misses.inc(stage=stage)
+        logger.info(f"Deadline of {deadline.seconds:g} s missed in {stage}")
+    return True
+
+
+async def run_within_deadline(awaitable, stage: str):
+    """Await `awaitable` for at most the remaining budget; DeadlineExceeded when it runs out."""
+    budget = remaining()
+    if budget is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, budget)
+    except asyncio.TimeoutError:
+        if record_miss(stage):
+            raise DeadlineExceeded(f"deadline missed in {stage}") from None
+        raise
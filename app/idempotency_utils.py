@@ -0,0 +1,80 @@
+import json
+import os
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.logger_utils import logger
+from app.metrics_utils import Counter
+from app.redis_utils import redis_conn
+
+load_dotenv()
+
+# Longer than the slowest pipeline run (gunicorn times workers out at 240 s), so a
+# retry that arrives while the first delivery is still processing is dropped
+IDEMPOTENCY_INFLIGHT_TTL = int(os.getenv("IDEMPOTENCY_INFLIGHT_TTL", "300"))
+# Twilio retries within minutes; keep completed replies for a day
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+
+NEW = 'new'
+IN_FLIGHT = 'in_flight'
+COMPLETED = 'completed'
+
+webhook_messages = Counter('noura_webhook_messages_total', 'Webhook deliveries received, by ledger state')
+duplicates_suppressed = Counter('noura_webhook_duplicates_suppressed_total',
+                                'Retried webhook deliveries answered without running the pipeline, by outcome')
+
+
+def _ledger_key(message_sid: str) -> str:
+    return f"noura_message_{message_sid}"
+
+
+def claim_message(message_sid: str) -> Tuple[str, Optional[dict]]:
+    """Record `message_sid` as in flight unless it was seen before.
+
+    Returns (NEW, None) when this call owns the message, (IN_FLIGHT, None) while another
+    delivery is processing it and (COMPLETED, entry) once a reply was stored. If Redis
+    is unavailable the message is processed rather than dropped.
+    """
+    key = _ledger_key(message_sid)
+    try:
+        if redis_conn.set(key, json.dumps({'state': IN_FLIGHT}), nx=True, ex=IDEMPOTENCY_INFLIGHT_TTL):
+            webhook_messages.inc(state=NEW)
+            return NEW, None
+        stored = redis_conn.get(key)
+    except Exception as e:
+        logger.error(f"Idempotency ledger unavailable: {e}")
+        webhook_messages.inc(state=NEW)
+        return NEW, None
+
+    entry = json.loads(stored) if stored else {'state': IN_FLIGHT}
+    state = COMPLETED if entry.get('state') == COMPLETED else IN_FLIGHT
+    webhook_messages.inc(state=state)
+    return state, entry if state == COMPLETED else None
+
+
+def get_message_entry(message_sid: str) -> Optional[dict]:
+    """Ledger entry for `message_sid` without claiming it (None if unknown or Redis is down)."""
+    try:
+        stored = redis_conn.get(_ledger_key(message_sid))
+    except Exception as e:
+        logger.error(f"Idempotency ledger unavailable: {e}")
+        return None
+    return json.loads(stored) if stored else None
+
+
+def complete_message(message_sid: str, reply: str, delivered: bool):
+    """Store the reply so retries replay it instead of running the pipeline again."""
+    entry = {'state': COMPLETED, 'reply': reply, 'delivered': delivered}
+    try:
+        redis_conn.set(_ledger_key(message_sid), json.dumps(entry), ex=IDEMPOTENCY_TTL)
+    except Exception as e:
+        logger.error(f"Could not record completed message {message_sid}: {e}")
+
+
+def release_message(message_sid: str):
+    """Forget a message whose processing failed so a retry runs it again."""
+    try:
+        redis_conn.delete(_ledger_key(message_sid))
+    except Exception as e:
+        logger.error(f"Could not release message {message_sid}: {e}")
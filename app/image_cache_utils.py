@@ -0,0 +1,202 @@
+"""Reuse of earlier vision answers for near-duplicate product photos, shared through Redis.
+
+Every photo analysed with the vision model is reduced to a 64-bit difference hash
+(dHash: a 9x8 greyscale thumbnail, one bit per pair of neighbouring pixels), which
+is unchanged by WhatsApp's recompression and resizing and changes only a few bits
+with small crops or lighting differences. A photo whose hash is within
+IMAGE_CACHE_MAX_DISTANCE bits of one already answered, sent with the same caption,
+from the same country and under the same system prompt, gets the stored answer
+instead of a new vision call.
+
+Hashes are indexed by their 8 bytes ("bands"): two hashes at most 7 bits apart
+share at least one byte, so the candidates are the union of 8 small Redis sorted
+sets and only those are compared bit by bit. Members are scored by when they were
+stored and dropped once older than IMAGE_CACHE_TTL, like the answers they point to. Turns whose caption refers to the
+conversation, and nearly uniform photos (too little detail to tell apart), always
+call the model.
+
+    python -m app.image_cache_utils    # hit ratio and vision calls saved, all workers
+"""
+import base64
+import binascii
+import hashlib
+import io
+import os
+import time
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from app.answer_cache_utils import depends_on_history, normalize_query
+from app.cookies_utils import get_cookies, set_cookies
+from app.logger_utils import logger
+from app.metrics_utils import Counter, Histogram
+from app.redis_utils import redis_conn
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+load_dotenv()
+
+IMAGE_CACHE = os.getenv("IMAGE_CACHE", "1") == "1"
+# Hamming distance (of 64 bits) up to which two photos count as the same picture; at most 7
+IMAGE_CACHE_MAX_DISTANCE = min(7, int(os.getenv("IMAGE_CACHE_MAX_DISTANCE", "5")))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(30 * 24 * 3600)))
+
+HASH_WIDTH, HASH_HEIGHT = 9, 8
+BANDS = 8
+# Hashes with fewer (or more) set bits than this come from flat images: a blank wall, a blurred shot
+MIN_DETAIL_BITS = 6
+
+STATS_KEY = 'noura_image_cache_stats'
+
+image_cache_requests = Counter('noura_image_cache_requests_total',
+                               'Near-duplicate image lookups before a vision call, by result')
+vision_calls_saved = Counter('noura_image_cache_vision_calls_saved_total',
+                             'Vision model calls avoided by reusing a near-duplicate\'s answer')
+vision_seconds_saved = Counter('noura_image_cache_saved_seconds_total', 'Vision model latency avoided by cache hits')
+hit_distance = Histogram('noura_image_cache_hit_distance', 'Hamming distance between a photo and the one it reused',
+                         buckets=(0, 1, 2, 3, 4, 5, 6, 7))
+
+if Image is None and IMAGE_CACHE:
+    logger.warning("Pillow is not installed; near-duplicate image reuse is disabled")
+
+
+def dhash(image_data: bytes) -> Optional[int]:
+    """64-bit difference hash of an encoded image, None if it cannot be decoded."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            # JPEGs are decoded straight at a reduced scale, which is most of the cost saved
+            image.draft('L', (HASH_WIDTH * 8, HASH_HEIGHT * 8))
+            image = ImageOps.exif_transpose(image)
+            pixels = image.convert('L').resize((HASH_WIDTH, HASH_HEIGHT), Image.Resampling.BOX).tobytes()
+    except Exception as e:
+        logger.error(f"Could not hash image: {e}")
+        return None
+    value = 0
+    for row in range(HASH_HEIGHT):
+        for col in range(HASH_WIDTH - 1):
+            left = pixels[row * HASH_WIDTH + col]
+            value = value << 1 | (left < pixels[row * HASH_WIDTH + col + 1])
+    return value
+
+
+def image_hash(image_url: str) -> Optional[int]:
+    """dHash of a base64 data URL as built by process_image_message."""
+    if not IMAGE_CACHE or not image_url.startswith('data:'):
+        return None
+    try:
+        image_data = base64.b64decode(image_url.split(',', 1)[1])
+    except (IndexError, binascii.Error):
+        return None
+    return dhash(image_data)
+
+
+def image_hashes(image_urls: list) -> List[Optional[int]]:
+    return [image_hash(url) for url in image_urls]
+
+
+def _bands(value: int) -> List[str]:
+    return [f"noura_image_zband:{i}:{(value >> (8 * i)) & 0xff:02x}" for i in range(BANDS)]
+
+
+def _count(result: str, saved_seconds: float = 0.0):
+    image_cache_requests.inc(result=result)
+    if result == 'hit':
+        vision_calls_saved.inc()
+        vision_seconds_saved.inc(saved_seconds)
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hincrby(STATS_KEY, result, 1)
+        if saved_seconds:
+            pipe.hincrbyfloat(STATS_KEY, 'saved_seconds', saved_seconds)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Image cache stats update failed: {e}")
+
+
+def image_answer_key(prompt_template: str, query: str, history: list, user_location: Optional[dict]) -> Optional[str]:
+    """Key prefix shared by answers to photos sent with this caption, or None if the turn must not be reused.
+
+    Pass the history before the current turn.
+    """
+    if not IMAGE_CACHE or Image is None:
+        return None
+    if depends_on_history(query, history):
+        _count('bypass')
+        return None
+    country = (user_location or {}).get('country') or 'Unknown'
+    template_hash = hashlib.sha1(prompt_template.encode('utf-8')).hexdigest()[:12]
+    digest = hashlib.sha1(f"{template_hash}|{country}|{normalize_query(query)}".encode('utf-8')).hexdigest()
+    return f"noura_image_answer_{digest}"
+
+
+def _detailed(value: Optional[int]) -> bool:
+    return value is not None and MIN_DETAIL_BITS <= value.bit_count() <= 64 - MIN_DETAIL_BITS
+
+
+def find_image_answer(key: Optional[str], value: Optional[int]) -> Optional[dict]:
+    """Stored answer for the closest near-duplicate of the photo hashed `value`, or None."""
+    if key is None:
+        return None
+    if not _detailed(value):
+        _count('bypass')
+        return None
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        for band in _bands(value):
+            # Members whose answer has expired may not be trimmed yet
+            pipe.zrangebyscore(band, time.time() - IMAGE_CACHE_TTL, '+inf')
+        candidates = set().union(*pipe.execute())
+        close = sorted((distance, member.decode()) for member in candidates
+                       if (distance := (int(member, 16) ^ value).bit_count()) <= IMAGE_CACHE_MAX_DISTANCE)
+        for distance, member in close:
+            entry = get_cookies(redis_conn, f"{key}_{member}")
+            if entry is not None:
+                hit_distance.observe(distance)
+                _count('hit', entry.get('seconds', 0.0))
+                logger.info(f"Image cache hit at distance {distance} ({len(candidates)} candidates)")
+                return entry
+    except Exception as e:
+        logger.error(f"Image cache read failed: {e}")
+        return None
+    _count('miss')
+    return None
+
+
+def store_image_answer(key: Optional[str], value: Optional[int], answer: str, seconds: float):
+    """Record the vision answer for the photo hashed `value` and index the hash."""
+    if key is None or not _detailed(value):
+        return
+    member = f"{value:016x}"
+    now = time.time()
+    entry = {'answer': answer, 'seconds': round(seconds, 3), 'created_at': now}
+    try:
+        set_cookies(redis_conn, f"{key}_{member}", entry, ttl=IMAGE_CACHE_TTL)
+        pipe = redis_conn.pipeline(transaction=False)
+        for band in _bands(value):
+            pipe.zadd(band, {member: now})
+            # The band's own TTL is refreshed by every photo: trim what has expired, or it grows forever
+            pipe.zremrangebyscore(band, '-inf', now - IMAGE_CACHE_TTL)
+            pipe.expire(band, IMAGE_CACHE_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Image cache write failed: {e}")
+
+
+def cache_report() -> str:
+    stats = {k.decode(): float(v) for k, v in redis_conn.hgetall(STATS_KEY).items()}
+    hits, misses, bypass = stats.get('hit', 0), stats.get('miss', 0), stats.get('bypass', 0)
+    lookups = hits + misses
+    return (f"lookups {lookups:.0f}, hits {hits:.0f}, misses {misses:.0f}, bypassed {bypass:.0f}\n"
+            f"hit ratio {hits / lookups if lookups else 0:.1%} of reusable photos, "
+            f"{hits / (lookups + bypass) if lookups + bypass else 0:.1%} of all photos\n"
+            f"saved {hits:.0f} vision calls and {stats.get('saved_seconds', 0):.0f} s of model time")
+
+
+if __name__ == '__main__':
+    print(cache_report())
@@ -1,19 +1,126 @@
+import atexit
+import contextvars
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_DIR = os.getenv("LOG_DIR", "./logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Fraction (0.0-1.0) of verbose per-request lines that are kept
+LOG_VERBOSE_SAMPLE_RATE = float(os.getenv("LOG_VERBOSE_SAMPLE_RATE", "0.1"))
+
+# Request ID of the webhook call being processed; set by the middleware in main.py
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+# Pass as `extra=VERBOSE` for chatty per-request lines that may be sampled out
+VERBOSE = {"verbose": True}
+
+_RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "verbose"}
+
+
+class VerboseSamplingFilter(logging.Filter):
+    """Keeps only a sample of records flagged as verbose. Warnings and errors are never dropped."""
+
+    def __init__(self, sample_rate: float = LOG_VERBOSE_SAMPLE_RATE):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "verbose", False) or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < self.sample_rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "request_id": getattr(record, "request_id", "-"),
+            "pid": record.process,
+            "src": f"{record.filename}:{record.lineno}",
+            "msg": record.getMessage(),
+        }
+        # Structured fields passed through `extra=`
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class RequestQueueHandler(QueueHandler):
+    """QueueHandler that stamps the request ID before the record leaves the request context."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        return super().prepare(record)
+
+
+def _build_output_handlers() -> list:
+    formatter = JsonFormatter()
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_handler = RotatingFileHandler(os.path.join(LOG_DIR, 'logtest.log'), maxBytes=1024 * 1024, backupCount=10)
+    file_handler.setFormatter(formatter)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+
+    return [file_handler, console_handler]
+
+
+_log_queue = queue.SimpleQueue()
+_listener = None
+
+
+def start_logging() -> None:
+    """Start the background listener that performs the actual log I/O."""
+    global _listener
+    if _listener is not None:
+        return
+    _listener = QueueListener(_log_queue, *_build_output_handlers(), respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the background listener."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+# Only the queue handler runs on the request path; formatting and I/O happen in the listener thread
+queue_handler = RequestQueueHandler(_log_queue)
+queue_handler.addFilter(VerboseSamplingFilter())
 
 logger = logging.getLogger('logtest')
-logger.setLevel(logging.INFO)
+# Parent of the module loggers (logging.getLogger(__name__) in app/services/*): same JSON lines and request ID
+app_logger = logging.getLogger('app')
+for _logger in (logger, app_logger):
+    _logger.setLevel(LOG_LEVEL)
+    _logger.propagate = False
+    _logger.addHandler(queue_handler)
+
 
-formatter = logging.Formatter(fmt='%(asctime)s pid/%(process)d [%(filename)s:%(lineno)d] %(message)s')
+def _restart_logging_in_child() -> None:
+    # The listener thread does not survive fork (e.g. gunicorn --preload); start a fresh one in the worker
+    global _listener
+    _listener = None
+    start_logging()
 
-# File handler
-file_handler = RotatingFileHandler('./logs/logtest.log', maxBytes=1024 * 1024, backupCount=10)
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 
-# Console handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
\ No newline at end of file
+start_logging()
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_logging_in_child)
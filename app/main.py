@@ -1,9 +1,11 @@
 import os
-import json
 import base64
+import asyncio
 import re
-import tempfile
+import time
+import uuid
 from datetime import datetime
+from typing import Optional
 from dotenv import load_dotenv
 import warnings
 
@@ -11,17 +13,34 @@ from fastapi import Form, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse
 
-from twilio.rest import Client
-import requests
-from openai import OpenAI
+import aiohttp
 
-from app.cookies_utils import set_cookies, get_cookies, clear_cookies
-from app.prompts import get_google_doc_content
-from app.openai_utils import gpt_without_functions, summarise_conversation
-from app.redis_utils import redis_conn
-from app.logger_utils import logger
-from app.services.product_analyzer import analyze_product, format_product_analysis, format_detailed_analysis
-from app.services.redis_utils import get_latest_analysis, store_latest_analysis
+from app.cookies_utils import set_cookies, get_cookies, clear_cookies, HISTORY_TTL, LOCATION_TTL
+from app.prompts import (get_google_doc_content, static_system_prompt, dynamic_context, WEB_SEARCH_MODE,
+                         NO_WEB_SEARCH_MODE)
+from app.openai_utils import gpt_without_functions, asummarise_conversation, log_prompt_cache
+from app.logger_utils import logger, request_id_var, VERBOSE
+from app.services.product_analyzer import analyze_product, lookup_product, format_product_analysis, format_detailed_analysis
+from app.redis_utils import redis_conn, get_latest_analysis, store_latest_analysis
+from app.services.transcription import transcribe_audio, language_for_location
+from app.services.alternatives import find_alternatives, record_analysis, format_alternatives
+from app.services.intent_router import (route_message, detect_location, route_messages, route_seconds, Intent,
+                                        GREETING, LOCATION, FOLLOW_UP, BARCODE, PRODUCT, OUT_OF_SCOPE, IMAGE, CHAT)
+from app.metrics_utils import render_metrics
+from app.admission_utils import (admission, degraded_slots, count_user_message, shed, USER_RATE_LIMIT,
+                                 DEGRADED_TIMEOUT, BUSY_MESSAGE, RATE_LIMITED_MESSAGE)
+from app.idempotency_utils import (claim_message, complete_message, release_message, get_message_entry,
+                                   duplicates_suppressed, IN_FLIGHT, COMPLETED)
+from app.queue_utils import QUEUE_MODE, enqueue_message, update_queue_gauges
+from app.answer_cache_utils import lookup_answer, store_answer
+from app.image_cache_utils import image_hashes, image_answer_key, find_image_answer, store_image_answer
+from app.pipeline_utils import StageGraph
+from app.tracing_utils import span, set_attributes, llm_span, record_usage
+from app.rate_limit_utils import call_openai, estimate_tokens
+from app.deadline_utils import (Deadline, DeadlineExceeded, has_time, record_miss, remaining, within,
+                                DEADLINE_FALLBACK_MIN, DEADLINE_RETRY_MIN, DEADLINE_WEB_SEARCH_MIN, TIMEOUT_MESSAGE)
+from app.profiling_utils import (PROFILER_TOKEN, PROFILE_HEADER, authorized, profile_worker, request_profile,
+                                 wants_profile)
 
 # Suppress Pydantic warnings
 warnings.filterwarnings("ignore", category=UserWarning, module="pydantic")
@@ -33,6 +52,12 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
+# Twilio REST API root; only changed to point at a local stand-in (benchmarks/replay_load.py)
+TWILIO_API_BASE_URL = os.getenv("TWILIO_API_BASE_URL", "")
+# Attachments of one message downloaded/transcribed/analysed at the same time
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", "3"))
+# Output allowance of an answer, reserved from the model's token budget
+ANSWER_MAX_TOKENS = 800
 
 # Validate critical environment variables
 if not TWILIO_ACCOUNT_SID:
@@ -46,6 +71,46 @@ if not OPENAI_API_KEY:
 logger.info("Twilio Account SID loaded successfully")
 logger.info("OpenAI API Key loaded successfully")
 
+_twilio_client = None
+_openai_client = None
+
+
+def get_twilio_client():
+    """Shared Twilio REST client, created on first use (twilio.rest is slow to import)."""
+    global _twilio_client
+    if _twilio_client is None:
+        from twilio.rest import Client
+        _twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        if TWILIO_API_BASE_URL:
+            _twilio_client.api.base_url = TWILIO_API_BASE_URL
+    return _twilio_client
+
+
+def get_openai_client():
+    """Shared OpenAI client, created on first use."""
+    global _openai_client
+    if _openai_client is None:
+        from openai import OpenAI
+        _openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    return _openai_client
+
+
+def warm_shared_state():
+    """Import the heavy SDKs and build shared clients ahead of the first request.
+
+    Called from the gunicorn master when the app is preloaded, so forked workers
+    inherit the imported modules copy-on-write instead of importing them on boot.
+    """
+    import litellm  # noqa: F401
+    import googleapiclient.discovery  # noqa: F401
+    from app.services.transcription import audio_transcriber
+
+    get_twilio_client()
+    get_openai_client()
+    audio_transcriber.client
+    logger.info("Shared state warmed")
+
+
 app = FastAPI(
     title="Twilio-OpenAI-WhatsApp-Bot",
     description="Twilio OpenAI WhatsApp Bot",
@@ -66,6 +131,27 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    """Tag every log line emitted while handling a request with a request ID."""
+    request_id = (
+        request.headers.get("I-Twilio-Idempotency-Token")
+        or request.headers.get("X-Request-ID")
+        or uuid.uuid4().hex
+    )
+    token = request_id_var.set(request_id)
+    try:
+        with span(f"{request.method} {request.url.path}", **{'http.method': request.method,
+                                                             'http.route': request.url.path,
+                                                             'noura.request_id': request_id}) as current:
+            response = await call_next(request)
+            current.set_attribute('http.status_code', response.status_code)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
 class ConversationHistory:
     """Manages conversation history with Redis storage and cleaning."""
     
@@ -76,20 +162,21 @@ class ConversationHistory:
     
     def load(self) -> list:
         """Load and clean history from Redis."""
-        history = get_cookies(self.redis_conn, f'whatsapp_twilio_demo_{self.session_id}_history')
+        history = get_cookies(self.redis_conn, f'whatsapp_twilio_demo_{self.session_id}_history', ttl=HISTORY_TTL)
         if history:
-            history = json.loads(history)
             # Clean once during load
             return [self._clean_message(msg) for msg in history[-self.max_messages:]]
         return []
     
     def save(self, history: list):
         """Save cleaned history to Redis."""
-        cleaned = [self._clean_message(msg) for msg in history]
+        # Only the last max_messages are ever loaded, so older ones are not kept
+        cleaned = [self._clean_message(msg) for msg in history[-self.max_messages:]]
         set_cookies(
             self.redis_conn, 
             name=f'whatsapp_twilio_demo_{self.session_id}_history',
-            value=json.dumps(cleaned)
+            value=cleaned,
+            ttl=HISTORY_TTL
         )
     
     def _clean_message(self, msg: dict) -> dict:
@@ -106,9 +193,9 @@ class UserContext:
     @staticmethod
     def get_user_location(phone_no: str) -> dict:
         """Get user location from Redis or return default."""
-        location_data = get_cookies(redis_conn, f'user_location_{phone_no}')
+        location_data = get_cookies(redis_conn, f'user_location_{phone_no}', ttl=LOCATION_TTL)
         if location_data:
-            return json.loads(location_data)
+            return location_data
         # Default location - should be updated after user provides it
         return {"country": "Unknown", "city": "Unknown"}
     
@@ -121,39 +208,14 @@ class UserContext:
         set_cookies(
             redis_conn,
             name=f'user_location_{phone_no}',
-            value=json.dumps(location)
+            value=location,
+            ttl=LOCATION_TTL
         )
     
     @staticmethod
     def detect_location_from_message(message: str) -> dict:
         """Try to detect location from user message."""
-        message_lower = message.lower()
-        
-        # Common country patterns
-        locations = {
-            "colombia": {"country": "CO", "city": "Bogotá"},
-            "méxico": {"country": "MX", "city": "Ciudad de México"},
-            "mexico": {"country": "MX", "city": "Ciudad de México"},
-            "españa": {"country": "ES", "city": "Madrid"},
-            "spain": {"country": "ES", "city": "Madrid"},
-            "argentina": {"country": "AR", "city": "Buenos Aires"},
-            "chile": {"country": "CL", "city": "Santiago"},
-            "perú": {"country": "PE", "city": "Lima"},
-            "peru": {"country": "PE", "city": "Lima"},
-            "brasil": {"country": "BR", "city": "São Paulo"},
-            "brazil": {"country": "BR", "city": "São Paulo"},
-            "france": {"country": "FR", "city": "Paris"},
-            "francia": {"country": "FR", "city": "Paris"},
-            "usa": {"country": "US", "city": "New York"},
-            "estados unidos": {"country": "US", "city": "New York"},
-            "united states": {"country": "US", "city": "New York"},
-        }
-        
-        for country_name, location_data in locations.items():
-            if country_name in message_lower:
-                return location_data
-        
-        return None
+        return detect_location(message)
 
 
 def clean_twilio_urls(text):
@@ -180,38 +242,43 @@ def clean_twilio_urls(text):
     return text
 
 
-def download_twilio_media(media_url):
+async def download_twilio_media(media_url):
     """Download media from Twilio using authentication."""
     try:
         if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
             logger.error("Missing Twilio credentials")
             return None
             
-        logger.info("Attempting to download media from Twilio")
-        
-        response = requests.get(
-            media_url,
-            auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
-            timeout=30
-        )
-        
-        logger.info(f"Response status: {response.status_code}")
+        logger.info("Attempting to download media from Twilio", extra=VERBOSE)
         
-        if response.status_code == 401:
-            logger.error("Authentication failed - check credentials")
-            return None
-        elif response.status_code == 404:
-            logger.error("Media not found - URL may have expired")
-            return None
-        elif response.status_code == 403:
-            logger.error("Access forbidden - check permissions")
-            return None
-            
-        response.raise_for_status()
-        logger.info(f"Successfully downloaded {len(response.content)} bytes")
-        return response.content
+        with span('twilio.media') as current:
+            async with aiohttp.ClientSession() as session, session.get(
+                media_url,
+                auth=aiohttp.BasicAuth(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+                timeout=aiohttp.ClientTimeout(total=remaining(30))
+            ) as response:
+                logger.info(f"Response status: {response.status}", extra=VERBOSE)
+                current.set_attributes({'http.status_code': response.status,
+                                        'http.response.content_type': response.content_type})
+                
+                if response.status == 401:
+                    logger.error("Authentication failed - check credentials")
+                    return None
+                elif response.status == 404:
+                    logger.error("Media not found - URL may have expired")
+                    return None
+                elif response.status == 403:
+                    logger.error("Access forbidden - check permissions")
+                    return None
+                    
+                response.raise_for_status()
+                content = await response.read()
+                current.set_attribute('http.response.body.size', len(content))
+                logger.info(f"Successfully downloaded {len(content)} bytes", extra=VERBOSE)
+                return content
         
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        record_miss('twilio_media')
         logger.error(f"Network error downloading Twilio media: {e}")
         return None
     except Exception as e:
@@ -219,6 +286,13 @@ def download_twilio_media(media_url):
         return None
 
 
+OUT_OF_SCOPE_MESSAGE = """NOURA: EVIDENCE-BASED WELLBEING™
+
+🌿 Solo puedo ayudarte con productos de consumo: alimentos, bebidas, cuidado personal y del hogar.
+
+📸 Envíame una foto, el código de barras o el nombre de un producto y te diré su score."""
+
+
 def get_greeting_message(user_text: str) -> str:
     """Get appropriate greeting message based on language detection."""
     user_text_lower = user_text.strip().lower()
@@ -277,39 +351,22 @@ This allows me to show you local and more sustainable options."""
     return greetings['en']['message']
 
 
-async def process_audio_message(media_url: str) -> str:
+async def process_audio_message(media_url: str, media_content_type: str = 'audio/ogg', language: str = None) -> str:
     """Process audio message and return transcribed text."""
-    audio_data = download_twilio_media(media_url)
+    audio_data = await download_twilio_media(media_url)
     if not audio_data:
         return "Lo siento, no pude descargar tu mensaje de audio."
     
-    with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as tmp_file:
-        tmp_file.write(audio_data)
-        tmp_path = tmp_file.name
-    
     try:
-        # Initialize OpenAI client properly
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        with open(tmp_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="es"
-            )
-        return transcript.text
+        return await transcribe_audio(audio_data, media_content_type, language=language)
     except Exception as e:
         logger.error(f"Error transcribing audio: {e}")
         return "Lo siento, no pude transcribir tu mensaje de audio."
-    finally:
-        try:
-            os.unlink(tmp_path)
-        except OSError as e:
-            logger.error(f"Error deleting temp file: {e}")
 
 
 async def process_image_message(media_url: str, media_content_type: str) -> str:
     """Process image message and return base64 encoded data URL."""
-    image_data = download_twilio_media(media_url)
+    image_data = await download_twilio_media(media_url)
     if not image_data:
         return None
     
@@ -317,38 +374,102 @@ async def process_image_message(media_url: str, media_content_type: str) -> str:
     return f"data:{media_content_type};base64,{image_base64}"
 
 
-def gpt_with_web_search(messages, user_location=None, context_size="medium"):
-    """Use GPT with web search capabilities."""
-    # Initialize OpenAI client properly
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    
-    # Extract system prompt
-    system_prompt = None
-    user_messages = []
-    
-    for msg in messages:
-        if msg['role'] == 'system':
-            system_prompt = msg['content']
-        else:
-            user_messages.append(msg)
-    
-    # Enhanced system prompt
-    enhanced_system_prompt = f"""{system_prompt}
+async def process_media_items(media_items: list, language: str = None) -> tuple:
+    """Download and process all attachments of a message concurrently.
+
+    Returns (transcripts, image_urls) in attachment order; failed items are skipped.
+    """
+    semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+
+    async def process_item(media_url, media_content_type):
+        async with semaphore:
+            if media_content_type.startswith("audio"):
+                return 'audio', await process_audio_message(media_url, media_content_type, language=language)
+            if media_content_type.startswith("image"):
+                return 'image', await process_image_message(media_url, media_content_type)
+            logger.info(f"Skipping unsupported media type: {media_content_type}")
+            return None, None
+
+    results = await asyncio.gather(*(process_item(url, content_type) for url, content_type in media_items))
+    transcripts = [value for kind, value in results if kind == 'audio' and value]
+    image_urls = [value for kind, value in results if kind == 'image' and value]
+    return transcripts, image_urls
 
-INSTRUCCIONES CRÍTICAS PARA BÚSQUEDA WEB:
-- Siempre sigue las instrucciones del sistema anterior al pie de la letra
-- Usa la información web SOLO para complementar, no para contradecir el prompt
-- Mantén el formato, tono y estilo especificado en el prompt del sistema
-- La búsqueda web debe ENRIQUECER tu respuesta, no cambiar tu comportamiento base
 
-PROHIBIDO TERMINANTEMENTE:
-- NUNCA inventes URLs ficticias como "example.com" o sitios que no existen
-- NUNCA uses enlaces placeholder como [Comprar aquí](https://www.example.com)
-- Si no encuentras URLs reales verificables, simplemente omite los enlaces
-- Es mejor NO dar enlace que dar un enlace falso
-- Solo incluye URLs que hayas encontrado mediante búsqueda web real
-- Si no puedes verificar una tienda online específica, no la menciones"""
+def attach_image(messages: list, query: str, image_url: str, detail: str = "high") -> list:
+    """Return a copy of `messages` whose last user turn carries `image_url`."""
+    messages = [msg.copy() for msg in messages]
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i]['role'] == 'user':
+            messages[i]['content'] = [
+                {
+                    "type": "text",
+                    "text": query
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url,
+                        "detail": detail
+                    }
+                }
+            ]
+            break
+    return messages
+
+
+async def analyze_images_concurrently(messages: list, query: str, image_urls: list, user_location: dict,
+                                      hashes: Optional[list] = None, image_key: Optional[str] = None) -> str:
+    """Analyse several product photos in parallel and combine them into one reply.
+
+    Photos close to one already answered for this caption (`image_key`, see
+    image_cache_utils) reuse that answer.
+    """
+    semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+
+    async def analyze_one(image_url, image_hash):
+        cached = find_image_answer(image_key, image_hash)
+        if cached:
+            return cached['answer']
+        async with semaphore:
+            start = time.monotonic()
+            response = await asyncio.to_thread(
+                gpt_with_web_search,
+                messages=attach_image(messages, query, image_url),
+                user_location=user_location,
+                context_size="medium"
+            )
+            answer = response.choices[0].message.content.strip()
+            store_image_answer(image_key, image_hash, answer, time.monotonic() - start)
+            return answer
+
+    hashes = hashes or [None] * len(image_urls)
+    results = await asyncio.gather(*(analyze_one(url, image_hash) for url, image_hash in zip(image_urls, hashes)),
+                                   return_exceptions=True)
+
+    sections = []
+    for i, result in enumerate(results, start=1):
+        if isinstance(result, Exception):
+            logger.error(f"Error analysing image {i}/{len(image_urls)}: {result}")
+            result = "Lo siento, no pude analizar esta imagen."
+        sections.append(f"📦 Producto {i}/{len(image_urls)}\n{result}")
+    return "\n\n".join(sections)
+
+
+def with_search_mode(messages: list, web_search: bool) -> list:
+    """Insert the mode line after the system prompt's static prefix, before the history."""
+    mode = {'role': 'system', 'content': WEB_SEARCH_MODE if web_search else NO_WEB_SEARCH_MODE}
+    return messages[:1] + [mode] + messages[1:]
+
+
+def gpt_with_web_search(messages, user_location=None, context_size="medium"):
+    """Use GPT with web search capabilities.
 
+    `messages` starts with the static system prompt (see prompts.static_system_prompt);
+    only a short mode line is added here, so every model call shares the same prefix.
+    """
+    client = get_openai_client()
+    
     # Configure web search options
     web_search_options = {
         "search_context_size": context_size,
@@ -361,58 +482,58 @@ PROHIBIDO TERMINANTEMENTE:
         }
     
     try:
-        enhanced_messages = [
-            {'role': 'system', 'content': enhanced_system_prompt}
-        ] + user_messages
-        
         # Check if there's an image in messages
         has_image = any(
             isinstance(m.get('content'), list) and 
             any(i.get('type') == 'image_url' for i in m.get('content'))
-            for m in enhanced_messages
+            for m in messages
         )
         
-        if has_image:
+        # Web search answers take longest; without the time for one, answer from the model alone
+        if has_image or not has_time(DEADLINE_WEB_SEARCH_MIN, 'web_search'):
             # Use gpt-4.1 for images without web search
-            response = client.chat.completions.create(
-                model="gpt-4.1",
-                messages=enhanced_messages
-            )
+            with llm_span('openai.chat', "gpt-4.1", messages, **{'llm.images': True}) as current:
+                response = call_openai(
+                    "gpt-4.1", estimate_tokens(messages, ANSWER_MAX_TOKENS),
+                    client.chat.completions.with_raw_response.create,
+                    model="gpt-4.1",
+                    messages=with_search_mode(messages, web_search=False)
+                )
+                record_usage(current, response)
         else:
             # Use gpt-4o-search-preview with web search
-            response = client.chat.completions.create(
-                model="gpt-4o-search-preview",
-                web_search_options=web_search_options,
-                messages=enhanced_messages
-            )
+            with llm_span('openai.chat', "gpt-4o-search-preview", messages,
+                          **{'llm.web_search.context_size': context_size}) as current:
+                response = call_openai(
+                    "gpt-4o-search-preview", estimate_tokens(messages, ANSWER_MAX_TOKENS),
+                    client.chat.completions.with_raw_response.create,
+                    model="gpt-4o-search-preview",
+                    web_search_options=web_search_options,
+                    messages=with_search_mode(messages, web_search=True)
+                )
+                record_usage(current, response)
+        log_prompt_cache(response)
         return response
     except Exception as e:
         logger.error(f"Error with GPT model: {e}")
+        if not has_time(DEADLINE_FALLBACK_MIN, 'answer_fallback'):
+            raise
         
         # Fallback to gpt-4.1 without web search
         try:
             logger.info("Fallback to gpt-4.1 without web search")
             
-            fallback_system_prompt = f"""{system_prompt}
-
-IMPORTANTE - MODO SIN BÚSQUEDA WEB:
-- NO tienes acceso a información web actualizada
-- NUNCA inventes URLs, tiendas online o enlaces que no puedas verificar  
-- Si no puedes verificar precios o disponibilidad, no los menciones
-- Es mejor ser honesto sobre limitaciones que dar información falsa
-- Usa solo tu conocimiento base sin inventar datos actuales
-- Si no puedes encontrar tiendas específicas verificables, simplemente omite los enlaces"""
-            
-            fallback_messages = [
-                {'role': 'system', 'content': fallback_system_prompt}
-            ] + user_messages
-            
-            response = client.chat.completions.create(
-                model="gpt-4.1",
-                messages=fallback_messages,
-                temperature=0.1,
-                max_tokens=800,
-            )
+            with llm_span('openai.chat', "gpt-4.1", messages, **{'llm.fallback': True}) as current:
+                response = call_openai(
+                    "gpt-4.1", estimate_tokens(messages, ANSWER_MAX_TOKENS),
+                    client.chat.completions.with_raw_response.create,
+                    model="gpt-4.1",
+                    messages=with_search_mode(messages, web_search=False),
+                    temperature=0.1,
+                    max_tokens=ANSWER_MAX_TOKENS,
+                )
+                record_usage(current, response)
+            log_prompt_cache(response)
             return response
         except Exception as e2:
             logger.error(f"Fallback also failed: {e2}")
@@ -422,7 +543,7 @@ IMPORTANTE - MODO SIN BÚSQUEDA WEB:
 def respond(to_number: str, message: str) -> None:
     """Send a message via Twilio WhatsApp."""
     TWILIO_WHATSAPP_PHONE_NUMBER = "whatsapp:" + TWILIO_WHATSAPP_NUMBER
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    twilio_client = get_twilio_client()
     
     # Split message if too long
     max_length = 3000
@@ -434,21 +555,28 @@ def respond(to_number: str, message: str) -> None:
             if len(chunks) > 1:
                 chunk = f"Part {i+1}/{len(chunks)}: {chunk}"
                 
+            with span('twilio.send', **{'twilio.message.chars': len(chunk)}):
+                twilio_client.messages.create(
+                    body=chunk,
+                    from_=TWILIO_WHATSAPP_PHONE_NUMBER,
+                    to=to_number
+                )
+    else:
+        with span('twilio.send', **{'twilio.message.chars': len(message)}):
             twilio_client.messages.create(
-                body=chunk,
+                body=message,
                 from_=TWILIO_WHATSAPP_PHONE_NUMBER,
                 to=to_number
             )
-    else:
-        twilio_client.messages.create(
-            body=message,
-            from_=TWILIO_WHATSAPP_PHONE_NUMBER,
-            to=to_number
-        )
 
 
-def prepare_messages_for_openai(history: list, system_prompt: str, max_messages: int = 10) -> list:
-    """Prepare and clean messages for OpenAI API."""
+def prepare_messages_for_openai(history: list, system_prompt: str, max_messages: int = 10,
+                                context: Optional[str] = None) -> list:
+    """Prepare and clean messages for OpenAI API.
+
+    `system_prompt` is the static prefix; the per-request `context` goes right before
+    the latest user turn so everything ahead of it can be served from the prompt cache.
+    """
     # Limit history size
     limited_history = history[-max_messages:] if len(history) > max_messages else history
     
@@ -476,238 +604,512 @@ def prepare_messages_for_openai(history: list, system_prompt: str, max_messages:
         
         cleaned_history.append(cleaned_msg)
     
+    if context and cleaned_history:
+        cleaned_history.insert(len(cleaned_history) - 1, {'role': 'system', 'content': context})
+    
     # Combine system prompt with history
     return [{'role': 'system', 'content': system_prompt}] + cleaned_history
 
 
-@app.post('/whatsapp-endpoint')
-async def whatsapp_endpoint(
-    request: Request,
-    From: str = Form(...),
-    Body: str = Form(""),
-    NumMedia: str = Form("0"),
-    MediaUrl0: str = Form(None),
-    MediaContentType0: str = Form(None)
-):
-    """Main WhatsApp webhook endpoint."""
-    try:
-        logger.info(f'WhatsApp endpoint triggered from: {From}')
-        logger.info(f'Body: {Body}')
-        logger.info(f'NumMedia: {NumMedia}, MediaContentType0: {MediaContentType0}')
-        
-        query = Body
-        image_url = None
-        phone_no = From.replace('whatsapp:+', '')
-        
-        # Process media if exists
-        if NumMedia and int(NumMedia) > 0 and MediaUrl0:
-            if MediaContentType0 and MediaContentType0.startswith("audio"):
-                # Process audio
-                query = await process_audio_message(MediaUrl0)
-                logger.info(f"Audio transcribed: {query}")
-                
-            elif MediaContentType0 and MediaContentType0.startswith("image"):
-                # Process image
-                image_url = await process_image_message(MediaUrl0, MediaContentType0)
-                if image_url:
-                    logger.info("Image processed successfully")
-                    if not query or query.strip() == "":
-                        query = "Please analyze this product image using NOURA evidence-based wellbeing analysis."
-                else:
-                    logger.error("Failed to process image")
-                    if not query or query.strip() == "":
-                        query = "Lo siento, no pude procesar la imagen. Por favor, describe el producto para analizarlo."
-        
-        # Default message if no content
-        if not query or query.strip() == "":
-            query = "Recibí tu mensaje, pero no pude procesar el contenido. Por favor envía texto, una imagen o un audio."
-        
-        # Clean query from Twilio URLs
-        query = clean_twilio_urls(query)
-        
-        # Check if user is providing location info
-        detected_location = UserContext.detect_location_from_message(query)
-        if detected_location:
-            UserContext.save_user_location(phone_no, detected_location["country"], detected_location.get("city"))
-            logger.info(f"User location detected and saved: {detected_location}")
-        
-        # Product Analysis Check
-        try:
-            analysis_result = await analyze_product(query)
-            
-            # Check if it's a greeting
-            if analysis_result.get('is_greeting'):
-                greeting_msg = get_greeting_message(query)
-                respond(From, greeting_msg)
-                return PlainTextResponse("OK", status_code=200)
-            
-            # Check if user is asking "why" for previous analysis
-            if query.strip().lower() in ['por qué', 'porque', 'explica', 'why']:
-                last_result = get_latest_analysis(phone_no)
-                if last_result and last_result.get('found'):
-                    detailed_response = format_detailed_analysis(last_result)
-                    respond(From, detailed_response)
-                    return PlainTextResponse("OK", status_code=200)
-            
-            # If product was analyzed successfully
-            if analysis_result.get('found'):
-                product_response = format_product_analysis(analysis_result)
-                store_latest_analysis(phone_no, analysis_result)
-                respond(From, product_response)
-                return PlainTextResponse("OK", status_code=200)
-                
-        except Exception as e:
-            logger.error(f"Error during product analysis: {e}")
-        
-        # Continue with GPT processing if not handled by product analyzer
-        
-        # Initialize conversation history manager
-        history_manager = ConversationHistory(redis_conn, phone_no)
-        history = history_manager.load()
-        
-        # Add user message to history
-        history.append({"role": 'user', "content": query})
+CHAT_ROUTES = {PRODUCT, BARCODE, FOLLOW_UP, IMAGE, CHAT}  # routes that may end up in handle_chat
+DEFAULT_PROMPT = "You are a helpful assistant. (Default prompt used due to error.)"
+
+
+async def build_query(phone_no: str, Body: str, media_items: list, stages: StageGraph) -> tuple:
+    """Turn the message text and attachments into (query, image_urls)."""
+    query = Body
+    image_urls = []
+    
+    # Process all attachments concurrently
+    if media_items:
+        language = None
+        if any(content_type.startswith("audio") for _, content_type in media_items):
+            # Hint Whisper with the user's stored locale when known
+            language = language_for_location(await stages.get('location'))
         
-        # Get system prompt from Google Docs
-        try:
-            raw_prompt = get_google_doc_content()
-        except Exception as e:
-            logger.error(f"Failed to fetch system prompt from Google Docs: {e}")
-            raw_prompt = "You are a helpful assistant. (Default prompt used due to error.)"
+        transcripts, image_urls = await process_media_items(media_items, language=language)
         
-        # Format system prompt
-        history_summary = summarise_conversation(history)
-        system_prompt = raw_prompt.format(
-            ProductName="WhatsApp Assistant",
-            history_summary=clean_twilio_urls(history_summary),
-            today=datetime.now().date(),
-            OverallIndicator="helpful and friendly",
-            score="85",
-            confidence="High",
-            indicator="🟢",
-            **{
-                "key factor": "user support excellence",
-                "Topic 1": "User Experience",
-                "Topic 2": "Response Time",
-                "Insight 1": "Quick and helpful responses",
-                "Insight 2": "Available 24/7 for assistance",
-                "Insight 3": "Personalized conversation experience",
-                "assessment": "Excellent"
-            }
-        )
+        if transcripts:
+            query = "\n".join(([query] if query and query.strip() else []) + transcripts)
+            logger.info(f"Audio transcribed: {query}", extra=VERBOSE)
         
-        system_prompt = clean_twilio_urls(system_prompt)
+        if image_urls:
+            logger.info(f"{len(image_urls)} image(s) processed successfully", extra=VERBOSE)
+            if not query or query.strip() == "":
+                query = "Please analyze this product image using NOURA evidence-based wellbeing analysis."
+        elif any(content_type.startswith("image") for _, content_type in media_items):
+            logger.error("Failed to process image")
+            if not query or query.strip() == "":
+                query = "Lo siento, no pude procesar la imagen. Por favor, describe el producto para analizarlo."
+    
+    # Default message if no content
+    if not query or query.strip() == "":
+        query = "Recibí tu mensaje, pero no pude procesar el contenido. Por favor envía texto, una imagen o un audio."
+    
+    # Clean query from Twilio URLs
+    return clean_twilio_urls(query), image_urls
+
+
+def load_system_prompt() -> str:
+    """System prompt from Google Docs, or a default one if it cannot be fetched."""
+    try:
+        return get_google_doc_content()
+    except Exception as e:
+        logger.error(f"Failed to fetch system prompt from Google Docs: {e}")
+        return DEFAULT_PROMPT
+
+
+async def summarise_history(query: str, stages: StageGraph) -> str:
+    """One-sentence summary of the conversation including the current message."""
+    history = await stages.get('history')
+    return clean_twilio_urls(await asummarise_conversation(history + [{"role": 'user', "content": query}]))
+
+
+async def current_location(intent: Intent, stages: StageGraph) -> dict:
+    """Location named in this message, else the stored one (read before this message's save)."""
+    if intent.location:
+        location = {"country": intent.location["country"]}
+        if intent.location.get("city"):
+            location["city"] = intent.location["city"]
+        return location
+    return await stages.get('location')
+
+
+async def handle_message(From: str, Body: str, media_items: list) -> str:
+    """Run the pipeline for one incoming message and return the reply text."""
+    logger.info(f'WhatsApp endpoint triggered from: {From}')
+    logger.info(f'Body: {Body}', extra=VERBOSE)
+    logger.info(f'NumMedia: {len(media_items)}, MediaContentTypes: {[t for _, t in media_items]}', extra=VERBOSE)
+    
+    phone_no = From.replace('whatsapp:+', '')
+    stages = StageGraph()
+    # Redis reads most routes need start right away, alongside the media processing
+    stages.start('location', UserContext.get_user_location, phone_no)
+    stages.start('history', ConversationHistory(redis_conn, phone_no).load)
+    
+    intent = None
+    route = 'unrouted'
+    outcome = 'handled'
+    try:
+        query, image_urls = await stages.run('media', build_query, phone_no, Body, media_items, stages)
         
-        # Prepare messages for OpenAI
-        messages = prepare_messages_for_openai(history, system_prompt, max_messages=10)
+        # Classify once, using only in-memory data, then dispatch to the route's handler
+        intent = route_message(query, has_images=bool(image_urls))
+        route = intent.route
+        set_attributes(**{'noura.route': route})
+        logger.info(f"Message routed to {route}", extra=VERBOSE)
+        start = time.monotonic()
         
-        # Add image if present
-        if image_url:
-            for i in range(len(messages) - 1, -1, -1):
-                if messages[i]['role'] == 'user':
-                    messages[i]['content'] = [
-                        {
-                            "type": "text",
-                            "text": query
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_url,
-                                "detail": "high"
-                            }
-                        }
-                    ]
-                    break
+        if intent.location:
+            stages.start('location_save', UserContext.save_user_location, phone_no,
+                         intent.location["country"], intent.location.get("city"))
+            logger.info(f"User location detected and saved: {intent.location}")
+        if route in (PRODUCT, BARCODE):
+            stages.start('product', lookup_product, intent.query)
+        elif route == FOLLOW_UP:
+            stages.start('last_analysis', get_latest_analysis, phone_no)
+        if route in CHAT_ROUTES:
+            # Prepared speculatively while the product lookup runs; cancelled if it answers
+            stages.start('prompt', load_system_prompt)
+            stages.start('summary', summarise_history, intent.query, stages)
+            if image_urls:
+                # Hashed off the event loop while the prompt loads, to find photos answered before
+                stages.start('image_hashes', image_hashes, image_urls)
         
-        # Get user location for web search
-        user_location = UserContext.get_user_location(phone_no)
+        reply = await ROUTE_HANDLERS[route](phone_no, intent, image_urls, stages)
+        if reply is None:
+            # Nothing to answer from local data or Open Food Facts: let the assistant reply
+            outcome = 'chat_fallback'
+            set_attributes(**{'noura.route.outcome': outcome})
+            reply = await handle_chat(phone_no, intent, image_urls, stages)
+        if intent.location:
+            await stages.get('location_save')
+        return reply
+    except DeadlineExceeded:
+        # Missed stage already counted; a late apology beats a generic error
+        outcome = 'deadline'
+        set_attributes(**{'noura.route.outcome': outcome})
+        return TIMEOUT_MESSAGE
+    finally:
+        if intent is not None:
+            route_messages.inc(route=route, outcome=outcome)
+            route_seconds.observe(time.monotonic() - start, route=route)
+        await stages.close()
+        stages.report(route)
+
+
+async def handle_greeting(phone_no: str, intent: Intent, image_urls: list, stages: StageGraph) -> Optional[str]:
+    return get_greeting_message(intent.query)
+
+
+async def handle_location(phone_no: str, intent: Intent, image_urls: list, stages: StageGraph) -> Optional[str]:
+    country = intent.country_info or {}
+    return f"""NOURA: EVIDENCE-BASED WELLBEING™
+
+📍 ¡Listo! Te mostraré opciones para {country.get('flag', '')} {country.get('name', intent.query)}.
+
+📸 Envíame una foto, el código de barras o el nombre de un producto para analizarlo."""
+
+
+async def handle_follow_up(phone_no: str, intent: Intent, image_urls: list, stages: StageGraph) -> Optional[str]:
+    last_result = await stages.run('last_analysis', get_latest_analysis, phone_no)
+    if not (last_result and last_result.get('found')):
+        return None
+    stages.cancel('prompt', 'summary')
+    if intent.follow_up == 'alternatives':
+        # Answered from the precomputed index, without the LLM
+        alternatives = find_alternatives(last_result, await current_location(intent, stages))
+        return format_alternatives(last_result, alternatives)
+    return format_detailed_analysis(last_result)
+
+
+async def handle_product(phone_no: str, intent: Intent, image_urls: list, stages: StageGraph) -> Optional[str]:
+    try:
+        analysis_result = await stages.run('product', lookup_product, intent.query)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"Error during product analysis: {e}")
+        return None
+    if not analysis_result.get('found'):
+        return None
+    # Found: the assistant will not be called
+    stages.cancel('prompt', 'summary')
+    store_latest_analysis(phone_no, analysis_result)
+    record_analysis(analysis_result)
+    return format_product_analysis(analysis_result)
+
+
+async def handle_out_of_scope(phone_no: str, intent: Intent, image_urls: list, stages: StageGraph) -> Optional[str]:
+    return OUT_OF_SCOPE_MESSAGE
+
+
+async def handle_chat(phone_no: str, intent: Intent, image_urls: list, stages: StageGraph) -> str:
+    """Answer with the assistant (web search, images, conversation history)."""
+    query = intent.query
+    
+    # History, prompt and summary were started by handle_message; this only waits for them
+    history_manager = ConversationHistory(redis_conn, phone_no)
+    history = list(await stages.run('history', history_manager.load))
+    
+    # Add user message to history
+    history.append({"role": 'user', "content": query})
+    
+    # Get system prompt from Google Docs
+    raw_prompt = await stages.run('prompt', load_system_prompt)
+    
+    # Static system prompt (cached per prompt revision) + per-request context
+    system_prompt = static_system_prompt(raw_prompt)
+    summary = await stages.run('summary', summarise_history, query, stages)
+    context = dynamic_context(summary, datetime.now().date())
+    
+    # Prepare messages for OpenAI
+    messages = prepare_messages_for_openai(history, system_prompt, max_messages=10, context=context)
+    
+    # Add image if present
+    if len(image_urls) == 1:
+        messages = attach_image(messages, query, image_urls[0], detail="high")
+    
+    # Get user location for web search
+    location = await current_location(intent, stages)
+    
+    # Standalone questions asked recently by anyone in the same country are answered from the cache
+    cache_key, cached = lookup_answer(raw_prompt, query, history[:-1], location, "medium",
+                                      has_images=bool(image_urls))
+    set_attributes(**{'noura.answer_cache.hit': bool(cached), 'noura.answer_cache.cacheable': bool(cache_key)})
+    
+    # A photo close to one already answered for the same caption reuses that answer
+    hashes, image_key = [], None
+    if image_urls:
+        hashes = await stages.run('image_hashes', image_hashes, image_urls)
+        image_key = image_answer_key(raw_prompt, query, history[:-1], location)
+        if len(image_urls) == 1:
+            cached = find_image_answer(image_key, hashes[0])
+            set_attributes(**{'noura.image_cache.hit': bool(cached)})
+    
+    # Get response from OpenAI
+    try:
+        if not cached:
+            logger.info(f"Sending to OpenAI with {len(messages)} messages", extra=VERBOSE)
         
-        # Get response from OpenAI
-        try:
-            logger.info(f"Sending to OpenAI with {len(messages)} messages")
-            
-            openai_response = gpt_with_web_search(
-                messages=messages,
-                user_location=user_location,
-                context_size="medium"
-            )
+        if cached:
+            chatbot_response = cached['answer']
+        elif len(image_urls) > 1:
+            # Several product photos: one analysis per photo, combined into a single reply
+            chatbot_response = await stages.run(
+                'answer', analyze_images_concurrently, messages, query, image_urls, location, hashes, image_key)
+        else:
+            start = time.monotonic()
+            openai_response = await stages.run('answer', gpt_with_web_search, messages, location, "medium")
             
             if openai_response and hasattr(openai_response, 'choices') and openai_response.choices:
                 chatbot_response = openai_response.choices[0].message.content.strip()
-                logger.info(f"OpenAI response received: {len(chatbot_response)} chars")
+                logger.info(f"OpenAI response received: {len(chatbot_response)} chars", extra=VERBOSE)
+                store_answer(cache_key, openai_response, time.monotonic() - start)
+                if image_urls:
+                    store_image_answer(image_key, hashes[0], chatbot_response, time.monotonic() - start)
             else:
                 logger.error("Invalid OpenAI response")
                 chatbot_response = "Lo siento, no pude procesar tu solicitud. Por favor, intenta de nuevo."
-                
-        except Exception as e:
-            logger.error(f"Error calling OpenAI: {e}")
             
-            # Try with reduced history if token limit exceeded
-            if 'context' in str(e).lower():
-                try:
-                    logger.info("Retrying with reduced history")
-                    messages = prepare_messages_for_openai(history, system_prompt, max_messages=5)
-                    
-                    if image_url:
-                        for i in range(len(messages) - 1, -1, -1):
-                            if messages[i]['role'] == 'user':
-                                messages[i]['content'] = [
-                                    {"type": "text", "text": query},
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": image_url,
-                                            "detail": "low"
-                                        }
-                                    }
-                                ]
-                                break
-                    
-                    openai_response = gpt_with_web_search(
-                        messages=messages,
-                        user_location=user_location,
-                        context_size="low"
-                    )
+    except DeadlineExceeded:
+        chatbot_response = TIMEOUT_MESSAGE
+    except Exception as e:
+        logger.error(f"Error calling OpenAI: {e}")
+        
+        # Try with reduced history if token limit exceeded (and there is still time for it)
+        if 'context' in str(e).lower() and has_time(DEADLINE_RETRY_MIN, 'answer_retry'):
+            try:
+                logger.info("Retrying with reduced history")
+                messages = prepare_messages_for_openai(history, system_prompt, max_messages=5, context=context)
+                
+                if image_urls:
+                    messages = attach_image(messages, query, image_urls[0], detail="low")
+                
+                openai_response = await stages.run('answer_retry', gpt_with_web_search, messages, location, "low")
+                
+                if openai_response and hasattr(openai_response, 'choices') and openai_response.choices:
+                    chatbot_response = openai_response.choices[0].message.content.strip()
+                else:
+                    chatbot_response = "Lo siento, hubo un problema con el procesamiento. Por favor, intenta de nuevo."
                     
-                    if openai_response and hasattr(openai_response, 'choices') and openai_response.choices:
-                        chatbot_response = openai_response.choices[0].message.content.strip()
-                    else:
-                        chatbot_response = "Lo siento, hubo un problema con el procesamiento. Por favor, intenta de nuevo."
-                        
-                except Exception as e2:
-                    logger.error(f"Retry failed: {e2}")
-                    chatbot_response = "Lo siento, no pude procesar tu solicitud debido a limitaciones técnicas."
+            except Exception as e2:
+                logger.error(f"Retry failed: {e2}")
+                chatbot_response = "Lo siento, no pude procesar tu solicitud debido a limitaciones técnicas."
+        else:
+            chatbot_response = "Lo siento, ocurrió un error al procesar tu mensaje. Por favor, intenta de nuevo."
+    
+    # Add assistant response to history
+    history.append({'role': 'assistant', 'content': chatbot_response})
+    
+    # Save updated history
+    history_manager.save(history)
+    
+    return chatbot_response
+
+
+ROUTE_HANDLERS = {
+    GREETING: handle_greeting,
+    LOCATION: handle_location,
+    FOLLOW_UP: handle_follow_up,
+    BARCODE: handle_product,
+    PRODUCT: handle_product,
+    OUT_OF_SCOPE: handle_out_of_scope,
+    IMAGE: handle_chat,
+    CHAT: handle_chat,
+}
+
+
+async def degraded_reply(phone_no: str, Body: str, media_items: list) -> str:
+    """Cheap answer for a message shed under load: Open Food Facts only, never OpenAI.
+
+    Text that names a product gets a score without the FDA check; greetings get the
+    greeting; everything else (media, free chat) gets the busy message.
+    """
+    query = clean_twilio_urls(Body or '').strip()
+    if media_items or not query or degraded_slots.locked():
+        shed.inc(reason='busy', reply='busy')
+        return BUSY_MESSAGE
+
+    async with degraded_slots:
+        try:
+            analysis_result = await asyncio.wait_for(analyze_product(query, check_recalls=False),
+                                                     remaining(DEGRADED_TIMEOUT))
+        except Exception as e:
+            logger.error(f"Degraded product lookup failed: {e}")
+            analysis_result = {'found': False}
+
+    if analysis_result.get('is_greeting'):
+        shed.inc(reason='busy', reply='greeting')
+        return get_greeting_message(query)
+    if analysis_result.get('found'):
+        shed.inc(reason='busy', reply='degraded')
+        store_latest_analysis(phone_no, analysis_result)
+        return (format_product_analysis(analysis_result)
+                + "\n\n⚡ Respuesta rápida por alta demanda: sin verificación de retiros FDA.")
+    shed.inc(reason='busy', reply='busy')
+    return BUSY_MESSAGE
+
+
+def deliver_reply(to_number: str, message: str) -> bool:
+    """Single send point for webhook replies; returns whether Twilio accepted the message."""
+    try:
+        respond(to_number, message)
+        return True
+    except Exception as e:
+        logger.error(f"Error sending reply to user: {e}")
+        return False
+
+
+def finish_message(From: str, MessageSid: str, reply: Optional[str]):
+    """Record the reply in the ledger and send it (None: nothing to send)."""
+    if reply is None:
+        if MessageSid:
+            complete_message(MessageSid, '', delivered=True)
+        return
+    if MessageSid:
+        # Stored before sending so a retry never recomputes, even if this worker dies mid-send
+        complete_message(MessageSid, reply, delivered=False)
+    delivered = deliver_reply(From, reply)
+    if MessageSid and delivered:
+        complete_message(MessageSid, reply, delivered=True)
+
+
+def replay_reply(From: str, MessageSid: str, reply: str):
+    """Send a stored reply whose first delivery failed and record the outcome."""
+    complete_message(MessageSid, reply, deliver_reply(From, reply))
+
+
+def fail_message(From: str, MessageSid: str):
+    """Forget a message whose processing failed and tell the user."""
+    if MessageSid:
+        release_message(MessageSid)
+    try:
+        respond(From, "Lo siento, ocurrió un error inesperado. Por favor, intenta de nuevo más tarde.")
+    except Exception as send_error:
+        logger.error(f"Error sending error message to user: {send_error}")
+
+
+async def process_queued_message(job: dict):
+    """Answer a message the webhook enqueued in queue mode (run by app.worker)."""
+    token = request_id_var.set(job.get('request_id') or '-')
+    # The budget starts when a worker picks the message up; time spent queued is not counted
+    deadline = Deadline()
+    try:
+        MessageSid = job.get('sid')
+        entry = await asyncio.to_thread(get_message_entry, MessageSid) if MessageSid else None
+        if entry and entry.get('state') == COMPLETED:
+            # Requeued after a worker died between answering and acknowledging the message
+            if not entry.get('delivered'):
+                await asyncio.to_thread(replay_reply, job['from'], MessageSid, entry['reply'])
+            return
+        try:
+            with within(deadline), request_profile(job.get('profile', False), job.get('request_id') or MessageSid):
+                reply = await handle_message(job['from'], job['body'], [tuple(item) for item in job['media']])
+        except Exception as e:
+            logger.error(f"Critical error processing queued message: {e}", exc_info=True)
+            await asyncio.to_thread(fail_message, job['from'], MessageSid)
+            return
+        # Twilio's send and the ledger writes block; off the loop, the other consumers and the heartbeat keep going
+        await asyncio.to_thread(finish_message, job['from'], MessageSid, reply)
+    finally:
+        request_id_var.reset(token)
+
+
+async def acquire_admission() -> bool:
+    with span('admission.acquire') as current:
+        admitted = await admission.acquire()
+        current.set_attribute('noura.admitted', admitted)
+        return admitted
+
+
+@app.get('/metrics')
+async def metrics():
+    """Prometheus metrics of this worker process."""
+    if QUEUE_MODE:
+        update_queue_gauges()
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get('/debug/profile')
+async def debug_profile(request: Request, seconds: float = 10):
+    """Collapsed stacks sampled from this worker for `seconds` (see app/profiling_utils.py)."""
+    if not PROFILER_TOKEN:
+        return PlainTextResponse("Not Found", status_code=404)
+    if not authorized(request.headers.get("Authorization")):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    try:
+        stacks = await profile_worker(seconds)
+    except RuntimeError as e:
+        return PlainTextResponse(str(e), status_code=409)
+    return PlainTextResponse(stacks, headers={"X-Worker-Pid": str(os.getpid())})
+
+
+@app.post('/whatsapp-endpoint')
+async def whatsapp_endpoint(
+    request: Request,
+    From: str = Form(...),
+    Body: str = Form(""),
+    NumMedia: str = Form("0"),
+    MessageSid: str = Form("")
+):
+    """Main WhatsApp webhook endpoint."""
+    # Time budget for the reply, from the moment the message arrives (admission wait included)
+    deadline = Deadline()
+    # Twilio retries slow webhooks with the same MessageSid; run the pipeline once per message
+    if MessageSid:
+        with span('idempotency.claim') as current:
+            state, entry = claim_message(MessageSid)
+            current.set_attribute('noura.message.state', state)
+        if state == IN_FLIGHT:
+            logger.info(f"Retry of {MessageSid} while it is still being processed; ignored")
+            duplicates_suppressed.inc(outcome='dropped')
+            return PlainTextResponse("OK", status_code=200)
+        if state == COMPLETED:
+            if entry.get('delivered'):
+                logger.info(f"Retry of {MessageSid} already answered; ignored")
+                duplicates_suppressed.inc(outcome='already_delivered')
             else:
-                chatbot_response = "Lo siento, ocurrió un error al procesar tu mensaje. Por favor, intenta de nuevo."
-        
-        # Add assistant response to history
-        history.append({'role': 'assistant', 'content': chatbot_response})
-        
-        # Save updated history
-        history_manager.save(history)
-        
-        # Send response to user
-        respond(From, chatbot_response)
-        
-        return PlainTextResponse("OK", status_code=200)
-        
+                # The reply was computed but sending it failed; send the stored reply again
+                logger.info(f"Retry of {MessageSid}; replaying the stored reply")
+                duplicates_suppressed.inc(outcome='replayed')
+                await asyncio.to_thread(replay_reply, From, MessageSid, entry['reply'])
+            return PlainTextResponse("OK", status_code=200)
+
+    try:
+        # Twilio sends one MediaUrlN/MediaContentTypeN pair per attachment
+        form = await request.form()
+        media_items = []
+        for i in range(int(NumMedia or 0)):
+            media_url = form.get(f'MediaUrl{i}')
+            if media_url:
+                media_items.append((media_url, form.get(f'MediaContentType{i}') or ''))
+
+        phone_no = From.replace('whatsapp:+', '')
+        message_count = count_user_message(phone_no)
+        if message_count > USER_RATE_LIMIT:
+            # Only the first message over the limit in a window is answered
+            notify = message_count == USER_RATE_LIMIT + 1
+            logger.info(f"Rate limit exceeded by {phone_no} ({message_count} messages)")
+            shed.inc(reason='rate_limited', reply='busy' if notify else 'none')
+            reply = RATE_LIMITED_MESSAGE if notify else None
+        elif QUEUE_MODE:
+            # Answered by the queue workers (python -m app.worker), in order per user
+            pending = enqueue_message(phone_no, {'from': From, 'body': Body, 'media': media_items,
+                                                 'sid': MessageSid, 'request_id': request_id_var.get(),
+                                                 'profile': wants_profile(request.headers.get(PROFILE_HEADER),
+                                                                          phone_no)})
+            logger.info(f"Message queued; {pending} pending for this user", extra=VERBOSE)
+            return PlainTextResponse("OK", status_code=200)
+        elif not await acquire_admission():
+            logger.info("Worker at capacity; shedding message")
+            with within(deadline):
+                reply = await degraded_reply(phone_no, Body, media_items)
+        else:
+            try:
+                with span('handle_message', **{'noura.message.media': len(media_items),
+                                               'noura.message.chars': len(Body)}), within(deadline), \
+                        request_profile(wants_profile(request.headers.get(PROFILE_HEADER), phone_no),
+                                        request_id_var.get()):
+                    reply = await handle_message(From, Body, media_items)
+            finally:
+                admission.release()
+
     except Exception as e:
         logger.error(f"Critical error in whatsapp_endpoint: {e}", exc_info=True)
-        
-        # Try to send error message to user
-        try:
-            respond(From, "Lo siento, ocurrió un error inesperado. Por favor, intenta de nuevo más tarde.")
-        except Exception as send_error:
-            logger.error(f"Error sending error message to user: {send_error}")
-        
+        await asyncio.to_thread(fail_message, From, MessageSid)
         return PlainTextResponse("Error", status_code=500)
 
+    with span('reply.deliver'):
+        # Blocking send: off the loop so the other requests' pipelines keep running meanwhile
+        await asyncio.to_thread(finish_message, From, MessageSid, reply)
+    return PlainTextResponse("OK", status_code=200)
+
 
 def validate_twilio_credentials():
     """Validate Twilio credentials by attempting to create a client."""
     try:
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        client = get_twilio_client()
         account = client.api.accounts(TWILIO_ACCOUNT_SID).fetch()
         logger.info(f"Twilio credentials validated successfully. Account: {account.friendly_name}")
         return True
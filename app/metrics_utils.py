@@ -0,0 +1,103 @@
+import os
+import threading
+from bisect import bisect_left
+from typing import Dict, Tuple
+
+# Metrics are kept in memory per worker process and served in the Prometheus text
+# format on /metrics; every sample carries the worker pid so scrapes can be summed.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 240)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: Tuple, extra: Tuple = ()) -> str:
+    pairs = (('pid', str(os.getpid())),) + key + extra
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Counter:
+    """Monotonic count, optionally split by labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Tuple, float] = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        for key, value in list(self._values.items()):
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Gauge(Counter):
+    """Value that goes up and down, e.g. requests in flight."""
+
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, plus their sum and count."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with _lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, **labels) -> int:
+        counts = self._values.get(_label_key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        for key, counts in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_format_labels(key, (('le', str(bound)),))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {counts[-1]}"
+            yield f"{self.name}_count{_format_labels(key)} {cumulative}"
+
+
+def render_metrics() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
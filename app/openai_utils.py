@@ -2,8 +2,11 @@
 
 import os 
 from dotenv import load_dotenv
-from litellm import completion
 from app.prompts import SUMMARY_PROMPT
+from app.metrics_utils import Counter
+from app.logger_utils import logger
+from app.tracing_utils import llm_span, record_usage
+from app.rate_limit_utils import SUMMARY, acall_openai, call_openai, estimate_tokens
 import logging
 
 load_dotenv()
@@ -55,26 +58,73 @@ SUPPORTED_MODELS = {
     }
 
 
-def gpt_without_functions(model, stream=False, messages=[]):
+openai_prompt_tokens = Counter('noura_openai_prompt_tokens_total', 'Prompt tokens sent to OpenAI, by model')
+openai_cached_tokens = Counter('noura_openai_cached_prompt_tokens_total',
+                               'Prompt tokens served from the provider prompt cache, by model')
+
+
+def log_prompt_cache(response):
+    """Log and count how much of the prompt was served from the provider's prompt cache."""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = (getattr(details, 'cached_tokens', 0) or 0) if details else 0
+    model = getattr(response, 'model', '') or ''
+    openai_prompt_tokens.inc(prompt_tokens, model=model)
+    openai_cached_tokens.inc(cached_tokens, model=model)
+    ratio = cached_tokens / prompt_tokens if prompt_tokens else 0
+    logger.info(f"Prompt cache: {cached_tokens}/{prompt_tokens} prompt tokens cached ({ratio:.0%}) on {model}")
+
+
+def gpt_without_functions(model, stream=False, messages=[], priority=None):
     """ GPT model without function call. """
     if model not in SUPPORTED_MODELS:
         return False
-    response = completion(
-        model=model, 
-        messages=messages,
-        temperature=TEMPERATURE,
-        max_tokens=MAX_TOKENS,
-        top_p=TOP_P,
-        frequency_penalty=FREQUENCY_PENALTY,
-        presence_penalty=PRESENCE_PENALTY,
-        stream=stream
-    )
+    from litellm import completion  # litellm takes seconds to import; load it on first call
+    with llm_span('litellm.completion', model, messages) as current:
+        response = call_openai(
+            model, estimate_tokens(messages, MAX_TOKENS), completion,
+            model=model, 
+            messages=messages,
+            temperature=TEMPERATURE,
+            max_tokens=MAX_TOKENS,
+            top_p=TOP_P,
+            frequency_penalty=FREQUENCY_PENALTY,
+            presence_penalty=PRESENCE_PENALTY,
+            stream=stream,
+            priority=priority,
+        )
+        if not stream:
+            record_usage(current, response)
     return response 
 
 
+async def agpt_without_functions(model, messages=[], priority=None):
+    """ Async gpt_without_functions (no streaming). """
+    if model not in SUPPORTED_MODELS:
+        return False
+    from litellm import acompletion
+    with llm_span('litellm.completion', model, messages) as current:
+        response = await acall_openai(
+            model, estimate_tokens(messages, MAX_TOKENS), acompletion,
+            model=model, 
+            messages=messages,
+            temperature=TEMPERATURE,
+            max_tokens=MAX_TOKENS,
+            top_p=TOP_P,
+            frequency_penalty=FREQUENCY_PENALTY,
+            presence_penalty=PRESENCE_PENALTY,
+            priority=priority,
+        )
+        record_usage(current, response)
+    return response
+
+
 
-def summarise_conversation(history):
-    """Summarise conversation history in one sentence"""
+def _summary_transcript(history):
+    """Last turns of `history` as the User:/Bot: text the summary model reads ('' if empty)."""
     import re
 
     def clean_twilio_urls(text):
@@ -127,9 +177,8 @@ def summarise_conversation(history):
                 content = content[:1000] + "... [truncated]"
             conversation += f"Bot: {content}\n"
 
-    # Si no hay conversación, retornar un summary genérico
     if not conversation.strip():
-        return "Nueva conversación iniciada"
+        return ''
 
     # Log the conversation length to monitor token usage
     logging.info(f"Summary - Conversation length: {len(conversation)} characters")
@@ -138,6 +187,15 @@ def summarise_conversation(history):
     if len(conversation) > 5000:  # Rough character limit
         conversation = conversation[-5000:]  # Keep only the last 5000 characters
         logging.warning("Summary - Conversation truncated to avoid context window issues")
+    return conversation
+
+
+def summarise_conversation(history):
+    """Summarise conversation history in one sentence"""
+    conversation = _summary_transcript(history)
+    # Si no hay conversación, retornar un summary genérico
+    if not conversation:
+        return "Nueva conversación iniciada"
 
     try:
         openai_response = gpt_without_functions(
@@ -146,7 +204,8 @@ def summarise_conversation(history):
                             messages=[
                                 {'role': 'system', 'content': SUMMARY_PROMPT}, 
                                 {'role': 'user', 'content': conversation}
-                        ])
+                            ],
+                            priority=SUMMARY)
         chatbot_response = openai_response.choices[0].message.content.strip()
         return chatbot_response
     except Exception as e:
@@ -155,15 +214,37 @@ def summarise_conversation(history):
         return "Conversación sobre diversos temas"
 
 
+async def asummarise_conversation(history):
+    """Async summarise_conversation; cancelling it abandons the request (used by the webhook pipeline)."""
+    conversation = _summary_transcript(history)
+    if not conversation:
+        return "Nueva conversación iniciada"
+
+    try:
+        openai_response = await agpt_without_functions(
+                            model="gpt-4o-mini",
+                            messages=[
+                                {'role': 'system', 'content': SUMMARY_PROMPT}, 
+                                {'role': 'user', 'content': conversation}
+                            ],
+                            priority=SUMMARY)
+        return openai_response.choices[0].message.content.strip()
+    except Exception as e:
+        logging.error(f"Error in summarise_conversation: {e}")
+        return "Conversación sobre diversos temas"
+
+
 def gpt_with_web_search(messages, stream=False):
     """ GPT model with REAL web search capability using gpt-4o-mini-search-preview. """
     model = "gpt-4o-mini-search-preview"  # Usar el modelo que SÍ soporta web search
     if model not in SUPPORTED_MODELS:
         logging.error(f"Model {model} not supported.")
         return None
+    from litellm import completion
     try:
         # gpt-4o-mini-search-preview SÍ soporta web search nativo
-        response = completion(
+        response = call_openai(
+            model, estimate_tokens(messages, MAX_TOKENS), completion,
             model=model, 
             messages=messages,
             temperature=TEMPERATURE,
@@ -181,7 +262,8 @@ def gpt_with_web_search(messages, stream=False):
         # Fallback a gpt-4o-mini sin web search
         try:
             logging.info("Fallback to gpt-4o-mini without web search")
-            response = completion(
+            response = call_openai(
+                "gpt-4o-mini", estimate_tokens(messages, MAX_TOKENS), completion,
                 model="gpt-4o-mini", 
                 messages=messages,
                 temperature=TEMPERATURE,
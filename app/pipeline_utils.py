@@ -0,0 +1,145 @@
+"""Run the steps of one webhook request as a small graph of concurrent stages.
+
+Each stage is a function started as an asyncio task (sync functions run in a
+thread). Stages start as soon as their inputs can be known and are awaited only
+where their result is used, so independent Redis reads, the Google Doc fetch and
+the product lookup overlap instead of running one after another.
+
+Dependencies are recorded as they happen: a stage that awaits another depends on
+it, and a stage started by the request after it awaited some stages depends on
+those. When the request ends, the chain of stages that finished last — its
+critical path — is logged and exported, together with the time all stages would
+have taken one after another.
+
+Stages whose result is no longer needed (e.g. the assistant's prompt once a
+product was found) are cancelled. Coroutine stages stop at once; a stage running
+in a thread cannot be interrupted, so it finishes in the background and its result
+is dropped.
+
+Every stage is given what is left of the message's time budget (deadline_utils):
+one still running when it runs out is stopped the same way and raises
+DeadlineExceeded, and the miss is counted by stage.
+"""
+import asyncio
+import contextvars
+import inspect
+import time
+from typing import Callable, Dict, List, Optional
+
+from app.deadline_utils import run_within_deadline
+from app.logger_utils import logger
+from app.metrics_utils import Counter, Histogram
+from app.profiling_utils import profiled_call
+from app.tracing_utils import span
+
+# The stage whose task is running, so get() knows who is waiting on whom
+_current_stage = contextvars.ContextVar('pipeline_stage', default=None)
+
+stage_seconds = Histogram('noura_pipeline_stage_seconds', 'Duration of each webhook pipeline stage, by stage')
+critical_path_seconds = Histogram('noura_pipeline_critical_path_seconds',
+                                  'Time on the critical path of the webhook pipeline, by route')
+critical_stage_seconds = Counter('noura_pipeline_critical_stage_seconds_total',
+                                 'Seconds each stage spent on the critical path, by stage')
+stages_cancelled = Counter('noura_pipeline_stages_cancelled_total', 'Pipeline stages cancelled as unneeded, by stage')
+
+
+class Stage:
+    def __init__(self, name: str, deps: List['Stage']):
+        self.name = name
+        self.deps = deps
+        self.task: Optional[asyncio.Task] = None
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.cancelled = False
+
+    @property
+    def seconds(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+
+class StageGraph:
+    """Stages of one request. Use from a single event loop; close() when the request ends."""
+
+    def __init__(self):
+        self.stages: Dict[str, Stage] = {}
+        self.created = time.monotonic()
+        # Stages the request itself has waited on; stages it starts afterwards depend on them
+        self._awaited: List[Stage] = []
+
+    def start(self, name: str, fn: Callable, *args) -> Stage:
+        """Start `fn(*args)` as stage `name`, unless a stage of that name was already started."""
+        if name in self.stages:
+            return self.stages[name]
+        parent = _current_stage.get()
+        stage = Stage(name, list(parent.deps if parent else self._awaited))
+        self.stages[name] = stage
+        stage.task = asyncio.create_task(self._run(stage, fn, args))
+        return stage
+
+    async def _run(self, stage: Stage, fn: Callable, args: tuple):
+        _current_stage.set(stage)
+        try:
+            with span(f"stage {stage.name}"):
+                if inspect.iscoroutinefunction(fn):
+                    call = fn(*args)
+                else:
+                    call = asyncio.to_thread(profiled_call, fn, *args)
+                return await run_within_deadline(call, stage.name)
+        finally:
+            stage.finished = time.monotonic()
+            stage_seconds.observe(stage.seconds, stage=stage.name)
+
+    async def get(self, name: str):
+        """Wait for stage `name` and return its result (or raise its exception)."""
+        stage = self.stages[name]
+        waiter = _current_stage.get()
+        deps = waiter.deps if waiter else self._awaited
+        if stage not in deps:
+            deps.append(stage)
+        # Shielded: a caller that gives up must not cancel the stage for other callers
+        return await asyncio.shield(stage.task)
+
+    async def run(self, name: str, fn: Callable, *args):
+        """Start the stage if needed and wait for it."""
+        self.start(name, fn, *args)
+        return await self.get(name)
+
+    def cancel(self, *names: str):
+        """Drop stages whose result is no longer needed."""
+        for name in names:
+            stage = self.stages.get(name)
+            if stage and not stage.cancelled and not stage.task.done():
+                stage.cancelled = True
+                stage.task.cancel()
+                stages_cancelled.inc(stage=name)
+
+    async def close(self):
+        """Cancel the stages still running and wait until they have all stopped."""
+        self.cancel(*self.stages)
+        tasks = [stage.task for stage in self.stages.values()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def critical_path(self) -> List[Stage]:
+        """The chain of finished stages, each the last-finishing input of the next, that the request waited on."""
+        candidates = [stage for stage in self._awaited if stage.finished and not stage.cancelled]
+        path = []
+        while candidates:
+            stage = max(candidates, key=lambda s: s.finished)
+            path.append(stage)
+            candidates = [dep for dep in stage.deps if dep.finished and not dep.cancelled]
+        return path[::-1]
+
+    def report(self, route: str) -> float:
+        """Log and export the critical path; return its length in seconds."""
+        path = self.critical_path()
+        seconds = sum(stage.seconds for stage in path)
+        for stage in path:
+            critical_stage_seconds.inc(stage.seconds, stage=stage.name)
+        critical_path_seconds.observe(seconds, route=route)
+        sequential = sum(stage.seconds for stage in self.stages.values() if not stage.cancelled)
+        cancelled = [stage.name for stage in self.stages.values() if stage.cancelled]
+        chain = ' → '.join(f"{stage.name} {stage.seconds:.2f}" for stage in path) or 'none'
+        logger.info(f"Critical path {seconds:.2f} s of {time.monotonic() - self.created:.2f} s ({route}): {chain}; "
+                    f"stages total {sequential:.2f} s" + (f"; cancelled {', '.join(cancelled)}" if cancelled else ''))
+        return seconds
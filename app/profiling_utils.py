@@ -0,0 +1,165 @@
+"""On-demand CPU profiling of a live worker.
+
+Two tools, both off unless PROFILER_TOKEN is set:
+
+* GET /debug/profile?seconds=N (header `Authorization: Bearer $PROFILER_TOKEN`)
+  samples every thread's stack of the worker that receives it for N seconds and
+  returns collapsed stacks ("frame;frame;frame count" per line), the input of
+  flamegraph.pl, speedscope and similar tools:
+
+      curl -H "Authorization: Bearer $PROFILER_TOKEN" "http://worker:3002/debug/profile?seconds=30" > cpu.folded
+
+* Per-request cProfile, for messages carrying `X-Noura-Profile: $PROFILER_TOKEN` or
+  sent from a number listed in PROFILE_NUMBERS. The pipeline's event-loop work and
+  its thread stages are profiled and written to PROFILE_DIR/<request id>-<random>.prof
+  (open with snakeviz or pstats); the top functions are logged. The request id comes
+  from a client header, so only [A-Za-z0-9_-] of it is kept in the file name. Other requests running
+  on the same event loop at the same time are included in the event-loop part.
+
+With gunicorn each request reaches one worker; repeat the call to profile the others.
+"""
+import asyncio
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as Tally
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from app.logger_utils import logger
+
+load_dotenv()
+
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN", "")
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+# 200 samples per second; each sample walks every thread's stack while holding the GIL
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+PROFILE_NUMBERS = {n.strip().replace('whatsapp:', '').lstrip('+')
+                   for n in os.getenv("PROFILE_NUMBERS", "").split(',') if n.strip()}
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.getenv("LOG_DIR", "./logs"), "profiles"))
+PROFILE_HEADER = "X-Noura-Profile"
+
+_sampling = threading.Lock()
+# cProfile allows one active profiler per thread; the event loop thread profiles one request at a time
+_request_profiling = threading.Lock()
+# Profiles of the request being profiled (event loop + thread stages), merged when it ends
+_request_profiles: ContextVar[Optional[list]] = ContextVar('request_profiles', default=None)
+
+
+def authorized(header_value: Optional[str]) -> bool:
+    """Whether an Authorization (or profile) header carries the profiler token."""
+    if not PROFILER_TOKEN or not header_value:
+        return False
+    token = header_value[7:] if header_value.startswith('Bearer ') else header_value
+    return hmac.compare_digest(token.encode(), PROFILER_TOKEN.encode())
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    # Keep the path from the package or site-packages root, enough to tell modules apart
+    for marker in ('/site-packages/', '/app/', '/lib/python'):
+        index = filename.rfind(marker)
+        if index >= 0:
+            filename = filename[index + 1:]
+            break
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(';', ',')
+
+
+def sample_stacks(seconds: float, interval: float = PROFILER_INTERVAL) -> str:
+    """Sample all threads (except this one) for `seconds`; return collapsed stacks, most frequent first."""
+    if not _sampling.acquire(blocking=False):
+        raise RuntimeError("a profile is already running in this worker")
+    try:
+        me = threading.get_ident()
+        names = {}
+        stacks = Tally()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                stacks[';'.join(reversed(labels))] += 1
+            time.sleep(interval)
+    finally:
+        _sampling.release()
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+async def profile_worker(seconds: float) -> str:
+    seconds = max(0.1, min(seconds, PROFILER_MAX_SECONDS))
+    logger.info(f"Sampling worker stacks for {seconds:.1f} s")
+    return await asyncio.to_thread(sample_stacks, seconds)
+
+
+def wants_profile(header_value: Optional[str], phone_no: str) -> bool:
+    return bool(PROFILER_TOKEN) and (phone_no in PROFILE_NUMBERS or authorized(header_value))
+
+
+@contextmanager
+def request_profile(enabled: bool, name: str):
+    """cProfile the enclosed request (event loop part and, via profiled_call, its thread stages)."""
+    if not enabled or not _request_profiling.acquire(blocking=False):
+        if enabled:
+            logger.info("Another request is being profiled in this worker; not profiling this one")
+        yield
+        return
+    profiles = [cProfile.Profile()]
+    token = _request_profiles.set(profiles)
+    start = time.monotonic()
+    profiles[0].enable()
+    try:
+        yield
+    finally:
+        profiles[0].disable()
+        _request_profiles.reset(token)
+        _request_profiling.release()
+        _save_request_profile(profiles, name, time.monotonic() - start)
+
+
+def profiled_call(fn, *args):
+    """Run fn(*args), under cProfile when it belongs to a profiled request (used for thread stages)."""
+    profiles = _request_profiles.get()
+    if profiles is None:
+        return fn(*args)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(fn, *args)
+    finally:
+        profiles.append(profile)
+
+
+def _save_request_profile(profiles: list, name: str, seconds: float):
+    try:
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        # The id is client supplied ("../../x"): never let it pick the directory
+        safe_name = re.sub(r'[^A-Za-z0-9_-]', '_', name)[:64]
+        path = os.path.join(PROFILE_DIR, f"{safe_name}-{uuid.uuid4().hex[:8]}.prof")
+        stats.dump_stats(path)
+        top = io.StringIO()
+        pstats.Stats(path, stream=top).sort_stats('cumulative').print_stats(15)
+        logger.info(f"Request {name!r} profiled ({seconds:.2f} s, {len(profiles) - 1} thread stages), "
+                    f"saved to {path}\n"
+                    f"{top.getvalue()}")
+    except Exception as e:
+        logger.error(f"Saving request profile failed: {e}")
@@ -1,6 +1,5 @@
+import hashlib
 import os
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
 from dotenv import load_dotenv
 
 SUMMARY_PROMPT = """
@@ -8,8 +7,83 @@ Summarize the following conversation and extract key points, especially from use
 Respond in maximum 5 sentences mentioning the most important information.
 """
 
+WEB_SEARCH_INSTRUCTIONS = """INSTRUCCIONES CRÍTICAS PARA BÚSQUEDA WEB (cuando el modo es "búsqueda web"):
+- Siempre sigue las instrucciones del sistema anterior al pie de la letra
+- Usa la información web SOLO para complementar, no para contradecir el prompt
+- Mantén el formato, tono y estilo especificado en el prompt del sistema
+- La búsqueda web debe ENRIQUECER tu respuesta, no cambiar tu comportamiento base
+
+PROHIBIDO TERMINANTEMENTE:
+- NUNCA inventes URLs ficticias como "example.com" o sitios que no existen
+- NUNCA uses enlaces placeholder como [Comprar aquí](https://www.example.com)
+- Si no encuentras URLs reales verificables, simplemente omite los enlaces
+- Es mejor NO dar enlace que dar un enlace falso
+- Solo incluye URLs que hayas encontrado mediante búsqueda web real
+- Si no puedes verificar una tienda online específica, no la menciones"""
+
+NO_WEB_SEARCH_INSTRUCTIONS = """IMPORTANTE - MODO SIN BÚSQUEDA WEB (cuando el modo es "sin búsqueda web"):
+- NO tienes acceso a información web actualizada
+- NUNCA inventes URLs, tiendas online o enlaces que no puedas verificar  
+- Si no puedes verificar precios o disponibilidad, no los menciones
+- Es mejor ser honesto sobre limitaciones que dar información falsa
+- Usa solo tu conocimiento base sin inventar datos actuales
+- Si no puedes encontrar tiendas específicas verificables, simplemente omite los enlaces"""
+
+WEB_SEARCH_MODE = "Modo: búsqueda web. Sigue las INSTRUCCIONES CRÍTICAS PARA BÚSQUEDA WEB."
+NO_WEB_SEARCH_MODE = "Modo: sin búsqueda web. Sigue IMPORTANTE - MODO SIN BÚSQUEDA WEB."
+
+# Values for the Google Doc placeholders that are the same on every request
+STATIC_PROMPT_FIELDS = {
+    "ProductName": "WhatsApp Assistant",
+    "OverallIndicator": "helpful and friendly",
+    "score": "85",
+    "confidence": "High",
+    "indicator": "🟢",
+    "key factor": "user support excellence",
+    "Topic 1": "User Experience",
+    "Topic 2": "Response Time",
+    "Insight 1": "Quick and helpful responses",
+    "Insight 2": "Available 24/7 for assistance",
+    "Insight 3": "Personalized conversation experience",
+    "assessment": "Excellent",
+}
+
+# Placeholders that change on every request. In the system prompt they point to the
+# context message sent after the history, so the system prompt stays byte-identical
+# across requests and the provider can serve it from its prompt cache.
+DYNAMIC_PROMPT_FIELDS = {
+    "history_summary": '(ver "Resumen de la conversación" en el CONTEXTO ACTUAL, al final)',
+    "today": '(ver "Fecha de hoy" en el CONTEXTO ACTUAL, al final)',
+}
+
+_prefix_cache = {}
+
+
+def static_system_prompt(raw_prompt: str) -> str:
+    """Doc prompt plus the search instructions, formatted once per prompt revision."""
+    digest = hashlib.sha1(raw_prompt.encode('utf-8')).hexdigest()
+    prefix = _prefix_cache.get(digest)
+    if prefix is None:
+        doc_prompt = raw_prompt.format(**STATIC_PROMPT_FIELDS, **DYNAMIC_PROMPT_FIELDS)
+        prefix = f"{doc_prompt}\n\n{WEB_SEARCH_INSTRUCTIONS}\n\n{NO_WEB_SEARCH_INSTRUCTIONS}"
+        if len(_prefix_cache) >= 4:
+            _prefix_cache.clear()
+        _prefix_cache[digest] = prefix
+    return prefix
+
+
+def dynamic_context(history_summary: str, today) -> str:
+    """Per-request values, sent as a system message right before the user's latest turn."""
+    return f"""CONTEXTO ACTUAL
+Fecha de hoy: {today}
+Resumen de la conversación: {history_summary}"""
+
 
 def get_google_doc_content(document_id=None):
+    # The Google client libraries are slow to import; only load them when the prompt is fetched
+    from googleapiclient.discovery import build
+    from google.oauth2 import service_account
+
     SCOPES = ['https://www.googleapis.com/auth/documents.readonly']
     credentials_info = {
         "type": os.getenv("GOOGLE_TYPE"),
@@ -27,7 +101,9 @@ def get_google_doc_content(document_id=None):
     if document_id is None:
         document_id = os.getenv("GOOGLE_DOC_ID")
     creds = service_account.Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
-    service = build('docs', 'v1', credentials=creds)
+    # GOOGLE_DOCS_API_ENDPOINT points the client at a local stand-in (benchmarks/replay_load.py)
+    endpoint = os.getenv("GOOGLE_DOCS_API_ENDPOINT")
+    service = build('docs', 'v1', credentials=creds, client_options={'api_endpoint': endpoint} if endpoint else None)
     doc = service.documents().get(documentId=document_id).execute()
     content = []
     for element in doc.get('body').get('content'):
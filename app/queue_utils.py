@@ -0,0 +1,216 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+from dotenv import load_dotenv
+
+from app.cookies_utils import decode_cookie, encode_cookie
+from app.logger_utils import logger
+from app.metrics_utils import Counter, Gauge, Histogram
+from app.redis_utils import redis_conn
+
+load_dotenv()
+
+# QUEUE_MODE=1: the webhook only enqueues messages and `python -m app.worker` processes answer them
+QUEUE_MODE = os.getenv("QUEUE_MODE", "0") == "1"
+QUEUE_WORKER_CONCURRENCY = int(os.getenv("QUEUE_WORKER_CONCURRENCY", "8"))
+# A worker whose heartbeat is older than this is considered dead and its messages are requeued
+QUEUE_HEARTBEAT_TTL = int(os.getenv("QUEUE_HEARTBEAT_TTL", "30"))
+# Seconds a consumer blocks waiting for work before checking for shutdown
+QUEUE_POLL_TIMEOUT = float(os.getenv("QUEUE_POLL_TIMEOUT", "2"))
+
+# Each user has their own list of pending messages. The ready list holds users with
+# pending messages that no consumer is serving; the active set holds those users plus
+# the ones being served. A consumer takes one user from the ready list, answers ONE
+# message, then puts the user back at the end of the ready list if more are pending:
+# one user's messages never run concurrently or out of order, and a user with fifty
+# pending messages gets one turn per round like everybody else.
+READY_KEY = 'noura_queue_ready'
+ACTIVE_KEY = 'noura_queue_active'
+CONSUMERS_KEY = 'noura_queue_consumers'
+
+queue_lag = Histogram('noura_queue_lag_seconds', 'Time from enqueue to a worker starting the message',
+                      buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+queue_depth = Gauge('noura_queue_ready_users', 'Users with pending messages waiting for a worker')
+queue_oldest = Gauge('noura_queue_oldest_seconds', 'Age of the oldest message at the front of the queue')
+queue_jobs = Counter('noura_queue_jobs_total', 'Queued messages, by outcome')
+
+_ENQUEUE = redis_conn.register_script("""
+redis.call('RPUSH', KEYS[1], ARGV[2])
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+end
+return redis.call('LLEN', KEYS[1])
+""")
+
+# KEYS: user queue, consumer job; pops the user's next message and records it as running
+_TAKE = redis_conn.register_script("""
+local job = redis.call('LPOP', KEYS[1])
+if job then
+    redis.call('SET', KEYS[2], job)
+end
+return job
+""")
+
+# KEYS: user queue, active set, ready list, consumer list, consumer job
+_FINISH = redis_conn.register_script("""
+redis.call('DEL', KEYS[5])
+redis.call('LREM', KEYS[4], 0, ARGV[1])
+if redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+else
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+""")
+
+# KEYS: consumers set, consumer list, consumer job, ready list, user queue (or a dummy key)
+# Puts a dead consumer's message back at the front of its user's queue and the user at the
+# front of the ready list. Only one caller wins the SREM, so concurrent recoveries are safe.
+_RECOVER = redis_conn.register_script("""
+if redis.call('SREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local job = redis.call('GET', KEYS[3])
+local user = redis.call('LPOP', KEYS[2])
+if user then
+    if job then
+        redis.call('LPUSH', KEYS[5], job)
+    end
+    redis.call('LPUSH', KEYS[4], user)
+end
+redis.call('DEL', KEYS[2], KEYS[3])
+return job and 2 or 1
+""")
+
+
+def _user_key(phone_no: str) -> str:
+    return f"noura_queue_user_{phone_no}"
+
+
+def _consumer_key(consumer_id: str) -> str:
+    return f"noura_queue_consumer_{consumer_id}"
+
+
+def _heartbeat_key(process_id: str) -> str:
+    return f"noura_queue_heartbeat_{process_id}"
+
+
+def enqueue_message(phone_no: str, job: dict) -> int:
+    """Queue a message for `phone_no`; returns how many of that user's messages are pending."""
+    job = dict(job, enqueued_at=time.time())
+    pending = _ENQUEUE(keys=[_user_key(phone_no), ACTIVE_KEY, READY_KEY], args=[phone_no, encode_cookie(job)])
+    queue_jobs.inc(outcome='enqueued')
+    return pending
+
+
+def update_queue_gauges():
+    """Refresh the depth and oldest-message gauges (called when /metrics is scraped)."""
+    try:
+        queue_depth.set(redis_conn.llen(READY_KEY))
+        front = redis_conn.lindex(READY_KEY, 0)
+        oldest = redis_conn.lindex(_user_key(front.decode('utf-8')), 0) if front else None
+        queue_oldest.set(time.time() - decode_cookie(oldest)['enqueued_at'] if oldest else 0)
+    except Exception as e:
+        logger.error(f"Could not read queue depth: {e}")
+
+
+def recover_dead_consumers() -> int:
+    """Requeue messages held by consumers whose process stopped sending heartbeats."""
+    recovered = 0
+    for member in redis_conn.smembers(CONSUMERS_KEY):
+        consumer_id = member.decode('utf-8')
+        process_id = consumer_id.rsplit('-', 1)[0]
+        if redis_conn.exists(_heartbeat_key(process_id)):
+            continue
+        consumer_key = _consumer_key(consumer_id)
+        user = redis_conn.lindex(consumer_key, 0)
+        user_key = _user_key(user.decode('utf-8')) if user else consumer_key
+        result = _RECOVER(keys=[CONSUMERS_KEY, consumer_key, f"{consumer_key}_job", READY_KEY, user_key],
+                          args=[consumer_id])
+        if result == 2:
+            recovered += 1
+            queue_jobs.inc(outcome='recovered')
+            logger.info(f"Requeued the message held by dead consumer {consumer_id}")
+    return recovered
+
+
+class QueueWorker:
+    """Runs `concurrency` consumers that answer queued messages with `handler(job)`."""
+
+    def __init__(self, handler: Callable[[dict], Awaitable[None]], concurrency: int = QUEUE_WORKER_CONCURRENCY,
+                 poll_timeout: float = QUEUE_POLL_TIMEOUT):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_timeout = poll_timeout
+        self.process_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._stopping = asyncio.Event()
+        self._poll_executor: Optional[ThreadPoolExecutor] = None
+
+    def stop(self):
+        """Finish the messages in progress, then return from run()."""
+        self._stopping.set()
+
+    async def _heartbeat(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.to_thread(redis_conn.set, _heartbeat_key(self.process_id), 1, ex=QUEUE_HEARTBEAT_TTL)
+                await asyncio.to_thread(recover_dead_consumers)
+            except Exception as e:
+                logger.error(f"Queue heartbeat failed: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=QUEUE_HEARTBEAT_TTL / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _consume(self, consumer_id: str):
+        consumer_key = _consumer_key(consumer_id)
+        job_key = f"{consumer_key}_job"
+        await asyncio.to_thread(redis_conn.sadd, CONSUMERS_KEY, consumer_id)
+        while not self._stopping.is_set():
+            try:
+                # Idle consumers sit in BLMOVE on threads of their own: in the default executor
+                # (min(32, cpus + 4) threads) they would starve the pipeline's to_thread stages
+                # and the heartbeat
+                user = await asyncio.get_running_loop().run_in_executor(
+                    self._poll_executor, redis_conn.blmove, READY_KEY, consumer_key, self.poll_timeout,
+                    'LEFT', 'RIGHT')
+            except Exception as e:
+                logger.error(f"Queue poll failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            if user is None:
+                continue
+            phone_no = user.decode('utf-8')
+            user_key = _user_key(phone_no)
+            try:
+                data = await asyncio.to_thread(_TAKE, keys=[user_key, job_key])
+                if data:
+                    job = decode_cookie(data)
+                    queue_lag.observe(max(0.0, time.time() - job['enqueued_at']))
+                    await self.handler(job)
+                    queue_jobs.inc(outcome='processed')
+            except Exception as e:
+                logger.error(f"Queued message for {phone_no} failed: {e}", exc_info=True)
+                queue_jobs.inc(outcome='failed')
+            finally:
+                await asyncio.to_thread(_FINISH, keys=[user_key, ACTIVE_KEY, READY_KEY, consumer_key, job_key],
+                                        args=[phone_no])
+        await asyncio.to_thread(redis_conn.srem, CONSUMERS_KEY, consumer_id)
+
+    async def run(self):
+        logger.info(f"Queue worker {self.process_id} started with {self.concurrency} consumers")
+        self._poll_executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='queue-poll')
+        await asyncio.to_thread(redis_conn.set, _heartbeat_key(self.process_id), 1, ex=QUEUE_HEARTBEAT_TTL)
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await asyncio.gather(*(self._consume(f"{self.process_id}-{i}") for i in range(self.concurrency)))
+        finally:
+            self._stopping.set()
+            await heartbeat
+            await asyncio.to_thread(redis_conn.delete, _heartbeat_key(self.process_id))
+            self._poll_executor.shutdown(wait=False)
+            logger.info(f"Queue worker {self.process_id} stopped")
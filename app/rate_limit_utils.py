@@ -0,0 +1,380 @@
+"""Client-side rate limiting of OpenAI calls, per model, shared by every call in the process.
+
+Each model has a requests-per-minute and a tokens-per-minute bucket. A call reserves
+one request and its estimated tokens (prompt + max output) before it is sent, and
+the estimate is corrected with the reported usage afterwards. When OpenAI returns
+x-ratelimit-* headers, they update the limits and what is left of them. Calls that
+do not fit wait in a priority queue (interactive replies, then summaries, then
+batch jobs) instead of being sent only to get a 429. A 429 that still happens
+pauses the model for its retry-after and the call is retried.
+
+Limits come from OPENAI_RATE_LIMITS ("model=rpm/tpm,...", tpm 0 when the model is
+not token-limited); models not listed are learned from the x-ratelimit-limit-*
+headers. The organisation's limits are shared by every process (gunicorn workers and
+queue workers): each one takes 1/OPENAI_LIMIT_PROCESSES of them. OPENAI_LIMITER=0 turns
+the limiter off (calls go straight out, as before).
+
+Within a message's time budget (deadline_utils) a call waits no longer than what is
+left of it, and is sent with that as its timeout.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.deadline_utils import record_miss, remaining
+from app.logger_utils import logger
+from app.metrics_utils import Counter, Gauge, Histogram
+
+load_dotenv()
+
+OPENAI_LIMITER = os.getenv("OPENAI_LIMITER", "1") == "1"
+OPENAI_RATE_LIMITS = os.getenv(
+    "OPENAI_RATE_LIMITS",
+    "gpt-4o-search-preview=500/30000,gpt-4o-mini-search-preview=500/200000,gpt-4.1=500/30000,"
+    "gpt-4o-mini=500/200000,whisper-1=500/0")
+OPENAI_LIMIT_PROCESSES = max(1, int(os.getenv("OPENAI_LIMIT_PROCESSES", os.getenv("GUNICORN_WORKERS", "2"))))
+OPENAI_LIMIT_RETRIES = int(os.getenv("OPENAI_LIMIT_RETRIES", "2"))
+
+INTERACTIVE = 0
+SUMMARY = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', SUMMARY: 'summary', BATCH: 'batch'}
+# Longest a call waits for budget before it fails like any other OpenAI error
+MAX_WAIT = {
+    INTERACTIVE: float(os.getenv("OPENAI_LIMIT_MAX_WAIT", "20")),
+    SUMMARY: float(os.getenv("OPENAI_LIMIT_MAX_WAIT_SUMMARY", "30")),
+    BATCH: float(os.getenv("OPENAI_LIMIT_MAX_WAIT_BATCH", "600")),
+}
+# Waiters behind others re-check this often
+POLL_INTERVAL = 0.05
+
+limit_wait_seconds = Histogram('noura_openai_limit_wait_seconds',
+                               'Time OpenAI calls waited for rate limit budget, by model and priority',
+                               buckets=(0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60))
+limit_waiting = Gauge('noura_openai_limit_waiting', 'OpenAI calls waiting for rate limit budget, by model')
+limit_timeouts = Counter('noura_openai_limit_timeouts_total',
+                         'OpenAI calls that gave up waiting for budget, by model and priority')
+rate_limited = Counter('noura_openai_rate_limited_total', 'OpenAI 429 responses, by model')
+
+_priority: ContextVar[int] = ContextVar('openai_priority', default=INTERACTIVE)
+
+
+class RateLimitTimeout(Exception):
+    """No budget for the call within its priority's MAX_WAIT."""
+
+
+@contextmanager
+def openai_priority(priority: int):
+    """Run the enclosed OpenAI calls (and tasks/threads started from them) at `priority`."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    limits = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        model, budget = item.split('=', 1)
+        rpm, _, tpm = budget.partition('/')
+        limits[model.strip()] = (float(rpm or 0), float(tpm or 0))
+    return limits
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """OpenAI reset durations: "1s", "6m0s", "20ms", "1h2m3.5s"."""
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value or '')
+    if not parts:
+        return None
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def estimate_tokens(messages, max_tokens: int = 0) -> int:
+    """Rough prompt size (4 characters a token; images count as 1000) plus the output allowance."""
+    characters = 0
+    images = 0
+    for message in messages or []:
+        content = message.get('content') if isinstance(message, dict) else message
+        if isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'image_url':
+                    images += 1
+                else:
+                    characters += len(part.get('text') or '')
+        else:
+            characters += len(content if isinstance(content, str) else json.dumps(content, default=str))
+    return characters // 4 + 1000 * images + max_tokens
+
+
+class _Bucket:
+    """Per-minute budget refilled continuously; 0 means not limited (yet)."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        if not self.capacity:
+            return 0.0
+        # A call larger than the whole budget waits for a full bucket rather than forever
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+    def set_capacity(self, per_minute: float):
+        if not self.capacity:
+            self.level = per_minute
+        self.capacity = per_minute
+
+
+class _ModelState:
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = _Bucket(rpm)
+        self.tokens = _Bucket(tpm)
+        self.paused_until = 0.0
+        self.throttles = 0
+        # (priority, arrival) of the calls waiting, best first
+        self.waiting = []
+
+
+class Reservation:
+    def __init__(self, model: str, tokens: int, priority: int):
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+
+
+class OpenAIRateLimiter:
+    """Request and token budgets per model; usable from the event loop and from threads."""
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[float, float]]] = None, share: int = OPENAI_LIMIT_PROCESSES):
+        self.share = share
+        self._limits = limits or {}
+        self._models: Dict[str, _ModelState] = {}
+        self._lock = threading.Lock()
+        self._arrivals = itertools.count()
+
+    def _state(self, model: str) -> _ModelState:
+        state = self._models.get(model)
+        if state is None:
+            rpm, tpm = self._limits.get(model, (0, 0))
+            state = self._models[model] = _ModelState(rpm / self.share, tpm / self.share)
+        return state
+
+    def _waits(self, model: str, tokens: int, priority: int):
+        """Yield how long to sleep until the call may go; return once its budget is reserved."""
+        start = time.monotonic()
+        max_wait = remaining(MAX_WAIT[priority])
+        ticket = (priority, next(self._arrivals))
+        with self._lock:
+            state = self._state(model)
+            heapq.heappush(state.waiting, ticket)
+        limit_waiting.inc(model=model)
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    state.requests.refill(now)
+                    state.tokens.refill(now)
+                    if state.waiting[0] != ticket:
+                        delay = POLL_INTERVAL
+                    else:
+                        delay = max(state.paused_until - now, state.requests.wait_for(1),
+                                    state.tokens.wait_for(tokens))
+                        if delay <= 0:
+                            heapq.heappop(state.waiting)
+                            state.requests.level -= 1
+                            state.tokens.level -= tokens
+                            break
+                waited = now - start
+                # At the head of the line the delay is known: fail now rather than after waiting in vain
+                if waited + delay > max_wait:
+                    limit_timeouts.inc(model=model, priority=PRIORITY_NAMES[priority])
+                    raise RateLimitTimeout(f"no {model} rate limit budget after {waited:.1f} s")
+                yield min(delay, 1.0)
+        finally:
+            limit_waiting.dec(model=model)
+            with self._lock:
+                if ticket in state.waiting:
+                    state.waiting.remove(ticket)
+                    heapq.heapify(state.waiting)
+        waited = time.monotonic() - start
+        limit_wait_seconds.observe(waited, model=model, priority=PRIORITY_NAMES[priority])
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f} s for {model} rate limit budget ({PRIORITY_NAMES[priority]})")
+
+    async def acquire(self, model: str, tokens: int, priority: Optional[int] = None) -> Reservation:
+        priority = _priority.get() if priority is None else priority
+        waits = self._waits(model, tokens, priority)
+        try:
+            for delay in waits:
+                await asyncio.sleep(delay)
+        finally:
+            waits.close()
+        return Reservation(model, tokens, priority)
+
+    def acquire_blocking(self, model: str, tokens: int, priority: Optional[int] = None) -> Reservation:
+        priority = _priority.get() if priority is None else priority
+        for delay in self._waits(model, tokens, priority):
+            time.sleep(delay)
+        return Reservation(model, tokens, priority)
+
+    def settle(self, reservation: Reservation, used_tokens: Optional[int] = None, headers=None):
+        """Correct the reservation with the tokens actually used and the response's rate limit headers."""
+        with self._lock:
+            state = self._state(reservation.model)
+            if used_tokens is not None:
+                state.tokens.level += reservation.tokens - used_tokens
+            state.throttles = 0
+            if headers:
+                self._apply_headers(state, headers)
+
+    def throttled(self, reservation: Reservation, headers=None) -> float:
+        """Record a 429: empty the budget and pause the model; return the pause in seconds."""
+        rate_limited.inc(model=reservation.model)
+        with self._lock:
+            state = self._state(reservation.model)
+            state.throttles += 1
+            pause = None
+            if headers:
+                self._apply_headers(state, headers)
+                retry_after = headers.get('retry-after-ms')
+                pause = float(retry_after) / 1000 if retry_after else None
+                if pause is None and headers.get('retry-after'):
+                    try:
+                        pause = float(headers.get('retry-after'))
+                    except ValueError:
+                        pause = None
+            if pause is None:
+                pause = min(30.0, 2 ** (state.throttles - 1))
+            state.requests.level = min(state.requests.level, 0)
+            state.paused_until = max(state.paused_until, time.monotonic() + pause)
+        logger.info(f"OpenAI rate limited {reservation.model}; pausing it for {pause:.1f} s")
+        return pause
+
+    def _apply_headers(self, state: _ModelState, headers):
+        for bucket, kind in ((state.requests, 'requests'), (state.tokens, 'tokens')):
+            limit = headers.get(f'x-ratelimit-limit-{kind}')
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            try:
+                if limit:
+                    bucket.set_capacity(float(limit) / self.share)
+                if remaining is not None and bucket.capacity:
+                    bucket.level = min(bucket.level, float(remaining) / self.share)
+            except ValueError:
+                continue
+            if remaining is not None and remaining.strip() == '0':
+                reset = _parse_duration(headers.get(f'x-ratelimit-reset-{kind}', ''))
+                if reset:
+                    state.paused_until = max(state.paused_until, time.monotonic() + reset)
+
+
+openai_limiter = OpenAIRateLimiter(_parse_limits(OPENAI_RATE_LIMITS))
+
+
+def _unwrap(result):
+    """(response, headers) from an OpenAI raw response, a litellm response or a plain response."""
+    if hasattr(result, 'parse') and hasattr(result, 'headers'):
+        return result.parse(), result.headers
+    hidden = getattr(result, '_hidden_params', None) or {}
+    headers = hidden.get('additional_headers') or getattr(result, '_response_headers', None)
+    if headers:
+        # litellm prefixes the provider's headers with "llm_provider-"
+        headers = {key.replace('llm_provider-', ''): value for key, value in dict(headers).items()}
+    return result, headers
+
+
+def _used_tokens(response) -> Optional[int]:
+    usage = getattr(response, 'usage', None)
+    total = getattr(usage, 'total_tokens', None) if usage is not None else None
+    return int(total) if total else None
+
+
+def _rate_limit_headers(error: Exception):
+    """Headers of a 429 error from the OpenAI SDK or litellm, None for any other error."""
+    if getattr(error, 'status_code', None) != 429:
+        return None
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'litellm_response_headers', None)
+    return dict(headers) if headers else {}
+
+
+def _bound_by_deadline(kwargs: dict):
+    """Send the call with the message's remaining budget as its timeout (unchanged outside a request)."""
+    timeout = remaining(kwargs.get('timeout'))
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+
+
+def call_openai(model: str, tokens: int, fn, /, *args, priority: Optional[int] = None, **kwargs):
+    """Run the blocking call fn(*args, **kwargs) within `model`'s budget, retrying 429s.
+
+    `model`, `tokens` and `fn` are positional-only, so fn's own `model=` passes through.
+    fn may return a raw response (`client.….with_raw_response.create`) so the rate
+    limit headers are read; the parsed response is returned.
+    """
+    if not OPENAI_LIMITER:
+        _bound_by_deadline(kwargs)
+        return _unwrap(fn(*args, **kwargs))[0]
+    for attempt in range(OPENAI_LIMIT_RETRIES + 1):
+        reservation = openai_limiter.acquire_blocking(model, tokens, priority)
+        _bound_by_deadline(kwargs)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            headers = _rate_limit_headers(e)
+            if headers is None:
+                openai_limiter.settle(reservation, used_tokens=0)
+                record_miss('openai')
+                raise
+            openai_limiter.throttled(reservation, headers)
+            if attempt == OPENAI_LIMIT_RETRIES:
+                raise
+            continue
+        response, headers = _unwrap(result)
+        openai_limiter.settle(reservation, _used_tokens(response), headers)
+        return response
+
+
+async def acall_openai(model: str, tokens: int, fn, /, *args, priority: Optional[int] = None, **kwargs):
+    """Async call_openai: awaits fn(*args, **kwargs)."""
+    if not OPENAI_LIMITER:
+        _bound_by_deadline(kwargs)
+        return _unwrap(await fn(*args, **kwargs))[0]
+    for attempt in range(OPENAI_LIMIT_RETRIES + 1):
+        reservation = await openai_limiter.acquire(model, tokens, priority)
+        _bound_by_deadline(kwargs)
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            headers = _rate_limit_headers(e)
+            if headers is None:
+                openai_limiter.settle(reservation, used_tokens=0)
+                record_miss('openai')
+                raise
+            openai_limiter.throttled(reservation, headers)
+            if attempt == OPENAI_LIMIT_RETRIES:
+                raise
+            continue
+        response, headers = _unwrap(result)
+        openai_limiter.settle(reservation, _used_tokens(response), headers)
+        return response
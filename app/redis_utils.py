@@ -14,18 +14,39 @@ redis_conn = redis.Redis(
     password=REDIS_PASSWORD,
     db=0)
 import json
+import time
+
+from app.cookies_utils import CONTEXT_TTL, get_cookies, set_cookies
+from app.services.records import AnalysisRecord, analysis_from_dict, decode_analysis, encode_analysis
+
+# Products each user scanned, kept long after the latest analysis expires (recall notices, app.services.broadcast)
+SCAN_HISTORY_TTL = int(os.getenv("SCAN_HISTORY_TTL", str(180 * 24 * 3600)))
 
 def store_latest_analysis(phone_no, analysis_result):
-    """Store the latest product analysis for a user"""
+    """Store the latest product analysis for a user, and add the product to the user's scans"""
     redis_key = f"noura_last_analysis_{phone_no}"
-    redis_conn.set(redis_key, json.dumps(analysis_result), ex=3600)  # Expires in 1 hour
+    if not isinstance(analysis_result, AnalysisRecord):
+        analysis_result = analysis_from_dict(analysis_result)
+    product = analysis_result['product']
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.set(redis_key, encode_analysis(analysis_result), ex=3600)  # Expires in 1 hour
+    if product.get('code'):
+        scans_key = f"noura_scanned_{phone_no}"
+        pipe.hset(scans_key, product['code'], json.dumps({'name': product.get('name', ''),
+                                                          'brand': product.get('brand', ''),
+                                                          'at': int(time.time())}, ensure_ascii=False))
+        pipe.expire(scans_key, SCAN_HISTORY_TTL)
+    pipe.execute()
 
 def get_latest_analysis(phone_no):
     """Retrieve the latest product analysis for a user"""
     redis_key = f"noura_last_analysis_{phone_no}"
     data = redis_conn.get(redis_key)
     if data:
-        return json.loads(data)
+        # Entries written before the binary encoding are JSON objects
+        if data[:1] == b'{':
+            return analysis_from_dict(json.loads(data))
+        return decode_analysis(data)
     return None
 from datetime import datetime
 
@@ -37,12 +58,9 @@ def save_conversation_context(phone_no, user_input, bot_response):
         "last_bot_output": bot_response,
         "timestamp": datetime.utcnow().isoformat()
     }
-    redis_conn.set(context_key, json.dumps(payload), ex=1800)  # Expira en 30 min
+    set_cookies(redis_conn, context_key, payload, ttl=CONTEXT_TTL)  # Expira en 30 min sin actividad
 
 def get_conversation_context(phone_no):
     """Recupera el contexto anterior si existe"""
     context_key = f"noura_context_{phone_no}"
-    data = redis_conn.get(context_key)
-    if data:
-        return json.loads(data)
-    return {}
+    return get_cookies(redis_conn, context_key, ttl=CONTEXT_TTL) or {}
@@ -0,0 +1,204 @@
+import bisect
+import json
+import logging
+import os
+import sys
+from typing import Dict, List, Optional
+
+from app.services.product_analyzer import product_analyzer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Precomputed index built with `python -m app.services.alternatives build <catalog.jsonl> <index.json>`
+ALTERNATIVES_INDEX_PATH = os.getenv("ALTERNATIVES_INDEX_PATH", "")
+ALTERNATIVES_TOP_K = int(os.getenv("ALTERNATIVES_TOP_K", "3"))
+# How many of the most specific category tags to search before giving up
+ALTERNATIVES_CATEGORY_DEPTH = int(os.getenv("ALTERNATIVES_CATEGORY_DEPTH", "2"))
+
+ALTERNATIVES_TRIGGERS = {'alternativas', 'alternativa', 'alternatives', 'alternative', 'opciones', 'mejores opciones'}
+
+# Pseudo-countries: every product, and products without country information
+ALL_COUNTRIES = '*'
+NO_COUNTRY = '-'
+
+# Country codes stored by UserContext mapped to Open Food Facts country tags
+COUNTRY_TAGS = {
+    'AR': 'en:argentina', 'BR': 'en:brazil', 'CL': 'en:chile', 'CO': 'en:colombia',
+    'ES': 'en:spain', 'FR': 'en:france', 'MX': 'en:mexico', 'PE': 'en:peru',
+    'US': 'en:united-states',
+}
+
+
+def is_alternatives_request(query: str) -> bool:
+    return query.strip().lower().strip('¿?¡!.') in ALTERNATIVES_TRIGGERS
+
+
+class AlternativesIndex:
+    """Products grouped by (OFF category, country) and ranked by NOURA overall score.
+
+    Each bucket keeps entries sorted best-first together with a parallel list of
+    negated scores, so finding everything that beats a given score is a bisect.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[tuple, list] = {}
+        self._keys: Dict[tuple, list] = {}
+        self._codes = set()
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def add(self, product: Dict, overall: int):
+        code = product.get('code')
+        if not code or code in self._codes or not product.get('categories'):
+            return
+        self._codes.add(code)
+
+        entry = {
+            'code': code,
+            'name': product.get('name', ''),
+            'brand': product.get('brand', ''),
+            'overall': overall,
+            'nutriscore': product.get('nutriscore', 'unknown'),
+            'ecoscore': product.get('ecoscore', 'unknown'),
+        }
+        countries = [ALL_COUNTRIES, *(product.get('countries') or [NO_COUNTRY])]
+        for category in product['categories']:
+            for country in countries:
+                bucket_key = (category, country)
+                keys = self._keys.setdefault(bucket_key, [])
+                position = bisect.bisect_right(keys, -overall)
+                keys.insert(position, -overall)
+                self._buckets.setdefault(bucket_key, []).insert(position, entry)
+
+    def better_than(self, product: Dict, overall: int, country: Optional[str] = None,
+                    k: int = ALTERNATIVES_TOP_K) -> List[Dict]:
+        """Top-k products scoring above `overall`, most specific category first.
+
+        Searches the user's country plus products with no country information (every
+        product when the country is unknown), walking from
+        the most specific category tag towards broader ones (up to
+        ALTERNATIVES_CATEGORY_DEPTH tags) until k are found.
+        """
+        countries = [country, NO_COUNTRY] if country else [ALL_COUNTRIES]
+        seen = {product.get('code')}
+        results = []
+        categories = (product.get('categories') or [])[-ALTERNATIVES_CATEGORY_DEPTH:]
+        for category in reversed(categories):
+            candidates = []
+            for bucket_country in countries:
+                bucket_key = (category, bucket_country)
+                keys = self._keys.get(bucket_key)
+                if not keys:
+                    continue
+                # Entries before this position have a strictly higher score; at most
+                # len(seen) of them can be skipped, so the rest of the bucket is never needed
+                end = min(bisect.bisect_left(keys, -overall), k + len(seen))
+                candidates.extend(self._buckets[bucket_key][:end])
+            for entry in sorted(candidates, key=lambda e: -e['overall']):
+                if entry['code'] not in seen:
+                    seen.add(entry['code'])
+                    results.append(entry)
+                    if len(results) == k:
+                        return results
+        return results
+
+    def save(self, path: str):
+        entries = {}
+        for bucket_key, bucket in self._buckets.items():
+            for entry in bucket:
+                stored = entries.setdefault(entry['code'], dict(entry, categories=[], countries=[]))
+                if bucket_key[0] not in stored['categories']:
+                    stored['categories'].append(bucket_key[0])
+                if bucket_key[1] not in (ALL_COUNTRIES, NO_COUNTRY) and bucket_key[1] not in stored['countries']:
+                    stored['countries'].append(bucket_key[1])
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(list(entries.values()), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'AlternativesIndex':
+        index = cls()
+        with open(path, encoding='utf-8') as f:
+            for entry in json.load(f):
+                index.add(entry, entry['overall'])
+        return index
+
+    @classmethod
+    def from_catalog(cls, path: str) -> 'AlternativesIndex':
+        """Build from a JSONL export of raw Open Food Facts products."""
+        from app.services.batch_scoring import score_products
+
+        with open(path, encoding='utf-8') as f:
+            products = [product_analyzer._process_off_product(json.loads(line)) for line in f if line.strip()]
+        index = cls()
+        for product, scores in zip(products, score_products(products)):
+            index.add(product, scores['overall'])
+        return index
+
+
+def _load_default_index() -> AlternativesIndex:
+    if ALTERNATIVES_INDEX_PATH and os.path.exists(ALTERNATIVES_INDEX_PATH):
+        try:
+            index = AlternativesIndex.load(ALTERNATIVES_INDEX_PATH)
+            logger.info(f"Loaded {len(index)} products into the alternatives index")
+            return index
+        except Exception as e:
+            logger.error(f"Could not load alternatives index: {e}")
+    return AlternativesIndex()
+
+
+alternatives_index = _load_default_index()
+
+
+def find_alternatives(analysis: Dict, user_location: Optional[Dict] = None,
+                      k: int = ALTERNATIVES_TOP_K) -> List[Dict]:
+    country = COUNTRY_TAGS.get(str((user_location or {}).get('country', '')).upper())
+    return alternatives_index.better_than(analysis['product'], analysis['scores']['overall'], country, k)
+
+
+def record_analysis(analysis: Dict):
+    """Add a product a user just scanned so it can be offered as an alternative later."""
+    if analysis.get('found'):
+        alternatives_index.add(analysis['product'], analysis['scores']['overall'])
+
+
+def format_alternatives(analysis: Dict, alternatives: List[Dict]) -> str:
+    product = analysis['product']
+    overall = analysis['scores']['overall']
+    display_name = f"{product.get('name', '')} de {product['brand']}" if product.get('brand') else product.get('name', '')
+
+    if not alternatives:
+        return f"""NOURA: EVIDENCE-BASED WELLBEING™
+
+No encontré alternativas con mejor puntaje que {display_name} ({overall}/100) en su categoría.
+📸 Envíame otro producto para compararlo."""
+
+    response = f"""NOURA: EVIDENCE-BASED WELLBEING™
+
+🔄 Mejores opciones que {display_name} ({overall}/100):
+"""
+    for entry in alternatives:
+        if entry['overall'] >= 90:
+            sphere_emoji = "🟢"
+        elif entry['overall'] >= 75:
+            sphere_emoji = "🟡"
+        elif entry['overall'] >= 50:
+            sphere_emoji = "🟠"
+        else:
+            sphere_emoji = "🔴"
+        name = f"{entry['name']} de {entry['brand']}" if entry.get('brand') else entry['name']
+        response += f"\n{sphere_emoji} {entry['overall']}/100 {name}"
+        response += f"\n   Nutri-Score: {entry['nutriscore'].upper()} · Eco-Score: {entry['ecoscore'].upper()}"
+
+    response += "\n\n📊 Fuente: Open Food Facts"
+    return response
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'build':
+        print("usage: python -m app.services.alternatives build <catalog.jsonl> <index.json>")
+        sys.exit(1)
+    built = AlternativesIndex.from_catalog(sys.argv[2])
+    built.save(sys.argv[3])
+    print(f"Indexed {len(built)} products into {sys.argv[3]}")
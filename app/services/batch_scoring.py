@@ -0,0 +1,121 @@
+"""Columnar NOURA scoring with NumPy.
+
+`calculate_scores_batch` computes the same sub-scores and overall score as
+`ProductAnalyzer._calculate_scores`, for whole arrays of products at once. Use it
+to rank or re-score a catalog; per-message analysis keeps using the scalar path.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from app.services.product_analyzer import ECO_SCORES, NUTRI_SCORES, SCORE_WEIGHTS
+
+# Grade letters are encoded as small integers; anything else (unknown, not-applicable, '') is 0
+GRADE_CODES = {'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5}
+
+_NUTRI_TABLE = np.array([50] + [NUTRI_SCORES[g] for g in 'abcde'], dtype=np.int16)
+_ECO_TABLE = np.array([50] + [ECO_SCORES[g] for g in 'abcde'], dtype=np.int16)
+
+
+def encode_grades(grades: Sequence) -> np.ndarray:
+    """Encode Nutri-Score/Eco-Score letters (any case) as GRADE_CODES integers."""
+    values = np.asarray(grades)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int8)
+    values = values.astype(str)
+    codes = np.zeros(values.shape, dtype=np.int8)
+    for grade, code in GRADE_CODES.items():
+        codes[(values == grade) | (values == grade.upper())] = code
+    return codes
+
+
+def calculate_scores_batch(nutriscore: Sequence, ecoscore: Sequence,
+                           is_organic: Sequence, is_palm_oil_free: Sequence,
+                           is_vegan: Sequence, has_recalls: Optional[Sequence] = None,
+                           is_fair_trade: Optional[Sequence] = None,
+                           brand_ethics_score: Optional[Sequence] = None,
+                           weights: Sequence[float] = SCORE_WEIGHTS) -> Dict[str, np.ndarray]:
+    """Score N products from columnar arrays.
+
+    nutriscore/ecoscore are grade letters or GRADE_CODES integers; the flags are
+    booleans; brand_ethics_score is numeric with NaN for missing. Returns int arrays
+    keyed like the scalar result ('overall', 'health', 'environmental', 'social', 'animal').
+    """
+    nutri_codes = encode_grades(nutriscore)
+    eco_codes = encode_grades(ecoscore)
+    n = len(nutri_codes)
+
+    health = _NUTRI_TABLE[nutri_codes]
+    if has_recalls is not None:
+        health = health - 20 * np.asarray(has_recalls, dtype=bool)
+
+    environmental = (_ECO_TABLE[eco_codes]
+                     + 10 * np.asarray(is_organic, dtype=bool)
+                     - 15 * ~np.asarray(is_palm_oil_free, dtype=bool))
+
+    social = np.full(n, 50, dtype=np.int16)
+    if is_fair_trade is not None:
+        social = social + 10 * np.asarray(is_fair_trade, dtype=bool)
+    if brand_ethics_score is not None:
+        ethics = np.asarray(brand_ethics_score, dtype=np.float64)
+        # int() truncates toward zero; missing (NaN) and 0 leave the social score as is
+        present = np.isfinite(ethics) & (ethics != 0)
+        social = np.where(present, np.maximum(social, np.trunc(np.where(present, ethics, 0))), social)
+
+    animal = 50 + np.where(np.asarray(is_vegan, dtype=bool), 20, -20)
+
+    health = np.clip(health, 0, 100).astype(np.int64)
+    environmental = np.clip(environmental, 0, 100).astype(np.int64)
+    social = np.clip(social, 0, 100).astype(np.int64)
+    animal = np.clip(animal, 0, 100).astype(np.int64)
+
+    # Same operation order as the scalar path so float results are bit-identical;
+    # np.rint rounds half to even like round()
+    health_weight, environmental_weight, social_weight, animal_weight = weights
+    overall = np.rint(
+        health_weight * health +
+        environmental_weight * environmental +
+        social_weight * social +
+        animal_weight * animal
+    ).astype(np.int64)
+
+    return {
+        'overall': overall,
+        'health': health,
+        'environmental': environmental,
+        'social': social,
+        'animal': animal,
+    }
+
+
+def _ethics_value(value) -> float:
+    if not value:
+        return np.nan
+    try:
+        return float(int(value))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def score_products(products: List[Dict], fda_results: Optional[Iterable[Optional[Dict]]] = None,
+                   weights: Sequence[float] = SCORE_WEIGHTS) -> List[Dict]:
+    """Batch-score processed product dicts (as returned by `_process_off_product`).
+
+    Returns one scalar-style scores dict per product.
+    """
+    if not products:
+        return []
+    fda_results = list(fda_results) if fda_results is not None else [None] * len(products)
+    scores = calculate_scores_batch(
+        nutriscore=[(p.get('nutriscore') or '') for p in products],
+        ecoscore=[(p.get('ecoscore') or '') for p in products],
+        is_organic=[bool(p.get('is_organic')) for p in products],
+        is_palm_oil_free=[bool(p.get('is_palm_oil_free')) for p in products],
+        is_vegan=[bool(p.get('is_vegan')) for p in products],
+        has_recalls=[bool(f and f.get('has_recalls')) for f in fda_results],
+        is_fair_trade=[bool(p.get('is_fair_trade')) for p in products],
+        brand_ethics_score=[_ethics_value(p.get('brand_ethics_score')) for p in products],
+        weights=weights,
+    )
+    columns = {key: values.tolist() for key, values in scores.items()}
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
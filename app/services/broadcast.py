@@ -0,0 +1,368 @@
+"""Bulk WhatsApp notifications (product recalls, campaigns) to users found in Redis.
+
+    python -m app.services.broadcast recall-2026-10 --audience recall --codes 7501055300075 \\
+        --reason "Puede contener trozos de plástico."
+    python -m app.services.broadcast promo-oct --audience users --country Colombia --template "..."
+    python -m app.services.broadcast recall-2026-10 --status
+
+Recipients are streamed from Redis with SCAN, in batches of BROADCAST_BATCH:
+- `recall` reads the products each user scanned (noura_scanned_<phone>, written by
+  store_latest_analysis). It keeps users who scanned one of --codes, or a product
+  whose brand and name contain every word of --match.
+- `users` takes everyone with a conversation history, optionally only those in
+  --country, given by name (Colombia, méxico) or ISO code (CO).
+
+Each batch is rendered and sent through a pool of async Twilio requests, at most
+BROADCAST_RATE messages per second so a sender's throughput limit is not exceeded.
+A 429 pauses the whole pool before the message is retried. Other 4xx errors (an
+invalid number, a user outside the 24-hour window) fail the recipient for good.
+5xx and network errors that persist after BROADCAST_RETRIES tries defer the
+recipient: the recipient is sent again at the end and on the next run.
+
+Progress is checkpointed in Redis under the broadcast id. Each recipient's outcome is
+stored as soon as Twilio answers, and the SCAN cursor is saved after each batch.
+Running the same command again resumes from the cursor and skips the numbers
+already done. A message is sent twice only if the process dies between
+Twilio accepting it and it being recorded. The checkpoint holds the counts: sent
+(accepted by Twilio; delivery receipts are not tracked), failed (by Twilio error
+code) and deferred.
+
+Outside the 24-hour session window WhatsApp only delivers approved templates. Pass
+--content-sid (and --content-variables) to send a Twilio Content template instead
+of a free-form body.
+
+Set TWILIO_API_BASE_URL to run against the stand-in (benchmarks/bench_broadcast.py).
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import aiohttp
+from dotenv import load_dotenv
+
+from app.cookies_utils import decode_cookie
+from app.redis_utils import redis_conn
+from app.services.bulk_scoring import TokenBucket
+from app.services.intent_router import LOCATIONS
+from app.services.product_search import fold
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+load_dotenv()
+
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
+TWILIO_API_BASE_URL = os.getenv("TWILIO_API_BASE_URL", "")
+
+# Messages per second; keep it under the sender's Twilio/WhatsApp throughput
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+# Keys examined by each SCAN call, and recipients gathered (over as many calls as needed) per batch
+BROADCAST_SCAN_COUNT = int(os.getenv("BROADCAST_SCAN_COUNT", "1000"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_RETRIES = int(os.getenv("BROADCAST_RETRIES", "3"))
+BROADCAST_TIMEOUT = float(os.getenv("BROADCAST_TIMEOUT", "15"))
+# How long the checkpoint (counts, numbers done) of a broadcast is kept
+BROADCAST_TTL = int(os.getenv("BROADCAST_TTL", str(30 * 24 * 3600)))
+
+RECALL_TEMPLATE = """NOURA: EVIDENCE-BASED WELLBEING™
+
+⚠️ Aviso de retiro: {name} de {brand}, un producto que consultaste, fue retirado del mercado.
+{reason}
+
+Si lo tienes en casa, no lo consumas y sigue las indicaciones del fabricante o del punto de venta."""
+
+
+class Recipient(NamedTuple):
+    phone: str
+    fields: Dict[str, str]
+
+
+class RecallAudience:
+    """Users who scanned a recalled product."""
+
+    pattern = 'noura_scanned_*'
+
+    def __init__(self, codes: List[str], match: str = '', reason: str = ''):
+        self.codes = set(codes)
+        self.words = fold(match).split()
+        self.reason = reason
+
+    def _matches(self, code: str, product: Dict) -> bool:
+        if code in self.codes:
+            return True
+        if not self.words:
+            return False
+        words = set(fold(f"{product.get('brand', '')} {product.get('name', '')}").split())
+        return all(word in words for word in self.words)
+
+    def recipients(self, redis_client, keys: List[bytes]) -> List[Recipient]:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        recipients = []
+        for key, scans in zip(keys, pipe.execute()):
+            for code, value in scans.items():
+                code = code.decode()
+                product = json.loads(value)
+                if self._matches(code, product):
+                    recipients.append(Recipient(key.decode()[len('noura_scanned_'):], {
+                        'name': product.get('name') or code, 'brand': product.get('brand') or '', 'code': code,
+                        'reason': self.reason}))
+                    break
+        return recipients
+
+
+def country_code(country: str) -> str:
+    """ISO code as stored in user_location_<phone>: "Colombia", "méxico" or "co" → "CO"."""
+    folded = fold(country)
+    for name, location in LOCATIONS.items():
+        if fold(name) == folded:
+            return location['country']
+    return country.strip().upper()
+
+
+class UserAudience:
+    """Everyone with a conversation history, optionally only in one country (name or ISO code)."""
+
+    pattern = 'whatsapp_twilio_demo_*_history'
+
+    def __init__(self, country: str = ''):
+        self.country = country_code(country) if country else ''
+
+    def recipients(self, redis_client, keys: List[bytes]) -> List[Recipient]:
+        phones = [key.decode()[len('whatsapp_twilio_demo_'):-len('_history')] for key in keys]
+        pipe = redis_client.pipeline(transaction=False)
+        for phone in phones:
+            pipe.get(f'user_location_{phone}')
+        recipients = []
+        for phone, data in zip(phones, pipe.execute()):
+            location = decode_cookie(data) if data else {}
+            country = location.get('country', '')
+            if self.country and str(country).upper() != self.country:
+                continue
+            recipients.append(Recipient(phone, {'country': country, 'city': location.get('city', '')}))
+        return recipients
+
+
+class Broadcast:
+    """One broadcast, resumable by id; see the module docstring."""
+
+    def __init__(self, broadcast_id: str, audience, template: str = '', content_sid: str = '',
+                 content_variables: Optional[Dict[str, str]] = None, rate: float = BROADCAST_RATE,
+                 concurrency: int = BROADCAST_CONCURRENCY, scan_count: int = BROADCAST_SCAN_COUNT,
+                 batch_size: int = BROADCAST_BATCH, redis_client=redis_conn):
+        self.broadcast_id = broadcast_id
+        self.audience = audience
+        self.template = template
+        self.content_sid = content_sid
+        self.content_variables = content_variables or {}
+        self.rate = rate
+        self.concurrency = concurrency
+        self.scan_count = scan_count
+        self.batch_size = batch_size
+        self.redis = redis_client
+        self.state_key = f"noura_broadcast_{broadcast_id}"
+        self.outcomes_key = f"noura_broadcast_{broadcast_id}_outcomes"
+        self.deferred_key = f"noura_broadcast_{broadcast_id}_deferred"
+        self._paused_until = 0.0
+
+    def render(self, recipient: Recipient) -> Dict:
+        """Twilio message parameters for `recipient`."""
+        params = {'to': f"whatsapp:+{recipient.phone}", 'from_': f"whatsapp:{TWILIO_WHATSAPP_NUMBER}"}
+        if self.content_sid:
+            params['content_sid'] = self.content_sid
+            params['content_variables'] = json.dumps(
+                {key: value.format(**recipient.fields) for key, value in self.content_variables.items()},
+                ensure_ascii=False)
+        else:
+            params['body'] = self.template.format(**recipient.fields)
+        return params
+
+    def status(self) -> Dict[str, str]:
+        """The checkpoint: status, cursor and times, plus the count of each outcome."""
+        state = {k.decode(): v.decode() for k, v in self.redis.hgetall(self.state_key).items()}
+        outcomes = collections.Counter(result.decode() for _, result in
+                                       self.redis.hscan_iter(self.outcomes_key, count=1000))
+        state.update({result: str(count) for result, count in outcomes.items()})
+        state['failed'] = str(sum(count for result, count in outcomes.items() if result.startswith('failed')))
+        return state
+
+    def _record(self, phone: str, result: str, fields: Dict, retrying: bool):
+        """Checkpoint one recipient's outcome: sent, failed for good, or deferred to a later pass."""
+        if result == 'deferred' and not retrying:
+            self.redis.hset(self.deferred_key, phone, json.dumps(fields, ensure_ascii=False))
+        elif result != 'deferred' and retrying:
+            self.redis.hdel(self.deferred_key, phone)
+        # One command per message: the outcome marks the number done and is what the counts are made of
+        self.redis.hset(self.outcomes_key, phone, result)
+
+    def _pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _send(self, client, recipient: Recipient, bucket: TokenBucket, slots: asyncio.Semaphore,
+                    retrying: bool = False) -> str:
+        from twilio.base.exceptions import TwilioRestException
+
+        params = self.render(recipient)
+        result = 'deferred'
+        async with slots:
+            for attempt in range(BROADCAST_RETRIES + 1):
+                while self._paused_until > time.monotonic():
+                    await asyncio.sleep(self._paused_until - time.monotonic())
+                await bucket.acquire()
+                try:
+                    await client.messages.create_async(**params)
+                    result = 'sent'
+                    break
+                except TwilioRestException as e:
+                    if e.status == 429:
+                        # Over the sender's throughput: everyone backs off, not just this message
+                        self._pause(min(30.0, 2 ** attempt))
+                    elif e.status < 500:
+                        result = f"failed_{e.code or e.status}"
+                        logger.info(f"Broadcast {self.broadcast_id}: {recipient.phone} failed ({e.code}: {e.msg})")
+                        break
+                    else:
+                        await asyncio.sleep(min(30.0, 2 ** attempt))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.error(f"Broadcast {self.broadcast_id}: network error sending to {recipient.phone}: {e}")
+                    await asyncio.sleep(min(30.0, 2 ** attempt))
+        self._record(recipient.phone, result, recipient.fields, retrying)
+        return result
+
+    async def _send_batch(self, client, recipients: List[Recipient], bucket: TokenBucket,
+                          slots: asyncio.Semaphore, retrying: bool = False):
+        # SCAN may return a key twice, and a number may already be done by an earlier run
+        unique = list({recipient.phone: recipient for recipient in recipients}.values())
+        if not unique:
+            return
+        outcomes = self.redis.hmget(self.outcomes_key, [recipient.phone for recipient in unique])
+        pending = [recipient for recipient, outcome in zip(unique, outcomes) if outcome in (None, b'deferred')]
+        if len(pending) < len(unique):
+            self.redis.hincrby(self.state_key, 'skipped', len(unique) - len(pending))
+        await asyncio.gather(*(self._send(client, recipient, bucket, slots, retrying) for recipient in pending))
+
+    async def run(self, client) -> Dict[str, str]:
+        """Send to every recipient not done yet, resuming from the checkpoint; return the counts."""
+        state = self.status()
+        if state.get('status') == 'finished' and not self.redis.hlen(self.deferred_key):
+            return state
+        # No bursts: the sender's throughput is enforced per second, a burst on top of the rate is a 429
+        bucket = TokenBucket(self.rate, capacity=1)
+        slots = asyncio.Semaphore(self.concurrency)
+        cursor = int(state.get('cursor', 0))
+        if state.get('status') != 'finished':
+            self.redis.hset(self.state_key, mapping={'status': 'running', 'cursor': cursor})
+            self.redis.hsetnx(self.state_key, 'started_at', int(time.time()))
+            for key in (self.state_key, self.outcomes_key, self.deferred_key):
+                self.redis.expire(key, BROADCAST_TTL)
+            while True:
+                # A SCAN call returns only the matching keys among those it examined, often a handful
+                recipients = []
+                while len(recipients) < self.batch_size:
+                    cursor, keys = self.redis.scan(cursor, match=self.audience.pattern, count=self.scan_count)
+                    recipients += self.audience.recipients(self.redis, keys)
+                    if cursor == 0:
+                        break
+                await self._send_batch(client, recipients, bucket, slots)
+                # Only past this batch once all of it has an outcome
+                self.redis.hset(self.state_key, 'cursor', cursor)
+                if cursor == 0:
+                    break
+        # One more try for the recipients deferred by 5xx or network errors
+        deferred = [Recipient(phone.decode(), json.loads(fields))
+                    for phone, fields in self.redis.hgetall(self.deferred_key).items()]
+        await self._send_batch(client, deferred, bucket, slots, retrying=True)
+        self.redis.hset(self.state_key, mapping={'status': 'finished', 'finished_at': int(time.time())})
+        return self.status()
+
+
+def twilio_client(account_sid: str = TWILIO_ACCOUNT_SID, auth_token: str = TWILIO_AUTH_TOKEN,
+                  base_url: str = TWILIO_API_BASE_URL):
+    """(Twilio client, its async HTTP client); close the latter when done. Call from the event loop."""
+    from twilio.http.async_http_client import AsyncTwilioHttpClient
+    from twilio.rest import Client
+
+    http_client = AsyncTwilioHttpClient(timeout=BROADCAST_TIMEOUT)
+    client = Client(account_sid, auth_token, http_client=http_client)
+    if base_url:
+        client.api.base_url = base_url
+    return client, http_client
+
+
+async def run_broadcast(broadcast: Broadcast, **client_options) -> Dict[str, str]:
+    """Run `broadcast` with its own Twilio client (see twilio_client for the options)."""
+    client, http_client = twilio_client(**client_options)
+    try:
+        return await broadcast.run(client)
+    finally:
+        await http_client.close()
+
+
+def summary(state: Dict[str, str]) -> str:
+    sent, failed = int(state.get('sent', 0)), int(state.get('failed', 0))
+    codes = ', '.join(f"{key[len('failed_'):]}: {value}" for key, value in sorted(state.items())
+                      if key.startswith('failed_'))
+    elapsed = int(state.get('finished_at', time.time())) - int(state.get('started_at', time.time()))
+    return (f"{state.get('status', 'not started')}: sent {sent}, failed {failed}" + (f" ({codes})" if codes else '')
+            + f", deferred {state.get('deferred', 0)}, skipped as already done {state.get('skipped', 0)}"
+            + (f"; {sent / elapsed:.1f} msg/s over {elapsed} s" if elapsed > 0 else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("broadcast_id", help="name of the broadcast; the same id resumes it")
+    parser.add_argument("--audience", choices=('recall', 'users'), default='recall')
+    parser.add_argument("--codes", default='', help="recall: comma-separated barcodes")
+    parser.add_argument("--match", default='', help="recall: words that the brand and name must all contain")
+    parser.add_argument("--reason", default='', help="recall: sentence added to the default message")
+    parser.add_argument("--country", default='', help="users: only users in this country, by name or ISO code")
+    parser.add_argument("--template", help="message body; fields {name} {brand} {code} {reason} or {country} {city}")
+    parser.add_argument("--content-sid", default='', help="send this approved Twilio Content template instead")
+    parser.add_argument("--content-variables", default='{}', help='JSON, e.g. \'{"1": "{name}"}\'')
+    parser.add_argument("--rate", type=float, default=BROADCAST_RATE, help="messages per second")
+    parser.add_argument("--concurrency", type=int, default=BROADCAST_CONCURRENCY)
+    parser.add_argument("--status", action="store_true", help="print the counts of the broadcast and exit")
+    args = parser.parse_args()
+
+    if args.audience == 'recall':
+        if not args.codes and not args.match:
+            parser.error("--audience recall needs --codes or --match")
+        audience = RecallAudience([code.strip() for code in args.codes.split(',') if code.strip()],
+                                  args.match, args.reason)
+        template = args.template or RECALL_TEMPLATE
+        sample = {'name': '', 'brand': '', 'code': '', 'reason': ''}
+    else:
+        if not args.template and not args.content_sid:
+            parser.error("--audience users needs --template or --content-sid")
+        audience = UserAudience(args.country)
+        template = args.template or ''
+        sample = {'country': '', 'city': ''}
+    broadcast = Broadcast(args.broadcast_id, audience, template, args.content_sid,
+                          json.loads(args.content_variables), args.rate, args.concurrency)
+    if args.status:
+        print(summary(broadcast.status()))
+        return
+    try:
+        broadcast.render(Recipient('0', sample))
+    except (KeyError, IndexError, ValueError) as e:
+        parser.error(f"the template uses a field this audience does not have: {e}")
+
+    state = asyncio.run(run_broadcast(broadcast))
+    print(summary(state))
+    if int(state.get('deferred', 0)):
+        print(f"{state['deferred']} recipients deferred after errors; run the same command again to retry them",
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""Offline bulk scoring of a catalog of barcodes or product names.
+
+    python -m app.services.bulk_scoring skus.csv scores.jsonl --concurrency 16 --rate 10
+
+The input is a CSV with a `barcode`, `code`, `name` or `query` column (otherwise the
+first column is used), or a JSONL file with one of those keys per line. It is
+streamed, never loaded whole. Every result is appended to the output JSONL as soon
+as it is ready, and that file is also the checkpoint: running the same command
+again skips rows that already have a result and retries rows that failed.
+`--parquet` converts the finished JSONL to Parquet (requires pyarrow).
+
+Set OFF_BASE_URL / FDA_BASE_URL to run against local stand-ins.
+"""
+import argparse
+import asyncio
+import csv
+import importlib.util
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import aiohttp
+
+from app.services.product_analyzer import ProductAnalyzer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+# Lookups started per second across all workers (each one is an OFF plus an FDA request)
+BULK_RATE_LIMIT = float(os.getenv("BULK_RATE_LIMIT", "5"))
+# fsync the output every N results so a crash loses at most that many
+BULK_FSYNC_EVERY = int(os.getenv("BULK_FSYNC_EVERY", "100"))
+
+QUERY_FIELDS = ('barcode', 'code', 'ean', 'name', 'query', 'product_name')
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _query_from_row(row: Dict) -> str:
+    for field in QUERY_FIELDS:
+        value = row.get(field)
+        if value not in (None, ''):
+            return str(value).strip()
+    first = next(iter(row.values()), '')
+    return str(first or '').strip()
+
+
+def read_queries(path: str) -> Iterator[Tuple[int, str]]:
+    """Yield (row number, query) pairs from a CSV or JSONL file."""
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.jsonl') or path.endswith('.ndjson'):
+            for row_number, line in enumerate(f):
+                if line.strip():
+                    yield row_number, _query_from_row(json.loads(line))
+        else:
+            for row_number, row in enumerate(csv.DictReader(f)):
+                yield row_number, _query_from_row(row)
+
+
+def load_checkpoint(path: str) -> Set[int]:
+    """Rows that already have a successful result in the output file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash; the row is looked up again
+                continue
+            if 'error' not in record:
+                done.add(record['row'])
+    return done
+
+
+def result_record(row_number: int, query: str, analysis: Dict, seconds: float) -> Dict:
+    record = {'row': row_number, 'query': query, 'found': analysis.get('found', False)}
+    if analysis.get('error'):
+        record['error'] = analysis['error']
+    if analysis.get('found'):
+        product = analysis['product']
+        fda = analysis.get('fda') or {}
+        record.update({
+            'code': product.get('code', ''),
+            'name': product.get('name', ''),
+            'brand': product.get('brand', ''),
+            'nutriscore': product.get('nutriscore', 'unknown'),
+            'ecoscore': product.get('ecoscore', 'unknown'),
+            'has_recalls': bool(fda.get('has_recalls')),
+            **analysis['scores'],
+        })
+    record['seconds'] = round(seconds, 4)
+    return record
+
+
+class BulkStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.skipped = 0
+        self.scored = 0
+        self.not_found = 0
+        self.errors = 0
+        self.latencies = []
+
+    def add(self, record: Dict):
+        self.latencies.append(record['seconds'])
+        if 'error' in record:
+            self.errors += 1
+        elif record['found']:
+            self.scored += 1
+        else:
+            self.not_found += 1
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.started
+        processed = self.scored + self.not_found + self.errors
+        lines = [
+            f"processed {processed} rows in {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.1f} rows/s), "
+            f"skipped {self.skipped} already done",
+            f"scored {self.scored}, not found {self.not_found}, errors {self.errors}",
+        ]
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            lines.append(f"lookup p50 {statistics.median(latencies) * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms")
+        return '\n'.join(lines)
+
+
+async def score_catalog(input_path: str, output_path: str, concurrency: int = BULK_CONCURRENCY,
+                        rate: float = BULK_RATE_LIMIT, analyzer: Optional[ProductAnalyzer] = None) -> BulkStats:
+    """Score every row of `input_path` into `output_path`, resuming from its checkpoint."""
+    done = load_checkpoint(output_path)
+    stats = BulkStats()
+    bucket = TokenBucket(rate)
+    # Bounded so the input is read only as fast as it is scored
+    pending: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+        if analyzer is None:
+            analyzer = ProductAnalyzer(session=session)
+        elif analyzer.session is None:
+            analyzer.session = session
+
+        with open(output_path, 'a', encoding='utf-8') as output:
+            async def worker():
+                while True:
+                    item = await pending.get()
+                    if item is None:
+                        return
+                    row_number, query = item
+                    await bucket.acquire()
+                    start = time.monotonic()
+                    try:
+                        analysis = await analyzer.lookup(query)
+                    except Exception as e:
+                        analysis = {'found': False, 'error': str(e) or type(e).__name__}
+                    record = result_record(row_number, query, analysis, time.monotonic() - start)
+                    output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    output.flush()
+                    stats.add(record)
+                    if len(stats.latencies) % BULK_FSYNC_EVERY == 0:
+                        os.fsync(output.fileno())
+
+            workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+            try:
+                for row_number, query in read_queries(input_path):
+                    if row_number in done or not query:
+                        stats.skipped += row_number in done
+                        continue
+                    await pending.put((row_number, query))
+                for _ in workers:
+                    await pending.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                os.fsync(output.fileno())
+
+    return stats
+
+
+def write_parquet(jsonl_path: str, parquet_path: str):
+    """Convert the results to Parquet, keeping the last result for each row."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet output requires pyarrow (pip install pyarrow)")
+
+    latest = {}
+    with open(jsonl_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            latest[record['row']] = record
+    records = [latest[row] for row in sorted(latest)]
+    # from_pylist would take the columns from the first row only, and that row may be a miss with no scores
+    columns = list(dict.fromkeys(key for record in records for key in record))
+    pq.write_table(pa.Table.from_pydict({key: [record.get(key) for record in records] for key in columns}),
+                   parquet_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="CSV or JSONL of barcodes or product names")
+    parser.add_argument("output", help="JSONL results file (also the resume checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=BULK_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=BULK_RATE_LIMIT, help="lookups per second, 0 for no limit")
+    parser.add_argument("--parquet", help="also write the results to this Parquet file")
+    args = parser.parse_args()
+    if args.parquet and importlib.util.find_spec('pyarrow') is None:
+        parser.error("--parquet requires pyarrow (pip install pyarrow)")
+
+    stats = asyncio.run(score_catalog(args.input, args.output, args.concurrency, args.rate))
+    print(stats.summary())
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
+        print(f"wrote {args.parquet}")
+    if stats.errors:
+        print(f"{stats.errors} rows failed; run the same command again to retry them", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Classifies each incoming message once, before any network or Redis call.
+
+`route_message` only looks at the text and in-memory tables, so greetings,
+locations, follow-ups and out-of-scope messages can be answered without
+touching Open Food Facts, the FDA or OpenAI. main.py dispatches each route
+to its own handler.
+"""
+import re
+from typing import Dict, NamedTuple, Optional
+
+from app.metrics_utils import Counter, Histogram
+from app.services.alternatives import is_alternatives_request
+from app.services.product_analyzer import product_analyzer
+
+GREETING = 'greeting'
+LOCATION = 'location'
+FOLLOW_UP = 'follow_up'
+BARCODE = 'barcode'
+PRODUCT = 'product'
+OUT_OF_SCOPE = 'out_of_scope'
+IMAGE = 'image'
+CHAT = 'chat'
+
+WHY_TRIGGERS = {'por qué', 'porque', 'explica', 'why'}
+
+# Free text up to this many words is tried as a product name first
+PRODUCT_MAX_WORDS = 6
+QUESTION_WORDS = re.compile(r'^(¿|cómo|como|qué|que|por qué|cuál|cual|cuándo|dónde|quién|how|what|why|when|where|who)\b')
+BARCODE_PATTERN = re.compile(r'^\d{8,14}$')
+
+# Country names users answer the greeting with, mapped to the stored location
+LOCATIONS = {
+    "colombia": {"country": "CO", "city": "Bogotá"},
+    "méxico": {"country": "MX", "city": "Ciudad de México"},
+    "mexico": {"country": "MX", "city": "Ciudad de México"},
+    "españa": {"country": "ES", "city": "Madrid"},
+    "spain": {"country": "ES", "city": "Madrid"},
+    "argentina": {"country": "AR", "city": "Buenos Aires"},
+    "chile": {"country": "CL", "city": "Santiago"},
+    "perú": {"country": "PE", "city": "Lima"},
+    "peru": {"country": "PE", "city": "Lima"},
+    "brasil": {"country": "BR", "city": "São Paulo"},
+    "brazil": {"country": "BR", "city": "São Paulo"},
+    "france": {"country": "FR", "city": "Paris"},
+    "francia": {"country": "FR", "city": "Paris"},
+    "usa": {"country": "US", "city": "New York"},
+    "estados unidos": {"country": "US", "city": "New York"},
+    "united states": {"country": "US", "city": "New York"},
+}
+
+route_messages = Counter('noura_route_messages_total', 'Messages handled, by route')
+route_seconds = Histogram('noura_route_seconds', 'Time spent in each route handler')
+
+
+class Intent(NamedTuple):
+    route: str
+    query: str
+    # Stored location the message mentions (any route), e.g. {"country": "CO", "city": "Bogotá"}
+    location: Optional[Dict] = None
+    # Country the location route was detected from (name and flag)
+    country_info: Optional[Dict] = None
+    # 'why' or 'alternatives' for follow-ups
+    follow_up: Optional[str] = None
+
+
+def detect_location(message: str) -> Optional[Dict]:
+    """Stored-location dict for a country named in the message, if any."""
+    message_lower = message.lower()
+    for country_name, location_data in LOCATIONS.items():
+        # Whole words only: "usa" must not match "usado"
+        if re.search(rf'\b{re.escape(country_name)}\b', message_lower):
+            return location_data
+    return None
+
+
+def route_message(query: str, has_images: bool = False) -> Intent:
+    text = query.strip()
+    lowered = text.lower()
+    location = detect_location(text)
+
+    if has_images:
+        return Intent(IMAGE, text, location)
+    if lowered in WHY_TRIGGERS:
+        return Intent(FOLLOW_UP, text, follow_up='why')
+    if is_alternatives_request(text):
+        return Intent(FOLLOW_UP, text, follow_up='alternatives')
+    if product_analyzer.is_greeting(lowered):
+        return Intent(GREETING, text, location)
+    if BARCODE_PATTERN.match(re.sub(r'[\s-]', '', lowered)):
+        return Intent(BARCODE, re.sub(r'[\s-]', '', lowered), location)
+
+    mentions_product = product_analyzer.mentions_product(lowered)
+    country_info = product_analyzer.detect_country(lowered)
+    if country_info and not mentions_product:
+        # Only countries we can store are confirmed locally; the assistant answers the rest
+        return Intent(LOCATION if location else CHAT, text, location, country_info)
+    if product_analyzer.is_out_of_scope(lowered):
+        return Intent(OUT_OF_SCOPE, text, location)
+    if mentions_product or (len(lowered.split()) <= PRODUCT_MAX_WORDS and not QUESTION_WORDS.match(lowered)):
+        return Intent(PRODUCT, text, location)
+    return Intent(CHAT, text, location)
@@ -1,19 +1,95 @@
 import aiohttp
 import asyncio
+from contextlib import asynccontextmanager
 from typing import Dict, Optional
 import logging
+import os
 import re
 
+from app.deadline_utils import DEADLINE_RECALLS_MIN, has_time, record_miss, remaining
+from app.services.product_search import learn_product, resolve_product
+from app.services.records import AnalysisRecord, ProductRecord, RecallRecord, ScoreRecord
+from app.tracing_utils import span
+
 # Configuración explícita del logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Point these at local stand-ins to run offline (see benchmarks/standins.py)
+OFF_BASE_URL = os.getenv("OFF_BASE_URL", "https://world.openfoodfacts.org/api/v2")
+FDA_BASE_URL = os.getenv("FDA_BASE_URL", "https://api.fda.gov")
+# Per-request timeouts, shortened to what is left of the message's budget
+OFF_TIMEOUT = float(os.getenv("OFF_TIMEOUT", "10"))
+FDA_TIMEOUT = float(os.getenv("FDA_TIMEOUT", "5"))
+
+# Sub-score tables and weights shared by the scalar and batch (app.services.batch_scoring) scorers
+NUTRI_SCORES = {'a': 90, 'b': 80, 'c': 60, 'd': 40, 'e': 20}
+ECO_SCORES = {'a': 90, 'b': 75, 'c': 60, 'd': 40, 'e': 20}
+# health, environmental, social, animal
+SCORE_WEIGHTS = (0.35, 0.30, 0.20, 0.15)
+
+# ✅ DETECCIÓN DE SALUDOS MEJORADA
+GREETING_PATTERNS = [
+    r'^(hi|hello|hey|hola|bonjour|salut|coucou)($|\W)',
+    r'^(buenos días|buenas tardes|buenas noches|buen día)',
+    r'^(¿qué más|que más|quiubo|¿qué tal|que tal)',  
+    r'^(¿qué me cuentas|qué me cuentas)',
+    r'^(ayuda|help|auxilio)($|\W)',
+    r'^(empezar|comenzar|iniciar)',
+    r'(primera vez|no sé qué|cómo funciona)',
+]
+
+# ✅ PALABRAS QUE INDICAN PRODUCTO LEGÍTIMO
+PRODUCT_INDICATORS = [
+    # Productos específicos
+    'champú', 'shampoo', 'acondicionador', 'conditioner', 'jabón', 'soap',
+    'crema', 'cream', 'loción', 'lotion', 'maquillaje', 'makeup', 'base',
+    'rímel', 'mascara', 'labial', 'lipstick', 'protector solar', 'sunscreen',
+    'pasta dental', 'toothpaste', 'enjuague', 'mouthwash', 'desodorante', 'deodorant',
+    
+    # Alimentos y bebidas
+    'yogur', 'yogurt', 'leche', 'milk', 'queso', 'cheese', 'mantequilla', 'butter',
+    'cereal', 'galleta', 'cookie', 'chocolate', 'dulce', 'candy', 'bebida', 'drink',
+    'agua', 'water', 'jugo', 'juice', 'té', 'tea', 'café', 'coffee',
+    'pan', 'bread', 'arroz', 'rice', 'pasta', 'aceite', 'oil', 'vinagre', 'vinegar',
+    
+    # Categorías de producto
+    'producto', 'product', 'marca', 'brand', 'ingredientes', 'ingredients',
+    'etiqueta', 'label', 'empaque', 'package', 'envase', 'container',
+    'orgánico', 'organic', 'natural', 'vegano', 'vegan', 'sin gluten', 'gluten free',
+    'azúcar', 'sugar', 'sal', 'salt', 'grasa', 'fat', 'proteína', 'protein',
+    'calorías', 'calories', 'nutricional', 'nutritional', 'saludable', 'healthy',
+    
+    # Marcas conocidas
+    'coca', 'pepsi', 'nestlé', 'nestle', 'danone', 'unilever', 'loreal', 'l\'oreal',
+    'johnson', 'procter', 'kellogg', 'kraft', 'heinz', 'mars', 'ferrero',
+    'nutella', 'oreo', 'doritos', 'pringles', 'fanta', 'sprite', 'nivea',
+    'pantene', 'garnier', 'maybelline', 'revlon', 'colgate', 'oral-b'
+]
+
+# ✅ PATRONES DE CONSULTA VÁLIDA SOBRE PRODUCTOS
+VALID_PRODUCT_PATTERNS = [
+    r'(mejor|buena?|recomendación|recomienda)\s+(crema|champú|shampoo|jabón|producto)',
+    r'(buscar|encontrar|necesito)\s+(un|una)\s+(crema|champú|shampoo|jabón|producto)',
+    r'(ayuda|ayúdame)\s+(a\s+)?(buscar|encontrar|elegir)\s+(crema|champú|producto)',
+    r'(cuál|qué)\s+(crema|champú|shampoo|jabón|producto).+(mejor|bueno|recomiendan)',
+    r'(quiero|necesito)\s+(una?|un)\s+(crema|champú|shampoo|jabón|producto)',
+    r'(dónde|cómo)\s+(encontrar|comprar)\s+(crema|champú|producto)',
+]
+
+def _record_response(current, resp):
+    current.set_attributes({'http.url': str(resp.url.with_query(None)), 'http.status_code': resp.status})
+
+
 class ProductAnalyzer:
     """Analyzes products using real data sources"""
 
-    def __init__(self):
-        self.off_base_url = "https://world.openfoodfacts.org/api/v2"
-        self.fda_base_url = "https://api.fda.gov"
+    def __init__(self, off_base_url: str = OFF_BASE_URL, fda_base_url: str = FDA_BASE_URL,
+                 session: Optional[aiohttp.ClientSession] = None):
+        self.off_base_url = off_base_url
+        self.fda_base_url = fda_base_url
+        # Bulk callers pass a shared session; otherwise each lookup opens its own
+        self.session = session
         
         # ✅ BASE DE DATOS GLOBAL DE PAÍSES (195+ países)
         self.countries_db = {
@@ -129,30 +205,30 @@ class ProductAnalyzer:
         if query_lower in self.countries_db:
             return self.countries_db[query_lower]
         
-        # Buscar coincidencia parcial
+        # Buscar el nombre como palabra completa: "no", "si" o "en" no son países
         for country_key, country_info in self.countries_db.items():
-            if country_key in query_lower or query_lower in country_key:
+            if re.search(rf'\b{re.escape(country_key)}\b', query_lower):
                 return country_info
         
         return None
 
-    async def analyze(self, query: str) -> Dict:
+    def is_greeting(self, query: str) -> bool:
+        query = query.strip().lower()
+        return any(re.search(pattern, query, re.IGNORECASE) for pattern in GREETING_PATTERNS)
+
+    def mentions_product(self, query: str) -> bool:
+        """Si la consulta contiene indicadores o patrones de consulta sobre productos"""
+        query_lower = query.lower()
+        if any(indicator in query_lower for indicator in PRODUCT_INDICATORS):
+            return True
+        return any(re.search(pattern, query_lower) for pattern in VALID_PRODUCT_PATTERNS)
+
+    async def analyze(self, query: str, check_recalls: bool = True) -> Dict:
         query = query.strip().lower()
         
         # ✅ DETECCIÓN DE SALUDOS MEJORADA
-        greeting_patterns = [
-            r'^(hi|hello|hey|hola|bonjour|salut|coucou)($|\W)',
-            r'^(buenos días|buenas tardes|buenas noches|buen día)',
-            r'^(¿qué más|que más|quiubo|¿qué tal|que tal)',  
-            r'^(¿qué me cuentas|qué me cuentas)',
-            r'^(ayuda|help|auxilio)($|\W)',
-            r'^(empezar|comenzar|iniciar)',
-            r'(primera vez|no sé qué|cómo funciona)',
-        ]
-        
-        for pattern in greeting_patterns:
-            if re.search(pattern, query, re.IGNORECASE):
-                return {'found': False, 'is_greeting': True}
+        if self.is_greeting(query):
+            return {'found': False, 'is_greeting': True}
         
         # ✅ DETECCIÓN GLOBAL DE PAÍSES
         detected_country = self.detect_country(query)
@@ -169,79 +245,49 @@ class ProductAnalyzer:
             return {'found': False, 'is_out_of_scope': True}
 
         # Continuar con análisis de producto...
+        return await self.lookup(query, check_recalls)
+
+    async def lookup(self, query: str, check_recalls: bool = True) -> Dict:
+        """Look up and score a barcode or product name, without the chat-message filters.
+
+        A failed Open Food Facts request is reported as `{'found': False, 'error': ...}`.
+        `check_recalls=False` skips the FDA request (degraded answers under load), as
+        does a message with too little time left.
+        """
+        check_recalls = check_recalls and has_time(DEADLINE_RECALLS_MIN, 'fda')
         results = await asyncio.gather(
             self._get_off_data(query),
-            self._check_fda_recalls(query),
+            self._check_fda_recalls(query) if check_recalls else asyncio.sleep(0),
             return_exceptions=True
         )
 
         off_data, fda_data = results
 
-        if isinstance(off_data, Exception) or not off_data.get('found'):
-            return {'found': False, 'query': query}
+        if isinstance(off_data, Exception):
+            return {'found': False, 'query': query, 'error': str(off_data)}
+        if not off_data.get('found'):
+            not_found = {'found': False, 'query': query}
+            if off_data.get('error'):
+                not_found['error'] = off_data['error']
+            return not_found
 
         scores = self._calculate_scores(off_data, fda_data)
 
-        return {
-            'found': True,
-            'product': off_data,
-            'fda': fda_data if not isinstance(fda_data, Exception) else None,
-            'scores': scores,
-            'query': query
-        }
+        return AnalysisRecord(
+            product=off_data,
+            fda=fda_data if not isinstance(fda_data, Exception) else None,
+            scores=scores,
+            query=query
+        )
 
     def is_out_of_scope(self, query: str) -> bool:
         """FILTRO INTELIGENTE: Detecta temas fuera de scope pero permite consultas legítimas sobre productos"""
         
         query_lower = query.lower()
         
-        # ✅ PRIMERO: PALABRAS QUE INDICAN PRODUCTO LEGÍTIMO (alta prioridad)
-        product_indicators = [
-            # Productos específicos
-            'champú', 'shampoo', 'acondicionador', 'conditioner', 'jabón', 'soap',
-            'crema', 'cream', 'loción', 'lotion', 'maquillaje', 'makeup', 'base',
-            'rímel', 'mascara', 'labial', 'lipstick', 'protector solar', 'sunscreen',
-            'pasta dental', 'toothpaste', 'enjuague', 'mouthwash', 'desodorante', 'deodorant',
-            
-            # Alimentos y bebidas
-            'yogur', 'yogurt', 'leche', 'milk', 'queso', 'cheese', 'mantequilla', 'butter',
-            'cereal', 'galleta', 'cookie', 'chocolate', 'dulce', 'candy', 'bebida', 'drink',
-            'agua', 'water', 'jugo', 'juice', 'té', 'tea', 'café', 'coffee',
-            'pan', 'bread', 'arroz', 'rice', 'pasta', 'aceite', 'oil', 'vinagre', 'vinegar',
-            
-            # Categorías de producto
-            'producto', 'product', 'marca', 'brand', 'ingredientes', 'ingredients',
-            'etiqueta', 'label', 'empaque', 'package', 'envase', 'container',
-            'orgánico', 'organic', 'natural', 'vegano', 'vegan', 'sin gluten', 'gluten free',
-            'azúcar', 'sugar', 'sal', 'salt', 'grasa', 'fat', 'proteína', 'protein',
-            'calorías', 'calories', 'nutricional', 'nutritional', 'saludable', 'healthy',
-            
-            # Marcas conocidas
-            'coca', 'pepsi', 'nestlé', 'nestle', 'danone', 'unilever', 'loreal', 'l\'oreal',
-            'johnson', 'procter', 'kellogg', 'kraft', 'heinz', 'mars', 'ferrero',
-            'nutella', 'oreo', 'doritos', 'pringles', 'fanta', 'sprite', 'nivea',
-            'pantene', 'garnier', 'maybelline', 'revlon', 'colgate', 'oral-b'
-        ]
-        
-        # ✅ PATRONES DE CONSULTA VÁLIDA SOBRE PRODUCTOS
-        valid_product_patterns = [
-            r'(mejor|buena?|recomendación|recomienda)\s+(crema|champú|shampoo|jabón|producto)',
-            r'(buscar|encontrar|necesito)\s+(un|una)\s+(crema|champú|shampoo|jabón|producto)',
-            r'(ayuda|ayúdame)\s+(a\s+)?(buscar|encontrar|elegir)\s+(crema|champú|producto)',
-            r'(cuál|qué)\s+(crema|champú|shampoo|jabón|producto).+(mejor|bueno|recomiendan)',
-            r'(quiero|necesito)\s+(una?|un)\s+(crema|champú|shampoo|jabón|producto)',
-            r'(dónde|cómo)\s+(encontrar|comprar)\s+(crema|champú|producto)',
-        ]
-        
-        # Si la consulta contiene indicadores de producto, NO está fuera de scope
-        for indicator in product_indicators:
-            if indicator in query_lower:
-                return False
-        
-        # Si coincide con patrones válidos de consulta de producto, NO está fuera de scope  
-        for pattern in valid_product_patterns:
-            if re.search(pattern, query_lower):
-                return False
+        # ✅ PRIMERO: SI MENCIONA UN PRODUCTO, NO está fuera de scope (alta prioridad)
+        if self.mentions_product(query_lower):
+            return False
         
         # ✅ TEMAS CLARAMENTE PROHIBIDOS (solo los más específicos)
         definitely_prohibited = [
@@ -298,52 +344,83 @@ class ProductAnalyzer:
         # Es mejor dejar pasar una consulta ambigua que rechazar una legítima
         return False
 
+    @asynccontextmanager
+    async def _client_session(self):
+        if self.session is not None:
+            yield self.session
+        else:
+            async with aiohttp.ClientSession() as session:
+                yield session
+
     async def _get_off_data(self, query: str) -> Dict:
-        async with aiohttp.ClientSession() as session:
+        async with self._client_session() as session:
             try:
-                if query.replace(' ', '').isdigit():
-                    url = f"{self.off_base_url}/product/{query}.json"
-                    async with session.get(url) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            if data.get('status') == 1:
-                                return self._process_off_product(data['product'])
+                code = query if query.replace(' ', '').isdigit() else None
+                if code is None:
+                    # Misspelled or Spanish/English names resolve locally; the barcode lookup is exact
+                    hit = resolve_product(query)
+                    code = hit.code if hit else None
+                if code is not None:
+                    url = f"{self.off_base_url}/product/{code}.json"
+                    with span('off.product') as current:
+                        async with session.get(url, timeout=aiohttp.ClientTimeout(total=remaining(OFF_TIMEOUT))) as resp:
+                            _record_response(current, resp)
+                            if resp.status == 200:
+                                data = await resp.json()
+                                current.set_attribute('http.response.body.size', len(await resp.read()))
+                                if data.get('status') == 1:
+                                    return self._process_off_product(data['product'])
+                            elif resp.status != 404:
+                                return {'found': False, 'error': f"OFF HTTP {resp.status}"}
 
                 params = {
                     'search_terms': query,
                     'search_simple': 1,
                     'json': 1,
                     'page_size': 1,
-                    'fields': 'product_name,brands,nutriscore_grade,ecoscore_grade,labels_tags,ingredients_from_palm_oil_n,nova_group'
+                    'fields': 'code,product_name,brands,nutriscore_grade,ecoscore_grade,labels_tags,ingredients_from_palm_oil_n,nova_group,categories_tags,countries_tags'
                 }
 
-                async with session.get(f"{self.off_base_url}/search.json", params=params) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        if data.get('products') and len(data['products']) > 0:
-                            return self._process_off_product(data['products'][0])
+                with span('off.search', **{'off.query.chars': len(query)}) as current:
+                    async with session.get(f"{self.off_base_url}/search.json", params=params,
+                                           timeout=aiohttp.ClientTimeout(total=remaining(OFF_TIMEOUT))) as resp:
+                        _record_response(current, resp)
+                        if resp.status == 200:
+                            data = await resp.json()
+                            current.set_attributes({'http.response.body.size': len(await resp.read()),
+                                                    'off.results': len(data.get('products') or [])})
+                            if data.get('products') and len(data['products']) > 0:
+                                learn_product(data['products'][0])
+                                return self._process_off_product(data['products'][0])
+                        else:
+                            return {'found': False, 'error': f"OFF HTTP {resp.status}"}
 
             except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    record_miss('off')
                 logger.error(f"OFF API error: {e}")
+                return {'found': False, 'error': str(e) or type(e).__name__}
 
         return {'found': False}
 
-    def _process_off_product(self, product: Dict) -> Dict:
-        return {
-            'found': True,
-            'name': product.get('product_name', 'Unknown').strip(),
-            'brand': product.get('brands', '').strip(),
-            'nutriscore': product.get('nutriscore_grade', 'unknown'),
-            'ecoscore': product.get('ecoscore_grade', 'unknown'),
-            'nova': product.get('nova_group', 0),
-            'labels': product.get('labels_tags', []),
-            'is_organic': 'en:organic' in product.get('labels_tags', []),
-            'is_vegan': 'en:vegan' in product.get('labels_tags', []),
-            'is_palm_oil_free': product.get('ingredients_from_palm_oil_n', 0) == 0
-        }
+    def _process_off_product(self, product: Dict) -> ProductRecord:
+        return ProductRecord(
+            code=product.get('code', ''),
+            name=product.get('product_name', 'Unknown').strip(),
+            brand=product.get('brands', '').strip(),
+            nutriscore=product.get('nutriscore_grade', 'unknown'),
+            ecoscore=product.get('ecoscore_grade', 'unknown'),
+            nova=product.get('nova_group', 0),
+            labels=product.get('labels_tags', []),
+            is_organic='en:organic' in product.get('labels_tags', []),
+            is_vegan='en:vegan' in product.get('labels_tags', []),
+            is_palm_oil_free=product.get('ingredients_from_palm_oil_n', 0) == 0,
+            categories=product.get('categories_tags', []),
+            countries=product.get('countries_tags', [])
+        )
 
-    async def _check_fda_recalls(self, query: str) -> Dict:
-        async with aiohttp.ClientSession() as session:
+    async def _check_fda_recalls(self, query: str) -> Optional[RecallRecord]:
+        async with self._client_session() as session:
             try:
                 params = {
                     'search': f'"{query}"',
@@ -351,35 +428,41 @@ class ProductAnalyzer:
                 }
 
                 url = f"{self.fda_base_url}/food/enforcement.json"
-                async with session.get(url, params=params) as resp:
-                    if resp.status == 200:
+                with span('fda.enforcement') as current:
+                    async with session.get(url, params=params,
+                                           timeout=aiohttp.ClientTimeout(total=remaining(FDA_TIMEOUT))) as resp:
+                        _record_response(current, resp)
+                        if resp.status != 200:
+                            return None
                         data = await resp.json()
+                        current.set_attributes({'http.response.body.size': len(await resp.read()),
+                                                'fda.results': len(data.get('results') or [])})
                         if data.get('results'):
-                            return {
-                                'has_recalls': True,
-                                'recall_count': len(data['results']),
-                                'latest_recall': data['results'][0].get('reason_for_recall', '')
-                            }
+                            return RecallRecord(
+                                has_recalls=True,
+                                recall_count=len(data['results']),
+                                latest_recall=data['results'][0].get('reason_for_recall', '')
+                            )
 
             except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    record_miss('fda')
                 logger.error(f"FDA API error: {e}")
 
-    def _calculate_scores(self, off_data: Dict, fda_data: Optional[Dict]) -> Dict:
+    def _calculate_scores(self, off_data: Dict, fda_data: Optional[Dict]) -> ScoreRecord:
         health_score = 50
         environmental_score = 50
         social_score = 50
         animal_score = 50
 
         nutriscore = off_data.get('nutriscore', '').lower()
-        nutri_mapping = {'a': 90, 'b': 80, 'c': 60, 'd': 40, 'e': 20}
-        health_score = nutri_mapping.get(nutriscore, 50)
+        health_score = NUTRI_SCORES.get(nutriscore, 50)
 
         if fda_data and fda_data.get('has_recalls'):
             health_score -= 20
 
         ecoscore = off_data.get('ecoscore', '').lower()
-        eco_mapping = {'a': 90, 'b': 75, 'c': 60, 'd': 40, 'e': 20}
-        environmental_score = eco_mapping.get(ecoscore, 50)
+        environmental_score = ECO_SCORES.get(ecoscore, 50)
 
         if off_data.get('is_organic'):
             environmental_score += 10
@@ -405,20 +488,21 @@ class ProductAnalyzer:
         social_score = max(0, min(social_score, 100))
         animal_score = max(0, min(animal_score, 100))
 
+        health_weight, environmental_weight, social_weight, animal_weight = SCORE_WEIGHTS
         overall = round(
-            0.35 * health_score +
-            0.30 * environmental_score +
-            0.20 * social_score +
-            0.15 * animal_score
+            health_weight * health_score +
+            environmental_weight * environmental_score +
+            social_weight * social_score +
+            animal_weight * animal_score
         )
 
-        return {
-            'overall': overall,
-            'health': health_score,
-            'environmental': environmental_score,
-            'social': social_score,
-            'animal': animal_score
-        }
+        return ScoreRecord(
+            overall=overall,
+            health=health_score,
+            environmental=environmental_score,
+            social=social_score,
+            animal=animal_score
+        )
 
 def format_product_analysis(analysis: Dict) -> str:
     """Formato mejorado con emoji de esfera obligatorio"""
@@ -462,7 +546,7 @@ def format_product_analysis(analysis: Dict) -> str:
         key_factors.append(f"Nutri-Score: {product['nutriscore'].upper()}")
     if product.get('ecoscore'):
         key_factors.append(f"Eco-Score: {product['ecoscore'].upper()}")
-    if analysis.get('fda', {}).get('has_recalls'):
+    if (analysis.get('fda') or {}).get('has_recalls'):
         key_factors.append("⚠️ Retiro registrado por la FDA")
     if product.get('is_vegan'):
         key_factors.append("✅ Vegano")
@@ -481,6 +565,47 @@ def format_product_analysis(analysis: Dict) -> str:
 
     return response
 
+def format_detailed_analysis(analysis: Dict) -> str:
+    """Explica el porqué de cada puntaje del último análisis"""
+    if not analysis.get('found'):
+        return None
+
+    product = analysis['product']
+    scores = analysis['scores']
+    fda = analysis.get('fda') or {}
+
+    nutriscore = (product.get('nutriscore') or 'unknown').upper()
+    ecoscore = (product.get('ecoscore') or 'unknown').upper()
+
+    health_reasons = [f"Nutri-Score {nutriscore}"]
+    if fda.get('has_recalls'):
+        health_reasons.append(f"{fda.get('recall_count', 1)} retiro(s) FDA (-20)")
+
+    environmental_reasons = [f"Eco-Score {ecoscore}"]
+    if product.get('is_organic'):
+        environmental_reasons.append("orgánico (+10)")
+    if not product.get('is_palm_oil_free'):
+        environmental_reasons.append("contiene aceite de palma (-15)")
+
+    social_reasons = ["comercio justo (+10)"] if product.get('is_fair_trade') else ["sin certificación de comercio justo"]
+    animal_reasons = ["vegano (+20)"] if product.get('is_vegan') else ["no certificado vegano (-20)"]
+
+    response = f"""NOURA: EVIDENCE-BASED WELLBEING™
+
+¿Por qué {scores.get('overall', 0)}/100?
+
+🧪 Salud {scores['health']}/100 (35%): {', '.join(health_reasons)}
+🌱 Medioambiente {scores['environmental']}/100 (30%): {', '.join(environmental_reasons)}
+👥 Justicia Social {scores['social']}/100 (20%): {', '.join(social_reasons)}
+🐾 Bienestar Animal {scores['animal']}/100 (15%): {', '.join(animal_reasons)}
+"""
+
+    if fda.get('latest_recall'):
+        response += f"\n⚠️ Último retiro FDA: {fda['latest_recall'][:200]}\n"
+
+    response += "\n📊 Fuente: Open Food Facts + FDA"
+    return response
+
 def format_clean_recommendation(score: int, confidence: str, brand: str, price: str, url: str) -> str:
     if score >= 90:
         emoji = "🟢"
@@ -495,5 +620,8 @@ def format_clean_recommendation(score: int, confidence: str, brand: str, price:
 
 product_analyzer = ProductAnalyzer()
 
-async def analyze_product(query: str) -> Dict:
-    return await product_analyzer.analyze(query)
+async def analyze_product(query: str, check_recalls: bool = True) -> Dict:
+    return await product_analyzer.analyze(query, check_recalls)
+
+async def lookup_product(query: str, check_recalls: bool = True) -> Dict:
+    return await product_analyzer.lookup(query.strip().lower(), check_recalls)
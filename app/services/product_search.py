@@ -0,0 +1,433 @@
+"""Local product name search that tolerates typos, accents and Spanish/English variants.
+
+Open Food Facts' `search_simple` gets "nutela" or "galletas oreo" wrong. This
+index resolves free text to a barcode in memory (BM25 over product name, brand
+and most specific category), with:
+
+* accent and case folding ("azúcar" = "azucar") and a light plural strip,
+* bilingual synonyms ("galletas" also matches "cookies", "fresa" "strawberry"),
+* trigram matching of words the catalog does not contain ("nutela" → "nutella"),
+* joined words ("coca cola" ↔ "cocacola", "kit kat" ↔ "kitkat").
+
+Each hit gets a confidence: how much of the query it explains (typos and synonyms
+count for less), times how clearly it is the product meant — either it leads the
+next candidate by PRODUCT_SEARCH_MIN_LEAD or the query names all of it. A lead
+alone is not enough when every word matched only through a typo correction: a
+lone near-miss ("vale" → "valdez") always leads, so it must name the product. The
+product analyzer only trusts hits above PRODUCT_SEARCH_MIN_CONFIDENCE and looks
+them up by barcode; anything else still goes to the remote search.
+
+    python -m app.services.product_search benchmarks/fixtures/catalog.jsonl "galetas oreo"
+"""
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from app.metrics_utils import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# JSONL export of Open Food Facts products (code, product_name, brands, categories_tags)
+PRODUCT_SEARCH_CATALOG_PATH = os.getenv("PRODUCT_SEARCH_CATALOG_PATH", "")
+PRODUCT_SEARCH_MIN_CONFIDENCE = float(os.getenv("PRODUCT_SEARCH_MIN_CONFIDENCE", "0.6"))
+# Relative BM25 lead over the runner-up that makes a hit unambiguous
+PRODUCT_SEARCH_MIN_LEAD = float(os.getenv("PRODUCT_SEARCH_MIN_LEAD", "0.2"))
+# Products learned from remote searches are added up to this size
+PRODUCT_SEARCH_MAX_PRODUCTS = int(os.getenv("PRODUCT_SEARCH_MAX_PRODUCTS", "500000"))
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Category words describe the product less precisely than its name or brand
+CATEGORY_WEIGHT = 0.5
+SYNONYM_WEIGHT = 0.9
+# Minimum Dice similarity of word trigrams for a typo match, and matches kept per word
+FUZZY_MIN_SIMILARITY = 0.6
+FUZZY_MAX_TERMS = 3
+FUZZY_EDIT_CANDIDATES = 20
+# Products scored per query word: all of those with a rare word, the best of those with a common one
+CANDIDATES_PER_TERM = 256
+
+# Words of the request rather than of the product
+STOPWORDS = {
+    'de', 'del', 'la', 'el', 'los', 'las', 'un', 'una', 'y', 'en', 'con', 'al', 'lo',
+    'the', 'of', 'and', 'a', 'with', 'le', 'les', 'du', 'des', 'et',
+    'quiero', 'analiza', 'analizar', 'analisis', 'producto', 'product', 'info', 'informacion',
+    'sobre', 'que', 'tal', 'es', 'esta', 'este', 'esa', 'ese', 'por', 'favor', 'marca', 'brand',
+}
+
+# Equivalent words across Spanish, English and French (folded and singularised when loaded)
+SYNONYM_GROUPS = [
+    ['galleta', 'cookie', 'biscuit', 'biscuits', 'galletita'],
+    ['yogur', 'yogurt', 'yoghurt', 'yogourt', 'yaourt'],
+    ['leche', 'milk', 'lait'],
+    ['fresa', 'frutilla', 'strawberry', 'fraise'],
+    ['naranja', 'orange'],
+    ['manzana', 'apple', 'pomme'],
+    ['jugo', 'zumo', 'juice', 'jus'],
+    ['chocolate', 'chocolat', 'chocolatina'],
+    ['mani', 'cacahuete', 'cacahuate', 'peanut'],
+    ['mantequilla', 'butter', 'beurre'],
+    ['avellana', 'hazelnut', 'noisette'],
+    ['almendra', 'almond', 'amande'],
+    ['avena', 'oat', 'oatmeal', 'avoine'],
+    ['arroz', 'rice', 'riz'],
+    ['pan', 'bread', 'pain'],
+    ['cafe', 'coffee'],
+    ['aceite', 'oil', 'huile'],
+    ['oliva', 'olive'],
+    ['agua', 'water', 'eau'],
+    ['papa', 'patata', 'potato', 'chip'],
+    ['organico', 'ecologico', 'organic', 'bio'],
+    ['integral', 'wholegrain', 'whole'],
+    ['griego', 'greek', 'grec'],
+    ['natural', 'plain', 'nature'],
+    ['negro', 'dark', 'noir'],
+    ['azucar', 'sugar', 'sucre'],
+    ['cereal', 'cereales'],
+    ['bebida', 'drink', 'boisson'],
+    ['crema', 'cream', 'spread'],
+]
+
+product_searches = Counter('noura_product_search_total',
+                           'Free-text product lookups, by result (local, remote)')
+product_search_seconds = Histogram('noura_product_search_seconds', 'Time to search the local product index')
+
+
+def fold(text: str) -> str:
+    """Lowercase, strip accents and punctuation: "Pâte à tartiner" → "pate a tartiner"."""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r'[^a-z0-9]+', ' ', text).strip()
+
+
+def _stem(word: str) -> str:
+    # galletas → galleta, cookies → cookie; short words ("gas", "jus") are left alone
+    if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    # Single letters are left over from "Kellogg's" or "Jus d'orange"
+    return [_stem(word) for word in fold(text).split() if len(word) > 1 or word.isdigit()]
+
+
+def _trigrams(word: str) -> set:
+    padded = f"${word}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance counting a swap of neighbouring letters as one edit ("pringels")."""
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+    return current[-1]
+
+
+def _build_synonyms() -> Dict[str, List[str]]:
+    synonyms = {}
+    for group in SYNONYM_GROUPS:
+        words = list(dict.fromkeys(_stem(fold(word)) for word in group))
+        for word in words:
+            synonyms[word] = [other for other in words if other != word]
+    return synonyms
+
+
+SYNONYMS = _build_synonyms()
+
+
+class SearchHit(NamedTuple):
+    code: str
+    name: str
+    brand: str
+    score: float
+    confidence: float
+
+
+class ProductSearchIndex:
+    """Inverted index of product names, brands and categories, scored with BM25."""
+
+    def __init__(self):
+        self._products: List[tuple] = []              # (code, name, brand, name terms)
+        self._lengths: List[float] = []
+        self._postings: Dict[str, Dict[int, float]] = defaultdict(dict)
+        # (trigram, word length) → indexed words, so typo candidates are only counted among similar lengths
+        self._trigram_terms: Dict[tuple, set] = defaultdict(set)
+        # Common words' postings ordered by BM25 impact, rebuilt after the word gets new products
+        self._top_postings: Dict[str, List[int]] = {}
+        self._codes = set()
+        self._total_length = 0.0
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def add(self, code: str, name: str, brand: str = '', categories: Optional[List[str]] = None):
+        if not code or not name or code in self._codes or len(self._products) >= PRODUCT_SEARCH_MAX_PRODUCTS:
+            return
+        self._codes.add(code)
+        doc = len(self._products)
+        name_terms = tokenize(name)
+        brand_terms = tokenize(brand)
+        words = name_terms + [term for term in brand_terms if term not in name_terms]
+        # Most specific OFF tag, e.g. "en:chocolate-sandwich-cookies"
+        category_words = tokenize(categories[-1].split(':')[-1]) if categories else []
+
+        frequencies = defaultdict(float)
+        for term in words:
+            frequencies[term] += 1
+        for term in category_words:
+            frequencies[term] += CATEGORY_WEIGHT
+        # "Coca-Cola" is also found as "cocacola", "Chips Ahoy" as "chipsahoy"
+        for first, second in zip(words, words[1:]):
+            frequencies.setdefault(first + second, 1)
+
+        for term, frequency in frequencies.items():
+            if term not in self._postings:
+                for trigram in _trigrams(term):
+                    self._trigram_terms[trigram, len(term)].add(term)
+            self._postings[term][doc] = frequency
+            self._top_postings.pop(term, None)
+        self._products.append((code, name, brand, tuple(name_terms), tuple(brand_terms)))
+        length = len(words) + CATEGORY_WEIGHT * len(category_words)
+        self._lengths.append(length)
+        self._total_length += length
+
+    def add_off_product(self, product: Dict):
+        """Add a raw Open Food Facts product (or a ProductRecord)."""
+        self.add(str(product.get('code') or ''),
+                 (product.get('product_name') or product.get('name') or '').strip(),
+                 (product.get('brands') or product.get('brand') or '').strip(),
+                 product.get('categories_tags') or product.get('categories'))
+
+    def _idf(self, term: str) -> float:
+        df = len(self._postings.get(term, ()))
+        return math.log(1 + (len(self._products) - df + 0.5) / (df + 0.5))
+
+    def _fuzzy_terms(self, word: str) -> List[tuple]:
+        """Indexed terms within FUZZY_MIN_SIMILARITY of a word the index lacks (trigram Dice, else edit distance)."""
+        if len(word) < 4:
+            return []
+        trigrams = _trigrams(word)
+        shared = defaultdict(int)
+        for length in range(len(word) - 2, len(word) + 3):
+            for trigram in trigrams:
+                for term in self._trigram_terms.get((trigram, length), ()):
+                    shared[term] += 1
+        similar = []
+        near_misses = []
+        for term, count in shared.items():
+            # A word of n letters has n padded trigrams
+            similarity = 2 * count / (len(trigrams) + len(term))
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                similar.append((term, similarity))
+            # Typos rarely hit the first letter, which keeps "lentejas" away from "entera"
+            elif count >= 2 and term[0] == word[0]:
+                near_misses.append((count, term))
+        # Swapped or doubled letters break several trigrams at once ("kelogs", "pringels");
+        # only the words sharing the most trigrams are worth an edit distance
+        for _, term in heapq.nlargest(FUZZY_EDIT_CANDIDATES, near_misses):
+            similarity = 1 - _edit_distance(word, term) / max(len(word), len(term))
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                similar.append((term, similarity))
+        similar.sort(key=lambda item: -item[1])
+        return similar[:FUZZY_MAX_TERMS]
+
+    def _query_slots(self, query: str) -> Tuple[List[List[tuple]], List[bool]]:
+        """One list of (indexed term, weight) alternatives per query word, and whether it is only fuzzy."""
+        words = [word for word in tokenize(query) if word not in STOPWORDS]
+        # "kit kat" → "kitkat" when only the joined form is indexed
+        merged = []
+        for word in words:
+            if (merged and merged[-1] not in self._postings and word not in self._postings
+                    and merged[-1] + word in self._postings):
+                merged[-1] += word
+            else:
+                merged.append(word)
+
+        slots, fuzzy = [], []
+        for word in merged:
+            alternatives = {}
+            if word in self._postings:
+                alternatives[word] = 1.0
+            for synonym in SYNONYMS.get(word, ()):
+                if synonym in self._postings:
+                    alternatives.setdefault(synonym, SYNONYM_WEIGHT)
+            fuzzy.append(not alternatives)
+            if not alternatives:
+                for term, similarity in self._fuzzy_terms(word):
+                    alternatives[term] = similarity
+                    for synonym in SYNONYMS.get(term, ()):
+                        if synonym in self._postings:
+                            alternatives.setdefault(synonym, similarity * SYNONYM_WEIGHT)
+            slots.append(list(alternatives.items()))
+        return slots, fuzzy
+
+    def _candidates(self, term: str, average_length: float) -> List[int]:
+        postings = self._postings[term]
+        if len(postings) <= CANDIDATES_PER_TERM:
+            return list(postings)
+        if term not in self._top_postings:
+            def impact(doc):
+                frequency = postings[doc]
+                return frequency / (frequency + K1 * (1 - B + B * self._lengths[doc] / average_length))
+            self._top_postings[term] = heapq.nlargest(CANDIDATES_PER_TERM, postings, key=impact)
+        return self._top_postings[term]
+
+    def search(self, query: str, k: int = 5) -> List[SearchHit]:
+        """Best k products for `query`, each with its score and confidence (0-1)."""
+        if not self._products:
+            return []
+        slots, fuzzy = self._query_slots(query)
+        if not slots:
+            return []
+
+        average_length = self._total_length / len(self._products)
+        unseen_idf = math.log(1 + (len(self._products) + 0.5) / 0.5)
+        idfs = {term: self._idf(term) for alternatives in slots for term, _ in alternatives}
+        # What each query word is worth: the word itself if indexed, else its best match. A rare
+        # synonym ("yaourt" for "yogur") is scored at that value, so it cannot outrank the word itself
+        slot_idfs = [idfs[alternatives[0][0]] if alternatives and alternatives[0][1] == 1.0
+                     else max((idfs[term] for term, _ in alternatives), default=unseen_idf)
+                     for alternatives in slots]
+        query_weight = sum(slot_idfs)
+        candidates = set()
+        for term in idfs:
+            candidates.update(self._candidates(term, average_length))
+
+        scores = {}
+        matched = {}
+        matched_name = {}
+        # Terms matched through typo corrections, and products some query word matched as is (or by synonym)
+        corrected = defaultdict(set)
+        exact = set()
+        for doc in candidates:
+            norm = K1 * (1 - B + B * self._lengths[doc] / average_length)
+            name_terms = self._products[doc][3]
+            total = credit = name_credit = 0.0
+            for alternatives, slot_idf, slot_fuzzy in zip(slots, slot_idfs, fuzzy):
+                # Each query word counts once per product, through its best alternative
+                best = None
+                for term, weight in alternatives:
+                    frequency = self._postings[term].get(doc)
+                    if frequency:
+                        term_idf = min(idfs[term], slot_idf)
+                        score = weight * term_idf * frequency * (K1 + 1) / (frequency + norm)
+                        if best is None or score > best[0]:
+                            best = (score, weight, term_idf, term)
+                if best:
+                    score, weight, term_idf, term = best
+                    total += score
+                    credit += weight * term_idf
+                    if term in name_terms:
+                        name_credit += term_idf
+                    if slot_fuzzy:
+                        corrected[doc].add(term)
+                    else:
+                        exact.add(doc)
+            scores[doc], matched[doc], matched_name[doc] = total, credit, name_credit
+
+        ranked = heapq.nlargest(max(k, 2), scores, key=scores.get)
+        hits = []
+        for position, doc in enumerate(ranked):
+            code, name, brand, name_terms, brand_terms = self._products[doc]
+            explained = min(1.0, matched[doc] / query_weight) if query_weight else 0.0
+            # How much of the product's name the query covers ("nutela" names all of "Nutella")
+            name_weight = sum(self._idf(term) for term in name_terms)
+            named = min(1.0, matched_name[doc] / name_weight) if name_weight else 0.0
+            lead = 0.0
+            if position == 0:
+                runner_up = scores[ranked[1]] if len(ranked) > 1 else 0.0
+                lead = (scores[doc] - runner_up) / scores[doc]
+            distinct = max(min(1.0, lead / PRODUCT_SEARCH_MIN_LEAD), named)
+            if doc not in exact:
+                # Typo corrections alone must also name the product or its brand: a lone
+                # near-miss ("vale" → "valdez" of Juan Valdez) always leads
+                distinct = min(distinct, max(self._coverage(name_terms, corrected[doc]),
+                                             self._coverage(brand_terms, corrected[doc])))
+            hits.append(SearchHit(code, name, brand, scores[doc], explained * distinct))
+        return hits[:k]
+
+    def _coverage(self, words: tuple, terms: set) -> float:
+        """Share of `words` (by idf) that `terms` name; a joined term ("chipahoy") names both halves."""
+        covered = {word for word in words if word in terms}
+        for first, second in zip(words, words[1:]):
+            if first + second in terms:
+                covered.update((first, second))
+        weight = sum(self._idf(word) for word in set(words))
+        return min(1.0, sum(self._idf(word) for word in covered) / weight) if weight else 0.0
+
+    def resolve(self, query: str, min_confidence: float = PRODUCT_SEARCH_MIN_CONFIDENCE) -> Optional[SearchHit]:
+        """The product `query` names, if the index is confident enough; None otherwise."""
+        hits = self.search(query, k=1)
+        if hits and hits[0].confidence >= min_confidence:
+            return hits[0]
+        return None
+
+    @classmethod
+    def from_catalog(cls, path: str) -> 'ProductSearchIndex':
+        """Build from a JSONL export of raw Open Food Facts products."""
+        index = cls()
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    index.add_off_product(json.loads(line))
+        return index
+
+
+def _load_default_index() -> ProductSearchIndex:
+    if PRODUCT_SEARCH_CATALOG_PATH and os.path.exists(PRODUCT_SEARCH_CATALOG_PATH):
+        try:
+            start = time.perf_counter()
+            index = ProductSearchIndex.from_catalog(PRODUCT_SEARCH_CATALOG_PATH)
+            logger.info(f"Indexed {len(index)} product names for local search in {time.perf_counter() - start:.2f}s")
+            return index
+        except Exception as e:
+            logger.error(f"Could not load product search catalog: {e}")
+    return ProductSearchIndex()
+
+
+product_search_index = _load_default_index()
+
+
+def resolve_product(query: str) -> Optional[SearchHit]:
+    """Barcode candidate for a free-text product query, or None to search remotely."""
+    if not len(product_search_index):
+        return None
+    start = time.perf_counter()
+    hit = product_search_index.resolve(query)
+    product_search_seconds.observe(time.perf_counter() - start)
+    product_searches.inc(result='local' if hit else 'remote')
+    if hit:
+        logger.info(f"Local search: '{query}' → {hit.code} {hit.name} ({hit.confidence:.2f})")
+    return hit
+
+
+def learn_product(product: Dict):
+    """Index a product found by a remote search, so the next misspelling of it resolves locally."""
+    product_search_index.add_off_product(product)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python -m app.services.product_search <catalog.jsonl> "query" ["query" ...]')
+        sys.exit(1)
+    catalog_index = ProductSearchIndex.from_catalog(sys.argv[1])
+    for text in sys.argv[2:]:
+        print(text)
+        for found in catalog_index.search(text):
+            print(f"  {found.confidence:.2f}  {found.score:6.2f}  {found.code}  {found.name} ({found.brand})")
@@ -0,0 +1,210 @@
+"""Compact records for product analyses.
+
+The analyzer used to pass nested dicts around (and JSON-encode them into Redis for
+the "why" and "alternativas" follow-ups). These `__slots__` records hold the same
+fields with far less memory, intern the Open Food Facts tag strings so every cached
+product shares one copy of e.g. 'en:organic', and encode to a small binary form.
+
+They keep the mapping-style access the formatters and handlers already use
+(`record['scores']['overall']`, `record.get('fda')`), so callers need not change.
+"""
+import struct
+import sys
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class _Record:
+    __slots__ = ()
+    # Keys exposed through the mapping interface (slots plus constant fields such as 'found')
+    FIELDS: Tuple[str, ...] = ()
+
+    def get(self, key: str, default=None):
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, key)
+
+    def __getitem__(self, key: str):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.FIELDS
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.FIELDS]
+
+    def to_dict(self) -> Dict:
+        """Plain nested dicts and lists, the JSON shape analyses had before records."""
+        result = {}
+        for key, value in self.items():
+            if isinstance(value, _Record):
+                value = value.to_dict()
+            elif isinstance(value, tuple):
+                value = list(value)
+            result[key] = value
+        return result
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, _Record):
+            return type(self) is type(other) and self.items() == other.items()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f"{key}={value!r}" for key, value in self.items())
+        return f"{type(self).__name__}({fields})"
+
+
+def intern_tags(tags: Optional[Iterable[str]]) -> Tuple[str, ...]:
+    return tuple(sys.intern(tag) for tag in tags or ())
+
+
+class ProductRecord(_Record):
+    __slots__ = ('code', 'name', 'brand', 'nutriscore', 'ecoscore', 'nova', 'labels',
+                 'is_organic', 'is_vegan', 'is_palm_oil_free', 'is_fair_trade', 'brand_ethics_score',
+                 'categories', 'countries')
+    FIELDS = ('found',) + __slots__
+    found = True
+
+    def __init__(self, code: str = '', name: str = '', brand: str = '', nutriscore: str = 'unknown',
+                 ecoscore: str = 'unknown', nova: Optional[int] = 0, labels: Iterable[str] = (),
+                 is_organic: bool = False, is_vegan: bool = False, is_palm_oil_free: bool = True,
+                 is_fair_trade: bool = False, brand_ethics_score: Optional[int] = None,
+                 categories: Iterable[str] = (), countries: Iterable[str] = ()):
+        self.code = code
+        self.name = name
+        self.brand = brand
+        # Grades come from a handful of values; interning them costs nothing
+        self.nutriscore = sys.intern(nutriscore) if isinstance(nutriscore, str) else nutriscore
+        self.ecoscore = sys.intern(ecoscore) if isinstance(ecoscore, str) else ecoscore
+        self.nova = nova
+        self.labels = intern_tags(labels)
+        self.is_organic = is_organic
+        self.is_vegan = is_vegan
+        self.is_palm_oil_free = is_palm_oil_free
+        self.is_fair_trade = is_fair_trade
+        self.brand_ethics_score = brand_ethics_score
+        self.categories = intern_tags(categories)
+        self.countries = intern_tags(countries)
+
+
+class RecallRecord(_Record):
+    __slots__ = ('has_recalls', 'recall_count', 'latest_recall')
+    FIELDS = __slots__
+
+    def __init__(self, has_recalls: bool = False, recall_count: int = 0, latest_recall: str = ''):
+        self.has_recalls = has_recalls
+        self.recall_count = recall_count
+        self.latest_recall = latest_recall
+
+
+class ScoreRecord(_Record):
+    __slots__ = ('overall', 'health', 'environmental', 'social', 'animal')
+    FIELDS = __slots__
+
+    def __init__(self, overall: int, health: int, environmental: int, social: int, animal: int):
+        self.overall = overall
+        self.health = health
+        self.environmental = environmental
+        self.social = social
+        self.animal = animal
+
+
+class AnalysisRecord(_Record):
+    """A product that was found and scored. Lookups that find nothing stay plain dicts."""
+    __slots__ = ('product', 'fda', 'scores', 'query')
+    FIELDS = ('found',) + __slots__
+    found = True
+
+    def __init__(self, product: ProductRecord, fda: Optional[RecallRecord], scores: ScoreRecord, query: str = ''):
+        self.product = product
+        self.fda = fda
+        self.scores = scores
+        self.query = query
+
+
+# Binary encoding: a fixed struct header followed by every string field and tag,
+# UTF-8 encoded and NUL-separated, so decoding is one unpack, one decode and one split
+ENCODING_VERSION = 1
+# version, flags, nova, brand ethics, 5 scores, recall count, label/category/country counts
+_HEADER = struct.Struct('<BBbh5BH3H')
+_NO_NOVA = -1
+_NO_ETHICS = -32768
+_SEPARATOR = '\x00'
+
+_IS_ORGANIC = 1 << 0
+_IS_VEGAN = 1 << 1
+_IS_PALM_OIL_FREE = 1 << 2
+_IS_FAIR_TRADE = 1 << 3
+_HAS_FDA = 1 << 4
+_HAS_RECALLS = 1 << 5
+
+
+def encode_analysis(analysis: AnalysisRecord) -> bytes:
+    product, fda, scores = analysis.product, analysis.fda, analysis.scores
+    flags = ((_IS_ORGANIC if product.is_organic else 0) | (_IS_VEGAN if product.is_vegan else 0)
+             | (_IS_PALM_OIL_FREE if product.is_palm_oil_free else 0)
+             | (_IS_FAIR_TRADE if product.is_fair_trade else 0))
+    if fda is not None:
+        flags |= _HAS_FDA | (_HAS_RECALLS if fda.has_recalls else 0)
+
+    nova = product.nova if isinstance(product.nova, int) and -1 < product.nova < 128 else _NO_NOVA
+    ethics = product.brand_ethics_score
+    ethics = int(ethics) if isinstance(ethics, (int, float)) and -32768 < ethics < 32768 else _NO_ETHICS
+    labels, categories, countries = product.labels[:0xFFFF], product.categories[:0xFFFF], product.countries[:0xFFFF]
+    header = _HEADER.pack(
+        ENCODING_VERSION, flags, nova, ethics,
+        scores.overall, scores.health, scores.environmental, scores.social, scores.animal,
+        min(fda.recall_count if fda else 0, 0xFFFF),
+        len(labels), len(categories), len(countries),
+    )
+    texts = [analysis.query, product.code, product.name, product.brand,
+             product.nutriscore, product.ecoscore, fda.latest_recall if fda else '']
+    fields = [str(text or '').replace(_SEPARATOR, '') for text in texts]
+    fields.extend(labels)
+    fields.extend(categories)
+    fields.extend(countries)
+    return header + _SEPARATOR.join(fields).encode('utf-8')
+
+
+def decode_analysis(data: bytes) -> AnalysisRecord:
+    (version, flags, nova, ethics, overall, health, environmental, social, animal,
+     recall_count, n_labels, n_categories, n_countries) = _HEADER.unpack_from(data)
+    if version != ENCODING_VERSION:
+        raise ValueError(f"Unsupported analysis encoding version {version}")
+
+    fields = data[_HEADER.size:].decode('utf-8').split(_SEPARATOR)
+    query, code, name, brand, nutriscore, ecoscore, latest_recall = fields[:7]
+    labels_end = 7 + n_labels
+    categories_end = labels_end + n_categories
+
+    product = ProductRecord(
+        code=code, name=name, brand=brand, nutriscore=nutriscore, ecoscore=ecoscore,
+        nova=None if nova == _NO_NOVA else nova, labels=fields[7:labels_end],
+        is_organic=bool(flags & _IS_ORGANIC), is_vegan=bool(flags & _IS_VEGAN),
+        is_palm_oil_free=bool(flags & _IS_PALM_OIL_FREE), is_fair_trade=bool(flags & _IS_FAIR_TRADE),
+        brand_ethics_score=None if ethics == _NO_ETHICS else ethics,
+        categories=fields[labels_end:categories_end],
+        countries=fields[categories_end:categories_end + n_countries],
+    )
+    fda = None
+    if flags & _HAS_FDA:
+        fda = RecallRecord(bool(flags & _HAS_RECALLS), recall_count, latest_recall)
+    return AnalysisRecord(product, fda, ScoreRecord(overall, health, environmental, social, animal), query)
+
+
+def analysis_from_dict(analysis: Dict) -> AnalysisRecord:
+    """Rebuild a record from the JSON shape stored before records existed."""
+    product = analysis['product']
+    fda = analysis.get('fda')
+    return AnalysisRecord(
+        ProductRecord(**{key: product[key] for key in ProductRecord.__slots__ if key in product}),
+        RecallRecord(**{key: fda[key] for key in RecallRecord.__slots__ if key in fda}) if fda else None,
+        ScoreRecord(**analysis['scores']),
+        analysis.get('query', ''),
+    )
@@ -0,0 +1,95 @@
+"""Redis memory usage by key family.
+
+    python -m app.services.redis_memory
+    python -m app.services.redis_memory --match 'whatsapp_twilio_demo_*' --apply-ttls
+
+Keys are grouped by replacing phone numbers, message SIDs and hashes with a
+placeholder, e.g. `user_location_{id}`. For each family it prints the key count,
+total and average MEMORY USAGE, and how many keys have no expiry.
+`--apply-ttls` gives keys of the per-user families that have no expiry (written
+before TTLs existed) their configured TTL.
+"""
+import argparse
+import re
+from typing import Dict
+
+from app.cookies_utils import CONTEXT_TTL, HISTORY_TTL, LOCATION_TTL
+from app.redis_utils import redis_conn
+
+# Phone numbers (optionally with the whatsapp: prefix), Twilio SIDs, hex digests, rate windows
+ID_PATTERN = re.compile(r'(whatsapp:)?\+?\d{6,}|\b(SM|MM)[0-9a-f]{32}|[0-9a-f]{32,}')
+
+FAMILY_TTLS = {
+    'whatsapp_twilio_demo_{id}_history': HISTORY_TTL,
+    'user_location_{id}': LOCATION_TTL,
+    'noura_context_{id}': CONTEXT_TTL,
+}
+
+
+def key_family(key: str) -> str:
+    return ID_PATTERN.sub('{id}', key)
+
+
+def memory_by_family(client=redis_conn, match: str = '*', batch: int = 500, apply_ttls: bool = False) -> Dict[str, dict]:
+    families: Dict[str, dict] = {}
+    keys = []
+
+    def flush():
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.memory_usage(key, samples=0)
+            pipe.ttl(key)
+        results = pipe.execute()
+        expire = client.pipeline(transaction=False)
+        for i, key in enumerate(keys):
+            size, ttl = results[2 * i], results[2 * i + 1]
+            if size is None:
+                continue  # expired between SCAN and MEMORY USAGE
+            name = key_family(key.decode('utf-8', 'replace'))
+            stats = families.setdefault(name, {'keys': 0, 'bytes': 0, 'no_ttl': 0})
+            stats['keys'] += 1
+            stats['bytes'] += size
+            if ttl == -1:
+                stats['no_ttl'] += 1
+                if apply_ttls and name in FAMILY_TTLS:
+                    expire.expire(key, FAMILY_TTLS[name])
+                    stats['expired'] = stats.get('expired', 0) + 1
+        expire.execute()
+        keys.clear()
+
+    for key in client.scan_iter(match=match, count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            flush()
+    if keys:
+        flush()
+    return families
+
+
+def format_report(families: Dict[str, dict]) -> str:
+    width = max([len(name) for name in families] + [6])
+    lines = [f"{'family':{width}} {'keys':>9} {'total':>11} {'avg/key':>9} {'no ttl':>8}"]
+    rows = sorted(families.items(), key=lambda item: item[1]['bytes'], reverse=True)
+    for name, stats in rows:
+        line = (f"{name:{width}} {stats['keys']:9d} {stats['bytes'] / 1024:9.1f} K "
+                f"{stats['bytes'] / stats['keys']:7.0f} B {stats['no_ttl']:8d}")
+        if stats.get('expired'):
+            line += f"  (ttl set on {stats['expired']})"
+        lines.append(line)
+    total_keys = sum(s['keys'] for s in families.values())
+    total_bytes = sum(s['bytes'] for s in families.values())
+    lines.append(f"{'total':{width}} {total_keys:9d} {total_bytes / 1024:9.1f} K")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--match", default='*', help="SCAN pattern")
+    parser.add_argument("--batch", type=int, default=500, help="keys per SCAN/pipeline round trip")
+    parser.add_argument("--apply-ttls", action='store_true', help="set the configured TTL on per-user keys without one")
+    args = parser.parse_args()
+    print(format_report(memory_by_family(match=args.match, batch=args.batch, apply_ttls=args.apply_ttls)))
+
+
+if __name__ == '__main__':
+    main()
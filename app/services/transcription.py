@@ -0,0 +1,303 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.rate_limit_utils import acall_openai
+from app.redis_utils import redis_conn
+from app.tracing_utils import span, set_attributes
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "whisper-1")
+TRANSCRIPT_CACHE_TTL = int(os.getenv("TRANSCRIPT_CACHE_TTL", str(7 * 24 * 3600)))
+# Set to 0 to upload voice notes as received
+TRIM_SILENCE = os.getenv("TRIM_SILENCE", "1") == "1"
+SILENCE_THRESHOLD_DB = os.getenv("SILENCE_THRESHOLD_DB", "-45dB")
+
+# Long notes are split at pauses and the segments transcribed in parallel
+CHUNKED_TRANSCRIPTION = os.getenv("CHUNKED_TRANSCRIPTION", "1") == "1"
+CHUNK_MIN_DURATION = float(os.getenv("CHUNK_MIN_DURATION", "45"))
+SEGMENT_MAX_SECONDS = float(os.getenv("SEGMENT_MAX_SECONDS", "30"))
+SEGMENT_MIN_SECONDS = float(os.getenv("SEGMENT_MIN_SECONDS", "10"))
+SEGMENT_OVERLAP_SECONDS = float(os.getenv("SEGMENT_OVERLAP_SECONDS", "0.5"))
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", "4"))
+
+# Language hint for Whisper from the country code stored by UserContext
+COUNTRY_LANGUAGES = {
+    'AR': 'es', 'BO': 'es', 'CL': 'es', 'CO': 'es', 'CR': 'es', 'EC': 'es', 'ES': 'es',
+    'GT': 'es', 'MX': 'es', 'PA': 'es', 'PE': 'es', 'PY': 'es', 'UY': 'es', 'VE': 'es',
+    'BR': 'pt', 'PT': 'pt',
+    'FR': 'fr', 'BE': 'fr',
+    'US': 'en', 'GB': 'en', 'CA': 'en', 'AU': 'en', 'NZ': 'en', 'IE': 'en',
+    'DE': 'de', 'AT': 'de', 'IT': 'it', 'NL': 'nl',
+}
+
+CONTENT_TYPE_EXTENSIONS = {
+    'audio/ogg': 'ogg',
+    'audio/opus': 'ogg',
+    'audio/mpeg': 'mp3',
+    'audio/mp4': 'm4a',
+    'audio/aac': 'm4a',
+    'audio/wav': 'wav',
+    'audio/webm': 'webm',
+}
+
+
+def language_for_location(location: Optional[dict]) -> Optional[str]:
+    """Whisper language hint for a stored user location, or None to let the model auto-detect."""
+    if not location:
+        return None
+    return COUNTRY_LANGUAGES.get(str(location.get('country', '')).upper())
+
+
+def is_ogg_opus(audio_data: bytes) -> bool:
+    """Whether the audio is Opus in an Ogg container (the first page carries the OpusHead header)."""
+    return audio_data[:4] == b'OggS' and b'OpusHead' in audio_data[:64]
+
+
+def plan_segments(duration: float, silences: List[Tuple[float, float]],
+                  max_len: float = SEGMENT_MAX_SECONDS, min_len: float = SEGMENT_MIN_SECONDS) -> List[Tuple[float, float]]:
+    """Split [0, duration] into segments of at most `max_len` seconds.
+
+    Each cut is placed in the middle of the latest pause that keeps the segment
+    within bounds; when there is no pause, the segment is cut hard at `max_len`.
+    """
+    cut_points = sorted((start + end) / 2 for start, end in silences)
+    segments = []
+    start = 0.0
+    while duration - start > max_len:
+        candidates = [c for c in cut_points if start + min_len <= c <= start + max_len]
+        end = candidates[-1] if candidates else start + max_len
+        segments.append((start, end))
+        start = end
+    segments.append((start, duration))
+    return segments
+
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r'[^\w]', '', word.lower())
+
+
+def stitch_transcripts(texts: List[str], max_overlap_words: int = 8) -> str:
+    """Join segment transcripts in order, dropping words repeated across overlapping boundaries."""
+    words = []
+    for text in texts:
+        segment_words = text.split()
+        if not segment_words:
+            continue
+        tail = [_normalize_word(w) for w in words[-max_overlap_words:]]
+        head = [_normalize_word(w) for w in segment_words[:max_overlap_words]]
+        overlap = 0
+        for k in range(min(len(tail), len(head)), 0, -1):
+            if tail[-k:] == head[:k]:
+                overlap = k
+                break
+        words.extend(segment_words[overlap:])
+    return ' '.join(words)
+
+
+class AudioTranscriber:
+    """Transcribes voice notes in memory, caching transcripts by audio content hash"""
+
+    def __init__(self, redis_client=redis_conn, cache_ttl: int = TRANSCRIPT_CACHE_TTL):
+        self.redis_client = redis_client
+        self.cache_ttl = cache_ttl
+        self._client = None
+        self.ffmpeg = shutil.which('ffmpeg')
+
+    @property
+    def client(self):
+        # One client (and connection pool) per process instead of one per voice note
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+        return self._client
+
+    @staticmethod
+    def _cache_key(audio_data: bytes, language: Optional[str]) -> str:
+        digest = hashlib.sha256(audio_data).hexdigest()
+        return f"noura_transcript_{digest}_{language or 'auto'}"
+
+    def _get_cached(self, key: str) -> Optional[str]:
+        if self.redis_client is None:
+            return None
+        try:
+            cached = self.redis_client.get(key)
+            return cached.decode('utf-8') if cached else None
+        except Exception as e:
+            logger.error(f"Transcript cache read failed: {e}")
+            return None
+
+    def _set_cached(self, key: str, text: str):
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.set(key, text, ex=self.cache_ttl)
+        except Exception as e:
+            logger.error(f"Transcript cache write failed: {e}")
+
+    async def trim_silence(self, audio_data: bytes) -> bytes:
+        """Strip leading and trailing silence with ffmpeg over pipes; returns the input if unavailable."""
+        if not (TRIM_SILENCE and self.ffmpeg):
+            return audio_data
+
+        # Trim the start, reverse, trim the (former) end, reverse back
+        silence = f"silenceremove=start_periods=1:start_silence=0.2:start_threshold={SILENCE_THRESHOLD_DB}"
+        audio_filter = f"{silence},areverse,{silence},areverse"
+        try:
+            returncode, trimmed, stderr = await self._run_ffmpeg(
+                ['-loglevel', 'error', '-i', 'pipe:0', '-af', audio_filter,
+                 '-c:a', 'libopus', '-b:a', '24k', '-f', 'ogg', 'pipe:1'],
+                audio_data,
+            )
+        except Exception as e:
+            logger.error(f"Silence trimming failed: {e}")
+            return audio_data
+
+        if returncode != 0 or not trimmed:
+            logger.error(f"Silence trimming failed: {stderr.decode('utf-8', 'ignore')[:200]}")
+            return audio_data
+
+        # A note that is all silence, or a re-encode that grew, is sent as-is
+        if len(trimmed) >= len(audio_data):
+            return audio_data
+        return trimmed
+
+    async def _run_ffmpeg(self, args: list, audio_data: bytes) -> Tuple[int, bytes, bytes]:
+        process = await asyncio.create_subprocess_exec(
+            self.ffmpeg, '-hide_banner', *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate(audio_data)
+        return process.returncode, stdout, stderr
+
+    async def probe_silences(self, audio_data: bytes) -> Tuple[float, List[Tuple[float, float]]]:
+        """Return the duration of the audio and its (start, end) pauses in seconds."""
+        returncode, _, stderr = await self._run_ffmpeg(
+            ['-i', 'pipe:0', '-af', f'silencedetect=noise={SILENCE_THRESHOLD_DB}:d=0.4',
+             '-f', 'null', '-'],
+            audio_data,
+        )
+        output = stderr.decode('utf-8', 'ignore')
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg silencedetect failed: {output[-200:]}")
+
+        # Piped input has no container duration; use the last decoded timestamp
+        times = re.findall(r'time=(\d+):(\d+):([\d.]+)', output)
+        duration = 0.0
+        if times:
+            hours, minutes, seconds = times[-1]
+            duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+        starts = [float(x) for x in re.findall(r'silence_start: ([\d.]+)', output)]
+        ends = [float(x) for x in re.findall(r'silence_end: ([\d.]+)', output)]
+        return duration, list(zip(starts, ends))
+
+    async def extract_segment(self, audio_data: bytes, start: float, end: float) -> bytes:
+        """Cut [start, end] seconds out of the audio as Ogg/Opus."""
+        if is_ogg_opus(audio_data):
+            # Stream copy cuts on Opus packet boundaries (20 ms) without decoding or re-encoding
+            codec = ['-c:a', 'copy']
+        else:
+            # AAC/MP3/AMR notes (when trimming is off or failed) cannot be copied into Ogg
+            codec = ['-c:a', 'libopus', '-b:a', '24k']
+        returncode, segment, stderr = await self._run_ffmpeg(
+            ['-loglevel', 'error', '-i', 'pipe:0', '-ss', f'{start:.3f}', '-t', f'{end - start:.3f}',
+             *codec, '-f', 'ogg', 'pipe:1'],
+            audio_data,
+        )
+        if returncode != 0 or not segment:
+            raise RuntimeError(f"ffmpeg segment extraction failed: {stderr.decode('utf-8', 'ignore')[:200]}")
+        return segment
+
+    async def _transcribe_upload(self, upload: bytes, extension: str, content_type: str,
+                                 language: Optional[str]) -> str:
+        params = {
+            'model': WHISPER_MODEL,
+            'file': (f"voice.{extension}", upload, content_type),
+        }
+        if language:
+            params['language'] = language
+        with span('openai.transcription', **{'llm.request.model': WHISPER_MODEL, 'llm.request.bytes': len(upload),
+                                             'llm.request.language': language}):
+            transcript = await acall_openai(WHISPER_MODEL, 0, self.client.audio.transcriptions.with_raw_response.create,
+                                            **params)
+        return transcript.text
+
+    async def transcribe_chunked(self, audio_data: bytes, language: Optional[str] = None) -> Optional[str]:
+        """Transcribe long audio as parallel segments cut at pauses.
+
+        Returns None when the audio is short enough to be sent as a single upload.
+        """
+        duration, silences = await self.probe_silences(audio_data)
+        if duration < CHUNK_MIN_DURATION:
+            return None
+
+        segments = plan_segments(duration, silences)
+        semaphore = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+        async def transcribe_segment(start: float, end: float) -> str:
+            async with semaphore:
+                # Pad both sides so words cut at a hard boundary appear whole in one of the segments
+                segment = await self.extract_segment(
+                    audio_data,
+                    max(0.0, start - SEGMENT_OVERLAP_SECONDS),
+                    min(duration, end + SEGMENT_OVERLAP_SECONDS),
+                )
+                return await self._transcribe_upload(segment, 'ogg', 'audio/ogg', language)
+
+        texts = await asyncio.gather(*(transcribe_segment(start, end) for start, end in segments))
+        logger.info(f"Transcribed {duration:.1f}s of audio as {len(segments)} segments")
+        return stitch_transcripts(texts)
+
+    async def transcribe(self, audio_data: bytes, content_type: str = 'audio/ogg',
+                         language: Optional[str] = None) -> str:
+        """Transcribe audio bytes. `language=None` lets Whisper auto-detect."""
+        cache_key = self._cache_key(audio_data, language)
+        cached = self._get_cached(cache_key)
+        set_attributes(**{'noura.transcript_cache.hit': cached is not None})
+        if cached is not None:
+            logger.info("Transcript cache hit")
+            return cached
+
+        upload = await self.trim_silence(audio_data)
+
+        text = None
+        if CHUNKED_TRANSCRIPTION and self.ffmpeg:
+            try:
+                text = await self.transcribe_chunked(upload, language)
+            except Exception as e:
+                logger.error(f"Chunked transcription failed, sending as a single upload: {e}")
+
+        if text is None:
+            if upload is not audio_data:
+                extension = 'ogg'
+                content_type = 'audio/ogg'
+            else:
+                extension = CONTENT_TYPE_EXTENSIONS.get((content_type or '').split(';')[0], 'ogg')
+            text = await self._transcribe_upload(upload, extension, content_type, language)
+            logger.info(f"Transcribed {len(upload)} bytes (received {len(audio_data)})")
+
+        self._set_cached(cache_key, text)
+        return text
+
+
+audio_transcriber = AudioTranscriber()
+
+
+async def transcribe_audio(audio_data: bytes, content_type: str = 'audio/ogg',
+                           language: Optional[str] = None) -> str:
+    with span('transcribe', **{'noura.audio.bytes': len(audio_data), 'noura.audio.content_type': content_type}):
+        return await audio_transcriber.transcribe(audio_data, content_type, language)
@@ -0,0 +1,159 @@
+"""OpenTelemetry spans for the webhook pipeline, off unless TRACING=1.
+
+Spans cover the webhook steps and pipeline stages, Open Food Facts / openFDA
+calls, every OpenAI call (fallbacks included), Twilio sends and media downloads,
+and Redis commands (with opentelemetry-instrumentation-redis installed). Only a
+TRACING_SAMPLE_RATE fraction of requests is recorded, and spans are exported in
+batches from a background thread, so the request path pays for little more than
+creating the span objects. Unsampled requests and TRACING=0 get a shared no-op span.
+
+    TRACING=1 TRACING_EXPORTER=file TRACING_FILE=./logs/traces.jsonl    # one JSON span per line
+    TRACING=1 TRACING_EXPORTER=otlp OTEL_EXPORTER_OTLP_ENDPOINT=http://localhost:4318
+
+The SDK is set up lazily in each process (gunicorn workers fork after preload, and
+the exporter thread does not survive a fork).
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from app.logger_utils import logger
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+load_dotenv()
+
+TRACING = os.getenv("TRACING", "0") == "1"
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "0.05"))
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "file")  # file | otlp
+TRACING_FILE = os.getenv("TRACING_FILE", os.path.join(os.getenv("LOG_DIR", "./logs"), "traces.jsonl"))
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "noura-whatsapp-bot")
+
+_tracer = None
+_tracer_pid = None
+_lock = threading.Lock()
+
+
+class _NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def is_recording(self) -> bool:
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _file_exporter():
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+    os.makedirs(os.path.dirname(TRACING_FILE) or '.', exist_ok=True)
+    out = open(TRACING_FILE, 'a', encoding='utf-8')
+    return ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + '\n')
+
+
+def _otlp_exporter():
+    # Endpoint and headers come from the standard OTEL_EXPORTER_OTLP_* variables
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+    return OTLPSpanExporter()
+
+
+def _setup():
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    provider = TracerProvider(
+        resource=Resource.create({'service.name': TRACING_SERVICE_NAME, 'process.pid': os.getpid()}),
+        # Children follow the root's decision, so a sampled request is traced end to end
+        sampler=ParentBased(TraceIdRatioBased(TRACING_SAMPLE_RATE)),
+    )
+    exporter = _otlp_exporter() if TRACING_EXPORTER == 'otlp' else _file_exporter()
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    try:
+        from opentelemetry.instrumentation.redis import RedisInstrumentor
+
+        RedisInstrumentor().instrument(tracer_provider=provider)
+    except ImportError:
+        logger.info("opentelemetry-instrumentation-redis not installed; Redis commands are not traced")
+    logger.info(f"Tracing {TRACING_SAMPLE_RATE:.0%} of requests to {TRACING_EXPORTER}")
+    return provider.get_tracer('app')
+
+
+def get_tracer():
+    """This process's tracer, or None when tracing is off or OpenTelemetry is missing."""
+    global _tracer, _tracer_pid, TRACING
+    if not TRACING:
+        return None
+    if _tracer_pid != os.getpid():
+        with _lock:
+            if _tracer_pid != os.getpid():
+                if trace is None:
+                    logger.error("TRACING=1 but opentelemetry-sdk is not installed; tracing disabled")
+                    TRACING = False
+                    return None
+                try:
+                    _tracer = _setup()
+                except Exception as e:
+                    logger.error(f"Tracing setup failed: {e}")
+                    TRACING = False
+                    return None
+                _tracer_pid = os.getpid()
+    return _tracer
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Child of the current span (or a new trace); yields a span with set_attribute(s)."""
+    tracer = get_tracer()
+    if tracer is None:
+        yield NOOP_SPAN
+        return
+    with tracer.start_as_current_span(name) as current:
+        if current.is_recording() and attributes:
+            current.set_attributes({k: v for k, v in attributes.items() if v is not None})
+        yield current if current.is_recording() else NOOP_SPAN
+
+
+def set_attributes(**attributes):
+    """Add attributes to the current span, if it is being recorded."""
+    if not TRACING or trace is None:
+        return
+    current = trace.get_current_span()
+    if current.is_recording():
+        current.set_attributes({k: v for k, v in attributes.items() if v is not None})
+
+
+@contextmanager
+def llm_span(name: str, model: str, messages: list, **attributes):
+    """Span for one model call; request size is only measured when the span is recorded."""
+    with span(name, **{'llm.request.model': model, 'llm.request.messages': len(messages)}, **attributes) as current:
+        if current.is_recording():
+            current.set_attribute('llm.request.bytes', len(json.dumps(messages, ensure_ascii=False, default=str)))
+        yield current
+
+
+def record_usage(target, response):
+    """Model and token counts of an OpenAI/litellm response as attributes of `target`."""
+    if not target.is_recording() or response is None:
+        return
+    usage = getattr(response, 'usage', None)
+    details = getattr(usage, 'prompt_tokens_details', None)
+    target.set_attributes({
+        'llm.response.model': getattr(response, 'model', '') or '',
+        'llm.usage.prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'llm.usage.completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+        'llm.usage.cached_tokens': (getattr(details, 'cached_tokens', 0) or 0) if details else 0,
+    })
@@ -0,0 +1,63 @@
+"""Queue worker: answers the messages the webhook enqueues when QUEUE_MODE=1.
+
+    python -m app.worker --concurrency 8 --metrics-port 9101
+
+Run as many of these as needed, on any number of hosts sharing the Redis. Each
+user's messages are answered one at a time and in order; see app/queue_utils.py.
+SIGTERM/SIGINT finish the messages in progress and exit. Prometheus metrics
+(including noura_queue_lag_seconds) are served on --metrics-port.
+"""
+import argparse
+import asyncio
+import os
+import signal
+
+from aiohttp import web
+
+from app.logger_utils import logger
+from app.main import process_queued_message, warm_shared_state
+from app.metrics_utils import render_metrics
+from app.queue_utils import QUEUE_WORKER_CONCURRENCY, QueueWorker, update_queue_gauges
+
+QUEUE_WORKER_METRICS_PORT = int(os.getenv("QUEUE_WORKER_METRICS_PORT", "9101"))
+
+
+async def serve_metrics(port: int) -> web.AppRunner:
+    async def metrics(request: web.Request) -> web.Response:
+        await asyncio.to_thread(update_queue_gauges)
+        return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    return runner
+
+
+async def run(concurrency: int, metrics_port: int):
+    worker = QueueWorker(process_queued_message, concurrency=concurrency)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.stop)
+    runner = await serve_metrics(metrics_port) if metrics_port else None
+    try:
+        await worker.run()
+    finally:
+        if runner:
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=QUEUE_WORKER_CONCURRENCY,
+                        help="messages answered at once by this process")
+    parser.add_argument("--metrics-port", type=int, default=QUEUE_WORKER_METRICS_PORT, help="0 to disable")
+    args = parser.parse_args()
+    warm_shared_state()
+    asyncio.run(run(args.concurrency, args.metrics_port))
+    logger.info("Worker exited")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Lookup latency of the precomputed alternatives index on a synthetic catalog.
+
+    python -m benchmarks.bench_alternatives --products 200000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from app.services.alternatives import AlternativesIndex
+
+GRADES = ['a', 'b', 'c', 'd', 'e', 'unknown']
+COUNTRIES = ['en:colombia', 'en:mexico', 'en:spain', 'en:france', 'en:united-states', 'en:peru']
+
+
+def synthetic_product(i: int, n_categories: int) -> dict:
+    family = random.randrange(n_categories // 10)
+    return {
+        'code': f"{i:013d}",
+        'name': f"Producto {i}",
+        'brand': f"Marca {i % 500}",
+        'nutriscore': random.choice(GRADES),
+        'ecoscore': random.choice(GRADES),
+        'categories': [f"en:family-{family}", f"en:category-{family}-{random.randrange(10)}"],
+        'countries': random.sample(COUNTRIES, random.randint(1, 3)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=200000)
+    parser.add_argument("--categories", type=int, default=2000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    products = [synthetic_product(i, args.categories) for i in range(args.products)]
+
+    start = time.perf_counter()
+    index = AlternativesIndex()
+    for product in products:
+        index.add(product, random.randint(0, 100))
+    print(f"built index of {len(index)} products in {time.perf_counter() - start:.2f}s")
+
+    timings = []
+    for _ in range(args.lookups):
+        product = random.choice(products)
+        country = random.choice(COUNTRIES + [None])
+        start = time.perf_counter()
+        index.better_than(product, random.randint(0, 100), country)
+        timings.append((time.perf_counter() - start) * 1e3)
+    timings.sort()
+    print(f"lookup p50 {statistics.median(timings):.3f} ms   p99 {timings[int(len(timings) * 0.99)]:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
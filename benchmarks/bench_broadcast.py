@@ -0,0 +1,138 @@
+"""Throughput, resume and duplicate check of a broadcast against the Twilio stand-in.
+
+    python -m benchmarks.bench_broadcast --users 5000 --rate 50 --twilio-rate 40 --interrupt-after 20
+    python -m benchmarks.bench_broadcast --audience users --country Colombia
+
+Seeds synthetic users in Redis (REDIS_HOST/REDIS_PORT): their scans, conversation
+history and location. A share of them scanned the recalled product, the rest are
+spread over a few countries, and a few have invalid numbers. It then runs a recall
+broadcast (or, with --audience users, one to the users in --country) against
+the stand-in. With --interrupt-after, the first run is cancelled after that many
+seconds, as if the process died, and the same broadcast is run again to finish. It
+reports the counts from the checkpoint, the stand-in's view (messages received,
+429s, recipients messaged twice or never) and the send rate. The seeded keys and the
+broadcast's checkpoint are deleted at the end.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+import uuid
+
+from app.cookies_utils import set_cookies
+from app.redis_utils import redis_conn
+from app.services.broadcast import (Broadcast, RecallAudience, RECALL_TEMPLATE, UserAudience, country_code,
+                                    run_broadcast, summary)
+from benchmarks.standins import make_twilio_app, start_server
+
+ACCOUNT_SID = 'AC' + '0' * 32
+RECALLED_CODE = '7709999000017'
+PHONE_PREFIX = '5799'
+COUNTRIES = [{'country': 'CO', 'city': 'Bogotá'}, {'country': 'MX', 'city': 'Ciudad de México'},
+             {'country': 'ES', 'city': 'Madrid'}]
+
+
+def seed_users(count: int, recalled_share: float, invalid_share: float) -> tuple:
+    """Write the users' scans, history and location.
+
+    Return the valid numbers that scanned the recalled product, the invalid numbers
+    and the valid numbers by country.
+    """
+    recalled, invalid = set(), set()
+    by_country = collections.defaultdict(set)
+    pipe = redis_conn.pipeline(transaction=False)
+    for i in range(count):
+        phone = f"{PHONE_PREFIX}{i:08d}"
+        scans = {f"770{random.randint(0, 10 ** 10):010d}": json.dumps({'name': 'Galletas de avena', 'brand': 'Bench'})
+                 for _ in range(random.randint(1, 4))}
+        if random.random() < recalled_share:
+            scans[RECALLED_CODE] = json.dumps({'name': 'Yogur griego natural', 'brand': 'Bench Lácteos'})
+            recalled.add(phone)
+        pipe.hset(f"noura_scanned_{phone}", mapping=scans)
+        pipe.expire(f"noura_scanned_{phone}", 3600)
+        location = random.choice(COUNTRIES)
+        set_cookies(pipe, f"whatsapp_twilio_demo_{phone}_history", [], ttl=3600)
+        set_cookies(pipe, f"user_location_{phone}", location, ttl=3600)
+        if random.random() < invalid_share:
+            invalid.add(phone)
+        by_country[location['country']].add(phone)
+        if i % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+    return recalled - invalid, invalid, {country: phones - invalid for country, phones in by_country.items()}
+
+
+def cleanup(broadcast: Broadcast):
+    keys = [key for pattern in (f"noura_scanned_{PHONE_PREFIX}*", f"whatsapp_twilio_demo_{PHONE_PREFIX}*_history",
+                                f"user_location_{PHONE_PREFIX}*")
+            for key in redis_conn.scan_iter(match=pattern, count=1000)]
+    for start in range(0, len(keys), 1000):
+        redis_conn.delete(*keys[start:start + 1000])
+    redis_conn.delete(broadcast.state_key, broadcast.outcomes_key, broadcast.deferred_key)
+
+
+async def bench(args):
+    random.seed(0)
+    recalled, invalid, by_country = seed_users(args.users, args.recalled, args.invalid)
+    app = make_twilio_app(latency=args.latency, jitter=args.latency / 2, error_rate=args.error_rate,
+                          rate=args.twilio_rate, invalid_numbers={f"+{phone}" for phone in invalid})
+    runner, url = await start_server(app)
+    client_options = {'account_sid': ACCOUNT_SID, 'auth_token': 'stand-in', 'base_url': url}
+    broadcast_id = f"bench-{uuid.uuid4().hex[:8]}"
+
+    if args.audience == 'users':
+        expected = by_country.get(country_code(args.country), set())
+        audience, template = UserAudience(args.country), "Novedades de NOURA para {country} ({city})."
+        print(f"{args.users} users, {len(expected)} in {args.country} ({len(invalid)} invalid numbers in all)")
+    else:
+        expected = recalled
+        audience, template = RecallAudience([RECALLED_CODE], reason="Lote contaminado."), RECALL_TEMPLATE
+        print(f"{args.users} users, {len(recalled)} scanned the recalled product ({len(invalid)} invalid numbers in all)")
+
+    def new_broadcast():
+        return Broadcast(broadcast_id, audience, template, rate=args.rate, concurrency=args.concurrency)
+
+    started = time.monotonic()
+    try:
+        if args.interrupt_after:
+            try:
+                await asyncio.wait_for(run_broadcast(new_broadcast(), **client_options), args.interrupt_after)
+                print("finished before the interruption")
+            except asyncio.TimeoutError:
+                print(f"interrupted after {args.interrupt_after:.0f} s: {summary(new_broadcast().status())}")
+        state = await run_broadcast(new_broadcast(), **client_options)
+        elapsed = time.monotonic() - started
+        print(summary(state))
+
+        received = collections.Counter(to.replace('whatsapp:+', '') for to, _ in app['sent'])
+        twice = [phone for phone, count in received.items() if count > 1]
+        missing = expected - set(received)
+        strays = set(received) - expected
+        print(f"stand-in: {len(app['sent'])} messages received in {elapsed:.1f} s "
+              f"({len(app['sent']) / elapsed:.1f} msg/s), {app['rate_limited']} answered 429")
+        print(f"recipients messaged twice {len(twice)}, never {len(missing)}, not in the audience {len(strays)}")
+    finally:
+        await runner.cleanup()
+        cleanup(new_broadcast())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--audience", choices=['recall', 'users'], default='recall')
+    parser.add_argument("--country", default='Colombia', help="users audience: country name or ISO code")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--recalled", type=float, default=0.3, help="share of users who scanned the product")
+    parser.add_argument("--invalid", type=float, default=0.02, help="share of those with an invalid number")
+    parser.add_argument("--rate", type=float, default=50, help="broadcast messages per second")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--twilio-rate", type=float, default=0, help="stand-in throughput limit (msg/s), 0 for none")
+    parser.add_argument("--latency", type=float, default=0.15, help="stand-in latency per message (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of stand-in requests failing with 503")
+    parser.add_argument("--interrupt-after", type=float, default=0, help="cancel the first run after N s, then resume")
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Bulk catalog scoring against the OFF/FDA stand-ins, including a crash and resume.
+
+    python -m benchmarks.bench_bulk_scoring --rows 2000 --concurrency 32 --rate 200
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import tempfile
+
+from app.services.bulk_scoring import load_checkpoint, score_catalog
+from app.services.product_analyzer import ProductAnalyzer
+from benchmarks.standins import FIXTURE_CATALOG, make_fda_app, make_off_app, start_server
+
+
+def write_input(path: str, rows: int):
+    with open(FIXTURE_CATALOG, encoding='utf-8') as f:
+        products = [json.loads(line) for line in f if line.strip()]
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['query'])
+        for i in range(rows):
+            kind = random.random()
+            if kind < 0.6:
+                writer.writerow([random.choice(products)['code']])
+            elif kind < 0.9:
+                writer.writerow([random.choice(products)['product_name']])
+            else:
+                writer.writerow([f"{7800000000000 + i}"])
+
+
+async def run(args):
+    off_runner, off_url = await start_server(make_off_app(latency=args.latency, error_rate=args.error_rate))
+    fda_runner, fda_url = await start_server(make_fda_app(latency=args.latency))
+    workdir = tempfile.mkdtemp()
+    input_path = os.path.join(workdir, 'skus.csv')
+    output_path = os.path.join(workdir, 'scores.jsonl')
+    write_input(input_path, args.rows)
+
+    def analyzer():
+        return ProductAnalyzer(off_base_url=f"{off_url}/api/v2", fda_base_url=fda_url)
+
+    try:
+        # Simulate a crash partway through
+        task = asyncio.create_task(score_catalog(input_path, output_path, args.concurrency, args.rate, analyzer()))
+        await asyncio.sleep(args.crash_after)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        print(f"crashed after {args.crash_after}s with {len(load_checkpoint(output_path))} rows checkpointed")
+
+        stats = await score_catalog(input_path, output_path, args.concurrency, args.rate, analyzer())
+        print(stats.summary())
+        if stats.errors:
+            retry = await score_catalog(input_path, output_path, args.concurrency, args.rate, analyzer())
+            print(f"retry pass: {retry.summary().splitlines()[1]}")
+
+        done = load_checkpoint(output_path)
+        print(f"{len(done)}/{args.rows} rows have a result in {output_path}")
+    finally:
+        await off_runner.cleanup()
+        await fda_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--crash-after", type=float, default=2.0)
+    args = parser.parse_args()
+    random.seed(0)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Wall-clock transcription time against voice note duration, single upload vs chunked.
+
+Runs offline: audio is synthesised with ffmpeg (speech-like bursts separated by
+short pauses) and sent to the local Whisper stand-in from benchmarks.standins.
+
+    python -m benchmarks.bench_chunked_transcription --durations 30 60 120 180 300
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-local-standin")
+
+from openai import AsyncOpenAI  # noqa: E402
+
+from app.services.transcription import AudioTranscriber  # noqa: E402
+from benchmarks.standins import make_whisper_app, start_server  # noqa: E402
+
+
+def synthesise_note(seconds: int) -> bytes:
+    """A tone that speaks for ~5.5 s and pauses for ~1.5 s, encoded like a WhatsApp note."""
+    return subprocess.run(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error',
+         '-f', 'lavfi', '-i', f'sine=frequency=300:duration={seconds}',
+         '-af', "volume='if(lt(mod(t,7),5.5),1,0)':eval=frame",
+         '-c:a', 'libopus', '-b:a', '24k', '-vbr', 'off', '-f', 'ogg', 'pipe:1'],
+        check=True, capture_output=True,
+    ).stdout
+
+
+async def run(durations, realtime_factor):
+    whisper = make_whisper_app(realtime_factor=realtime_factor)
+    runner, base_url = await start_server(whisper)
+    transcriber = AudioTranscriber(redis_client=None)
+    transcriber._client = AsyncOpenAI(api_key="sk-local-standin", base_url=f"{base_url}/v1")
+
+    print(f"{'duration':>9} {'single':>9} {'chunked':>9} {'segments':>9}")
+    try:
+        for seconds in durations:
+            audio = synthesise_note(seconds)
+
+            start = time.perf_counter()
+            await transcriber._transcribe_upload(audio, 'ogg', 'audio/ogg', None)
+            single = time.perf_counter() - start
+
+            calls_before = whisper['calls']
+            start = time.perf_counter()
+            text = await transcriber.transcribe_chunked(audio)
+            chunked = time.perf_counter() - start
+
+            if text is None:
+                # Below CHUNK_MIN_DURATION the bot sends a single upload
+                print(f"{seconds:>8}s {single:>8.2f}s {'-':>9} {'-':>9}")
+            else:
+                print(f"{seconds:>8}s {single:>8.2f}s {chunked:>8.2f}s {whisper['calls'] - calls_before:>9}")
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--durations", type=int, nargs="+", default=[30, 60, 120, 180, 300])
+    parser.add_argument("--realtime-factor", type=float, default=0.05,
+                        help="stand-in seconds of latency per second of audio")
+    args = parser.parse_args()
+    asyncio.run(run(args.durations, args.realtime_factor))
+
+
+if __name__ == "__main__":
+    main()
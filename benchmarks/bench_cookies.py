@@ -0,0 +1,109 @@
+"""Bytes per user of the per-user Redis values: legacy double-encoded JSON vs msgpack (+ zstd).
+
+    python -m benchmarks.bench_cookies --users 2000
+
+Histories mix product analyses (formatted from the fixture catalog, as the bot
+sends them) with free-text chat turns, and are 4 to 50 messages long.
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+import app.cookies_utils as cookies
+from app.services.product_analyzer import format_product_analysis, product_analyzer
+from app.services.records import AnalysisRecord
+from benchmarks.standins import FIXTURE_CATALOG
+
+USER_TURNS = [
+    "hola", "Colombia", "nutella", "¿por qué?", "alternativas", "qué tal el yogur griego sin azúcar",
+    "¿es seguro el aceite de palma para los niños?", "champú sin sulfatos", "7700000104729",
+    "¿qué significa nutri-score E?", "gracias 🙏", "¿dónde compro productos orgánicos en Bogotá?",
+]
+CHAT_REPLIES = [
+    "🌿 El aceite de palma no es tóxico, pero su producción está ligada a la deforestación y suele venir en "
+    "productos ultraprocesados. Para los niños conviene limitar las cremas de untar y preferir frutos secos "
+    "naturales. 📚 Fuentes: OMS, EFSA (2023).",
+    "📍 En Bogotá encuentras productos orgánicos certificados en mercados campesinos (Usaquén, Paloquemao), "
+    "tiendas especializadas y en las secciones 'eco' de los supermercados grandes. Busca el sello 🇨🇴 "
+    "'Alimento Ecológico' del Ministerio de Agricultura.",
+    "El Nutri-Score E indica la peor calidad nutricional de la escala A–E: alto en azúcares, grasas saturadas "
+    "o sal y bajo en fibra o proteína. ⚠️ No significa que esté prohibido, sino que es mejor consumirlo ocasionalmente.",
+    "¡Con gusto! 😊 Envíame otra foto o el nombre de un producto cuando quieras.",
+]
+
+
+def product_replies() -> list:
+    replies = []
+    with open(FIXTURE_CATALOG, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                raw = json.loads(line)
+                product = product_analyzer._process_off_product(raw)
+                analysis = AnalysisRecord(product, None, product_analyzer._calculate_scores(product, None), raw['product_name'])
+                replies.append(format_product_analysis(analysis))
+    return replies
+
+
+def synthetic_users(users: int) -> list:
+    analyses = product_replies()
+    out = []
+    for _ in range(users):
+        history = []
+        for _ in range(random.randint(2, 25)):
+            history.append({'role': 'user', 'content': random.choice(USER_TURNS)})
+            reply = random.choice(analyses) if random.random() < 0.6 else random.choice(CHAT_REPLIES)
+            history.append({'role': 'assistant', 'content': reply})
+        location = random.choice([{"country": "CO", "city": "Bogotá"}, {"country": "MX", "city": "Ciudad de México"},
+                                  {"country": "ES", "city": "Madrid"}])
+        out.append((history, location))
+    return out
+
+
+def legacy(value) -> bytes:
+    # What set_cookies(json.dumps(value)) used to store
+    return json.dumps(json.dumps(value)).encode('utf-8')
+
+
+def run(name, encode, decode, users):
+    sizes, encode_s, decode_s = [], 0.0, 0.0
+    for history, location in users:
+        start = time.perf_counter()
+        payloads = [encode(history), encode(location)]
+        encode_s += time.perf_counter() - start
+        start = time.perf_counter()
+        for p in payloads:
+            decode(p)
+        decode_s += time.perf_counter() - start
+        sizes.append(sum(map(len, payloads)))
+    n = len(users)
+    print(f"{name:16} {statistics.mean(sizes):9.0f} B {statistics.median(sizes):9.0f} B "
+          f"{encode_s / n * 1e6:8.1f} us {decode_s / n * 1e6:8.1f} us")
+    return statistics.mean(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    args = parser.parse_args()
+    random.seed(0)
+    users = synthetic_users(args.users)
+    assert all(cookies.decode_cookie(legacy(h)) == h for h, _ in users[:100])
+
+    print(f"{args.users} users, history + location")
+    print(f"{'':16} {'mean/user':>11} {'median':>11} {'encode':>11} {'decode':>11}")
+    before = run('legacy json', legacy, cookies.decode_cookie, users)
+    cookies.COOKIES_ZSTD = False
+    plain = run('msgpack', cookies.encode_cookie, cookies.decode_cookie, users)
+    print(f"msgpack is {before / plain:.1f}x smaller")
+    if cookies.zstandard is not None:
+        cookies.COOKIES_ZSTD = True
+        compressed = run('msgpack + zstd', cookies.encode_cookie, cookies.decode_cookie, users)
+        print(f"msgpack + zstd is {before / compressed:.1f}x smaller")
+    else:
+        print("zstandard not installed, skipping msgpack + zstd")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Measure the per-request logging cost seen by the request path.
+
+Compares the previous synchronous setup (RotatingFileHandler + StreamHandler
+writing inline) with the queue-backed JSON setup from app.logger_utils.
+
+    python -m benchmarks.bench_logging --requests 5000
+"""
+import argparse
+import logging
+import os
+import statistics
+import tempfile
+import time
+from logging.handlers import QueueListener, RotatingFileHandler
+
+os.environ.setdefault("LOG_DIR", tempfile.mkdtemp(prefix="noura-logs-"))
+
+from app.logger_utils import JsonFormatter, RequestQueueHandler, VerboseSamplingFilter, VERBOSE, request_id_var  # noqa: E402
+
+# Roughly the lines whatsapp_endpoint emits for a text message answered by the LLM
+BODY = "Hola, ¿qué opinas de las galletas orgánicas de avena con chocolate? " * 3
+
+
+def simulate_request(logger: logging.Logger, i: int) -> None:
+    logger.info(f'WhatsApp endpoint triggered from: whatsapp:+5730000{i:05d}')
+    logger.info(f'Body: {BODY}', extra=VERBOSE)
+    logger.info('NumMedia: 0, MediaContentType0: None', extra=VERBOSE)
+    logger.info("Sending to OpenAI with 7 messages", extra=VERBOSE)
+    logger.info("OpenAI response received: 812 chars", extra=VERBOSE)
+
+
+def build_sync_logger(log_dir: str, devnull) -> logging.Logger:
+    logger = logging.getLogger("bench.sync")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter(fmt='%(asctime)s pid/%(process)d [%(filename)s:%(lineno)d] %(message)s')
+    file_handler = RotatingFileHandler(os.path.join(log_dir, 'sync.log'), maxBytes=1024 * 1024, backupCount=10)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(devnull)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+    return logger
+
+
+def build_queue_logger(log_dir: str, devnull, sample_rate: float):
+    import queue
+
+    log_queue = queue.SimpleQueue()
+    formatter = JsonFormatter()
+    file_handler = RotatingFileHandler(os.path.join(log_dir, 'queue.log'), maxBytes=1024 * 1024, backupCount=10)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(devnull)
+    console_handler.setFormatter(formatter)
+    listener = QueueListener(log_queue, file_handler, console_handler)
+    listener.start()
+
+    logger = logging.getLogger(f"bench.queue.{sample_rate}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = RequestQueueHandler(log_queue)
+    handler.addFilter(VerboseSamplingFilter(sample_rate))
+    logger.addHandler(handler)
+    return logger, listener
+
+
+def measure(logger: logging.Logger, n_requests: int) -> list:
+    timings = []
+    for i in range(n_requests):
+        token = request_id_var.set(f"req-{i}")
+        start = time.perf_counter()
+        simulate_request(logger, i)
+        timings.append((time.perf_counter() - start) * 1e6)
+        request_id_var.reset(token)
+    return timings
+
+
+def report(name: str, timings: list) -> None:
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:<28} mean {statistics.mean(timings):8.1f} us   p50 {statistics.median(timings):8.1f} us   p99 {p99:8.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    log_dir = tempfile.mkdtemp(prefix="noura-bench-")
+    with open(os.devnull, "w") as devnull:
+        report("sync handlers", measure(build_sync_logger(log_dir, devnull), args.requests))
+        for rate in (1.0, 0.1):
+            logger, listener = build_queue_logger(log_dir, devnull, rate)
+            report(f"queue + json (sample={rate})", measure(logger, args.requests))
+            listener.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Precision and latency of the local product name search on the fixture catalog.
+
+Runs labelled messy queries (typos, accents, Spanish/English names, products the
+catalog lacks) and reports how many resolve locally, how many of those are right,
+and how many would fall through to Open Food Facts. --distractors adds synthetic
+products named with the catalog's generic words, to see precision and latency on a
+bigger, more confusable index.
+
+    python -m benchmarks.bench_product_search --distractors 200000
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+from app.services.product_search import PRODUCT_SEARCH_MIN_CONFIDENCE, SYNONYM_GROUPS, ProductSearchIndex
+from benchmarks.standins import FIXTURE_CATALOG
+
+FIXTURE_QUERIES = 'benchmarks/fixtures/product_queries.jsonl'
+SYLLABLES = ['ma', 'ri', 'to', 'ka', 'lo', 'ne', 'sa', 'vi', 'del', 'cor', 'pan', 'tex', 'bri', 'mon', 'lu', 'za']
+
+
+def pseudo_word() -> str:
+    return ''.join(random.choice(SYLLABLES) for _ in range(random.randint(2, 3)))
+
+
+def add_distractors(index: ProductSearchIndex, catalog: list, count: int):
+    """Products named like real ones: an invented brand or line plus the catalog's generic words."""
+    generic = sorted({word for product in catalog for word in product['categories_tags'][-1][3:].split('-')}
+                     | {group[0] for group in SYNONYM_GROUPS} | {group[1] for group in SYNONYM_GROUPS})
+    categories = [product['categories_tags'] for product in catalog]
+    brands = [pseudo_word().title() for _ in range(5000)]
+    for i in range(count):
+        words = random.sample(generic, random.randint(1, 3)) + [pseudo_word()]
+        random.shuffle(words)
+        index.add(f"{9900000000000 + i}", ' '.join(words).capitalize(), random.choice(brands),
+                  random.choice(categories))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--catalog", default=FIXTURE_CATALOG)
+    parser.add_argument("--queries", default=FIXTURE_QUERIES)
+    parser.add_argument("--distractors", type=int, default=0)
+    parser.add_argument("--min-confidence", type=float, default=PRODUCT_SEARCH_MIN_CONFIDENCE)
+    parser.add_argument("--repeat", type=int, default=50, help="timed passes over the queries")
+    parser.add_argument("--verbose", action="store_true", help="print every query's result")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with open(args.catalog, encoding='utf-8') as f:
+        catalog = [json.loads(line) for line in f if line.strip()]
+    with open(args.queries, encoding='utf-8') as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+
+    start = time.perf_counter()
+    index = ProductSearchIndex()
+    for product in catalog:
+        index.add_off_product(product)
+    add_distractors(index, catalog, args.distractors)
+    print(f"indexed {len(index)} products in {time.perf_counter() - start:.2f}s")
+
+    correct = wrong = missed = fell_through = false_accepts = 0
+    for case in queries:
+        hit = index.resolve(case['query'], args.min_confidence)
+        if case['code'] is None:
+            false_accepts += hit is not None
+            fell_through += hit is None
+            outcome = 'WRONG' if hit else 'remote'
+        elif hit is None:
+            missed += 1
+            outcome = 'remote'
+        elif hit.code == case['code']:
+            correct += 1
+            outcome = 'ok'
+        else:
+            wrong += 1
+            outcome = 'WRONG'
+        if args.verbose or outcome == 'WRONG':
+            found = f"{hit.name} ({hit.confidence:.2f})" if hit else '-'
+            print(f"  {outcome:6s} {case['query']!r:36s} → {found}")
+
+    answerable = correct + wrong + missed
+    accepted = correct + wrong + false_accepts
+    print(f"precision {correct / accepted if accepted else 0:.1%} ({correct}/{accepted} local answers right)   "
+          f"recall {correct / answerable if answerable else 0:.1%} ({correct}/{answerable} catalog products)   "
+          f"unknown products sent remote {fell_through}/{fell_through + false_accepts}")
+
+    timings = []
+    for _ in range(args.repeat):
+        for case in queries:
+            start = time.perf_counter()
+            index.resolve(case['query'], args.min_confidence)
+            timings.append((time.perf_counter() - start) * 1e3)
+    timings.sort()
+    print(f"resolve p50 {statistics.median(timings):.3f} ms   p99 {timings[int(len(timings) * 0.99)]:.3f} ms   "
+          f"max {timings[-1]:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Memory and encode/decode cost of analysis records vs the previous nested dicts.
+
+    python -m benchmarks.bench_records --entries 100000
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from app.services.records import (AnalysisRecord, RecallRecord, decode_analysis, encode_analysis)
+from app.services.product_analyzer import product_analyzer
+from benchmarks.standins import FIXTURE_CATALOG
+
+# A typical OFF product carries a dozen or so label tags drawn from a small vocabulary
+LABELS = ['en:organic', 'en:eu-organic', 'en:vegan', 'en:vegetarian', 'en:gluten-free', 'en:no-preservatives',
+          'en:fair-trade', 'en:green-dot', 'en:no-added-sugar', 'en:nutriscore', 'en:made-in-france',
+          'en:rainforest-alliance', 'en:no-gmos', 'en:sustainable-farming', 'en:palm-oil-free', 'en:low-fat']
+
+
+def synthetic_analyses(entries: int) -> list:
+    with open(FIXTURE_CATALOG, encoding='utf-8') as f:
+        catalog = [json.loads(line) for line in f if line.strip()]
+    analyses = []
+    for i in range(entries):
+        raw = dict(random.choice(catalog))
+        raw['code'] = f"{7700000000000 + i}"
+        raw['product_name'] = f"{raw['product_name']} {i}"
+        raw['labels_tags'] = random.sample(LABELS, random.randint(4, 14))
+        product = product_analyzer._process_off_product(raw)
+        fda = RecallRecord(True, 1, 'Undeclared milk') if random.random() < 0.05 else None
+        analyses.append(AnalysisRecord(product, fda, product_analyzer._calculate_scores(product, fda), raw['product_name']))
+    return analyses
+
+
+def measure(build) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    built = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000)
+    args = parser.parse_args()
+    random.seed(0)
+    n = args.entries
+
+    analyses = synthetic_analyses(n)
+    json_payloads = [json.dumps(a.to_dict()).encode('utf-8') for a in analyses]
+    binary_payloads = [encode_analysis(a) for a in analyses]
+
+    # What an in-process cache holds after reading entries back from Redis
+    dicts, dict_bytes = measure(lambda: [json.loads(p) for p in json_payloads])
+    records, record_bytes = measure(lambda: [decode_analysis(p) for p in binary_payloads])
+    assert all(r == d for r, d in zip(records, dicts))
+
+    # Timings without tracemalloc's per-allocation overhead
+    start = time.perf_counter()
+    for p in json_payloads:
+        json.loads(p)
+    dict_decode = time.perf_counter() - start
+    start = time.perf_counter()
+    for p in binary_payloads:
+        decode_analysis(p)
+    record_decode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for d in dicts:
+        json.dumps(d)
+    dict_encode = time.perf_counter() - start
+    start = time.perf_counter()
+    for r in records:
+        encode_analysis(r)
+    record_encode = time.perf_counter() - start
+
+    json_size = sum(map(len, json_payloads)) / n
+    binary_size = sum(map(len, binary_payloads)) / n
+    print(f"{n} analyses")
+    print(f"{'':8} {'memory/entry':>13} {'payload':>9} {'encode':>10} {'decode':>10}")
+    print(f"{'dict':8} {dict_bytes / n:11.0f} B {json_size:7.0f} B {dict_encode / n * 1e6:7.2f} us {dict_decode / n * 1e6:7.2f} us")
+    print(f"{'record':8} {record_bytes / n:11.0f} B {binary_size:7.0f} B {record_encode / n * 1e6:7.2f} us {record_decode / n * 1e6:7.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Import-time profile of the web app, grouped by top-level package.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter with
+placeholder credentials and prints the slowest packages by cumulative time.
+
+    python -m benchmarks.profile_imports --module app.main --top 15
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+PLACEHOLDER_ENV = {
+    "TWILIO_ACCOUNT_SID": "ACxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
+    "TWILIO_AUTH_TOKEN": "placeholder",
+    "TWILIO_WHATSAPP_NUMBER": "+10000000000",
+    "OPENAI_API_KEY": "sk-placeholder",
+    "REDIS_HOST": "localhost",
+    "REDIS_PORT": "6379",
+    "LOG_DIR": "/tmp/noura-import-profile-logs",
+    # Keep litellm from fetching its model price map over the network during import
+    "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+}
+
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def profile(module: str) -> tuple:
+    env = {**os.environ, **PLACEHOLDER_ENV}
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise SystemExit(result.stderr[-2000:])
+
+    # importtime lists children before their parent; walk it backwards so each
+    # line's enclosing import is on the stack, and charge a package's cumulative
+    # time once per entry point from a different package
+    by_package = defaultdict(int)
+    stack = []
+    for line in reversed(result.stderr.splitlines()):
+        match = LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        depth, package = len(indent), name.split('.')[0]
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        if not stack or stack[-1][1] != package:
+            by_package[package] += int(cumulative)
+        stack.append((depth, package))
+    return wall, by_package
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    wall, by_package = profile(args.module)
+    root = args.module.split('.')[0]
+    print(f"import {args.module}: {by_package[root] / 1e6:.2f}s in imports, {wall:.2f}s interpreter wall-clock")
+    ranked = [item for item in sorted(by_package.items(), key=lambda item: -item[1]) if item[0] != root]
+    for name, micros in ranked[:args.top]:
+        print(f"  {name:<24} {micros / 1e6:7.3f}s")
+
+
+if __name__ == "__main__":
+    main()
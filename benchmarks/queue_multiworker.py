@@ -0,0 +1,160 @@
+"""Multi-process check of the per-user queue against a local Redis (REDIS_HOST/REDIS_PORT).
+
+    python -m benchmarks.queue_multiworker --workers 4 --concurrency 4
+
+Starts worker processes whose handler sleeps, half of it in asyncio.to_thread like
+the pipeline's thread stages, with the default executor cut to --default-threads
+threads (a 2-CPU box). It enqueues a burst from one heavy user plus many light
+users, SIGKILLs one worker halfway and starts a replacement. Then checks that every
+message was answered, that each user's messages ran one at a time and in order,
+and that light users were not stuck behind the heavy one (their median queue lag
+under a quarter of the heavy user's; the p95 includes the messages that waited for
+the killed worker to be declared dead). Exits 1 on any problem; test_queue_multiworker.py
+runs it. Uses (and clears) the noura_queue_* keys of the selected Redis database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.redis_utils import redis_conn
+
+LOG_KEY = 'noura_queue_test_log'
+HEAVY_USER = '15550000000'
+
+
+def run_worker(concurrency: int, service_time: float, default_threads: int):
+    from app.queue_utils import QueueWorker
+
+    async def handler(job: dict):
+        start = time.time()
+        seconds = random.uniform(0.5, 1.5) * service_time
+        await asyncio.to_thread(time.sleep, seconds / 2)
+        await asyncio.sleep(seconds / 2)
+        redis_conn.rpush(LOG_KEY, json.dumps({'user': job['from'], 'seq': job['seq'], 'pid': os.getpid(),
+                                              'enqueued': job['enqueued_at'], 'start': start, 'end': time.time()}))
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=default_threads))
+        worker = QueueWorker(handler, concurrency=concurrency, poll_timeout=0.5)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, worker.stop)
+        await worker.run()
+
+    asyncio.run(main())
+
+
+def spawn(args) -> subprocess.Popen:
+    # A short heartbeat TTL so the killed worker's messages are requeued within seconds
+    env = dict(os.environ, QUEUE_HEARTBEAT_TTL=str(args.heartbeat_ttl))
+    return subprocess.Popen([sys.executable, '-m', 'benchmarks.queue_multiworker', '--worker',
+                             '--concurrency', str(args.concurrency), '--service-time', str(args.service_time),
+                             '--default-threads', str(args.default_threads)], env=env)
+
+
+def check(log: list, expected: dict) -> list:
+    problems = []
+    by_user = {}
+    for entry in log:
+        by_user.setdefault(entry['user'], []).append(entry)
+    for user, count in expected.items():
+        # A message whose worker was killed mid-run is answered again: at-least-once
+        seqs = sorted({e['seq'] for e in by_user.get(user, [])})
+        if seqs != list(range(count)):
+            problems.append(f"{user}: answered {len(seqs)}/{count}")
+        runs = sorted(by_user.get(user, []), key=lambda e: e['start'])
+        for a, b in zip(runs, runs[1:]):
+            if b['start'] < a['end']:
+                problems.append(f"{user}: messages {a['seq']} and {b['seq']} overlapped")
+            if b['seq'] < a['seq']:
+                problems.append(f"{user}: message {b['seq']} ran after {a['seq']}")
+    light, heavy = _lags([e for e in log if e['user'] != HEAVY_USER]), _lags(by_user.get(HEAVY_USER, []))
+    if light and heavy and statistics.median(light) > statistics.median(heavy) / 4:
+        problems.append(f"light users waited behind the heavy one: median lag {statistics.median(light):.2f} s "
+                        f"against the heavy user's {statistics.median(heavy):.2f} s")
+    return problems
+
+
+def _lags(entries: list) -> list:
+    return sorted(e['start'] - e['enqueued'] for e in entries)
+
+
+def _p95(lags: list) -> float:
+    return lags[int(len(lags) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--service-time", type=float, default=0.2, help="mean seconds per message")
+    parser.add_argument("--heavy", type=int, default=60, help="messages from the heavy user")
+    parser.add_argument("--light-users", type=int, default=40)
+    parser.add_argument("--heartbeat-ttl", type=int, default=3)
+    parser.add_argument("--default-threads", type=int, default=6, help="default executor size in each worker")
+    parser.add_argument("--worker", action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.concurrency, args.service_time, args.default_threads)
+        return
+
+    from app.queue_utils import enqueue_message
+
+    for key in redis_conn.scan_iter(match='noura_queue_*'):
+        redis_conn.delete(key)
+    workers = [spawn(args) for _ in range(args.workers)]
+
+    expected = {HEAVY_USER: args.heavy}
+    for i in range(args.light_users):
+        expected[f"1666{i:07d}"] = 3
+    # The heavy user's burst arrives first, then everyone else
+    arrivals = [(HEAVY_USER, seq) for seq in range(args.heavy)]
+    light = [(user, seq) for user, count in expected.items() if user != HEAVY_USER for seq in range(count)]
+    arrivals += sorted(light, key=lambda item: item[1])
+    start = time.time()
+    for user, seq in arrivals:
+        enqueue_message(user, {'from': user, 'seq': seq})
+
+    total = sum(expected.values())
+    killed = False
+    while redis_conn.scard('noura_queue_active') or redis_conn.llen(LOG_KEY) < total:
+        if not killed and redis_conn.llen(LOG_KEY) >= total // 2:
+            os.kill(workers[0].pid, signal.SIGKILL)
+            workers[0].wait()
+            print(f"killed worker {workers[0].pid}; starting a replacement")
+            workers[0] = spawn(args)
+            killed = True
+        if time.time() - start > 300:
+            print("timed out", file=sys.stderr)
+            break
+        time.sleep(0.2)
+    elapsed = time.time() - start
+
+    for worker in workers:
+        worker.send_signal(signal.SIGTERM)
+    for worker in workers:
+        worker.wait(timeout=30)
+
+    log = [json.loads(entry) for entry in redis_conn.lrange(LOG_KEY, 0, -1)]
+    print(f"{total} messages from {len(expected)} users in {elapsed:.1f} s on {args.workers}x{args.concurrency} consumers "
+          f"({len(log) - total} answered twice after the kill)")
+    for name, entries in (('light users', [e for e in log if e['user'] != HEAVY_USER]),
+                          ('heavy user', [e for e in log if e['user'] == HEAVY_USER])):
+        lags = _lags(entries)
+        print(f"{name:12} queue lag p50 {statistics.median(lags):5.2f} s  p95 {_p95(lags):5.2f} s  "
+              f"max {lags[-1]:5.2f} s")
+    problems = check(log, expected)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    print("OK" if not problems else f"{len(problems)} problems")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""Replay recorded Twilio webhook posts against /whatsapp-endpoint, fully offline.
+
+    python -m benchmarks.replay_load --rate 4 --concurrency 16 --messages 300
+    python -m benchmarks.replay_load --service openai=2.5/1.0/0.02 --workers 4 --json results.json
+    python -m benchmarks.replay_load --anonymize recorded.jsonl > corpus.jsonl
+
+Starts local stand-ins for Twilio, OpenAI, Whisper, Open Food Facts, openFDA and
+Google Docs (benchmarks/standins.py), starts the app under gunicorn with every
+client pointed at them, then posts the corpus at a fixed arrival rate (--rate,
+messages per second; 0 replays the recorded timing) with at most --concurrency
+requests open. Reports throughput, p50/p95/p99 latency per route and error rates.
+
+Each stand-in takes --service NAME=LATENCY[/JITTER[/ERROR_RATE]] (seconds, seconds,
+fraction). Needs a Redis at REDIS_HOST/REDIS_PORT; the synthetic users' history and
+rate-limit keys are left behind, so point it at a scratch instance. Other app
+settings (ADMISSION_*, USER_RATE_LIMIT, ...) are passed through from the environment.
+
+Corpus lines are {"t": seconds since the first message, "form": {Twilio form fields}};
+media URLs use {twilio} and {account} placeholders. --anonymize turns logged form
+posts ({"ts": epoch seconds, "form": {...}} per line) into that format.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+
+from app.admission_utils import BUSY_MESSAGE, RATE_LIMITED_MESSAGE
+from app.services.intent_router import route_message
+from benchmarks.standins import (make_fda_app, make_gdocs_app, make_off_app, make_openai_app, make_twilio_app,
+                                 start_server)
+
+CORPUS = 'benchmarks/fixtures/webhook_corpus.jsonl'
+ACCOUNT_SID = 'AC' + '0' * 32
+STAND_IN_PROMPT = "Eres NOURA, asistente de bienestar basado en evidencia.\nResponde en máximo 5 frases."
+
+# name -> (latency, jitter, error rate); roughly what production sees
+DEFAULT_SERVICES = {
+    'twilio': (0.15, 0.05, 0.0),
+    'openai': (1.5, 0.5, 0.0),
+    'whisper': (0.4, 0.1, 0.0),
+    'off': (0.25, 0.1, 0.0),
+    'fda': (0.2, 0.05, 0.0),
+    'gdocs': (0.3, 0.1, 0.0),
+}
+
+PHONE_IN_TEXT = re.compile(r'\+\d[\d\s-]{6,}\d')
+EMAIL_IN_TEXT = re.compile(r'[\w.+-]+@[\w-]+\.[\w.]+')
+
+
+def parse_service(spec: str) -> tuple:
+    name, _, values = spec.partition('=')
+    if name not in DEFAULT_SERVICES:
+        raise argparse.ArgumentTypeError(f"unknown service {name!r}; one of {', '.join(DEFAULT_SERVICES)}")
+    defaults = DEFAULT_SERVICES[name]
+    parts = [float(v) for v in values.split('/') if v]
+    return name, tuple(parts + list(defaults[len(parts):]))
+
+
+def anonymize(path: str):
+    """Print the logged form posts in `path` as a corpus: synthetic numbers, fresh SIDs, no account data."""
+    numbers = {}
+    start = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            form = record.get('form', record)
+            ts = float(record.get('ts', 0))
+            start = ts if start is None else start
+            sender = numbers.setdefault(form['From'], f"whatsapp:+1555{len(numbers):07d}")
+            body = EMAIL_IN_TEXT.sub('[email]', PHONE_IN_TEXT.sub('[phone]', form.get('Body', '')))
+            out = {'From': sender, 'Body': body, 'NumMedia': form.get('NumMedia', '0')}
+            for i in range(int(form.get('NumMedia') or 0)):
+                message, media = hashlib.sha1(f"{form.get('MessageSid')}{i}".encode()).hexdigest()[:32], uuid.uuid4().hex
+                out[f'MediaUrl{i}'] = f"{{twilio}}/2010-04-01/Accounts/{{account}}/Messages/MM{message}/Media/ME{media}"
+                out[f'MediaContentType{i}'] = form.get(f'MediaContentType{i}', '')
+            print(json.dumps({'t': round(ts - start, 3), 'form': out}, ensure_ascii=False))
+
+
+def route_of(form: dict) -> str:
+    """Route label from the message alone (follow-ups that fall back to chat still count as follow_up)."""
+    types = [form.get(f'MediaContentType{i}', '') for i in range(int(form.get('NumMedia') or 0))]
+    if any(t.startswith('audio') for t in types):
+        return 'audio'
+    return route_message(form.get('Body', ''), has_images=any(t.startswith('image') for t in types)).route
+
+
+def sample_media() -> dict:
+    """Bytes served for inbound media: a ~40 KB 'JPEG' and an 8 s voice note (Opus if ffmpeg can make one)."""
+    media = {'image/jpeg': b'\xff\xd8\xff\xe0' + random.Random(0).randbytes(40_000)}
+    audio = b''
+    if shutil.which('ffmpeg'):
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i',
+                                 'sine=frequency=220:duration=8', '-c:a', 'libopus', '-b:a', '24k', '-f', 'ogg',
+                                 'pipe:1'], capture_output=True)
+        audio = result.stdout if result.returncode == 0 else b''
+    # Without ffmpeg: bytes the Whisper stand-in reads as 8 s at 24 kbit/s
+    media['audio/ogg'] = audio or random.Random(1).randbytes(24_000)
+    return media
+
+
+def google_private_key() -> str:
+    import rsa  # comes with google-auth
+
+    _, private_key = rsa.newkeys(1024)
+    return private_key.save_pkcs1().decode()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def start_stand_ins(services: dict, openai_rpm: int = 0):
+    twilio = make_twilio_app(*services['twilio'][:3], media=sample_media())
+    latency, jitter, error_rate = services['whisper']
+    openai = make_openai_app(*services['openai'], rpm=openai_rpm,
+                             whisper={'base_latency': latency, 'jitter': jitter, 'error_rate': error_rate})
+    latency, jitter, error_rate = services['off']
+    off = make_off_app(latency=latency, jitter=jitter, error_rate=error_rate)
+    latency, jitter, error_rate = services['fda']
+    fda = make_fda_app(latency=latency, jitter=jitter, error_rate=error_rate)
+    gdocs = make_gdocs_app(STAND_IN_PROMPT, *services['gdocs'])
+    apps = {'twilio': twilio, 'openai': openai, 'off': off, 'fda': fda, 'gdocs': gdocs}
+    runners, urls = [], {}
+    for name, app in apps.items():
+        runner, urls[name] = await start_server(app)
+        runners.append(runner)
+    return apps, urls, runners
+
+
+def start_app(urls: dict, port: int, workers: int, log_dir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        TWILIO_ACCOUNT_SID=ACCOUNT_SID, TWILIO_AUTH_TOKEN='stand-in', TWILIO_WHATSAPP_NUMBER='+15559999999',
+        TWILIO_API_BASE_URL=urls['twilio'],
+        OPENAI_API_KEY='sk-stand-in', OPENAI_BASE_URL=f"{urls['openai']}/v1", OPENAI_API_BASE=f"{urls['openai']}/v1",
+        OFF_BASE_URL=f"{urls['off']}/api/v2", FDA_BASE_URL=urls['fda'],
+        GOOGLE_TYPE='service_account', GOOGLE_PROJECT_ID='stand-in', GOOGLE_PRIVATE_KEY_ID='stand-in',
+        GOOGLE_PRIVATE_KEY=google_private_key(), GOOGLE_CLIENT_EMAIL='noura@stand-in.iam.gserviceaccount.com',
+        GOOGLE_CLIENT_ID='0', GOOGLE_TOKEN_URI=f"{urls['gdocs']}/token", GOOGLE_UNIVERSE_DOMAIN='googleapis.com',
+        GOOGLE_DOC_ID='stand-in', GOOGLE_DOCS_API_ENDPOINT=urls['gdocs'],
+        GUNICORN_BIND=f"127.0.0.1:{port}", GUNICORN_WORKERS=str(workers), GUNICORN_LOG_LEVEL='warning',
+        LOG_DIR=log_dir, LITELLM_LOCAL_MODEL_COST_MAP='True',
+    )
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app.main:app'], env=env)
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, server: subprocess.Popen, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"app exited with status {server.returncode}")
+        try:
+            async with session.get(f"{url}/metrics") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("app did not start")
+
+
+def load_corpus(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def replay(session: aiohttp.ClientSession, url: str, corpus: list, args, twilio_app, twilio_url: str) -> list:
+    span = corpus[-1]['t'] + 1.0
+    slots = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def post(entry: dict, lap: int, at: float):
+        await asyncio.sleep(max(0.0, at - time.monotonic()))
+        form = {}
+        for key, value in entry['form'].items():
+            value = value.replace('{twilio}', twilio_url).replace('{account}', ACCOUNT_SID)
+            if key.startswith('MediaUrl'):
+                # Each lap gets its own media paths, hence its own bytes, as a new upload would
+                value = f"{value}{lap}"
+                twilio_app['media_types'][value[len(twilio_url):]] = entry['form'][f"MediaContentType{key[8:]}"]
+            form[key] = value
+        form['MessageSid'] = f"SM{uuid.uuid4().hex}"
+        form['AccountSid'] = ACCOUNT_SID
+        route = route_of(entry['form'])
+        async with slots:
+            start = time.monotonic()
+            try:
+                async with session.post(f"{url}/whatsapp-endpoint", data=form,
+                                        timeout=aiohttp.ClientTimeout(total=args.timeout)) as resp:
+                    await resp.read()
+                    status = str(resp.status)
+            except asyncio.TimeoutError:
+                status = 'timeout'
+            except aiohttp.ClientError:
+                status = 'connection'
+            results.append((route, status, time.monotonic() - start))
+
+    begin = time.monotonic() + 0.1
+    tasks = []
+    for i in range(args.messages):
+        lap, entry = i // len(corpus), corpus[i % len(corpus)]
+        at = begin + (i / args.rate if args.rate else lap * span + entry['t'])
+        tasks.append(asyncio.create_task(post(entry, lap, at)))
+    await asyncio.gather(*tasks)
+    return results
+
+
+def percentile(values: list, q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summarize(results: list, elapsed: float, sent: list, apps: dict) -> dict:
+    routes = {}
+    for route, status, seconds in results:
+        routes.setdefault(route, []).append((status, seconds))
+    summary = {'messages': len(results), 'seconds': round(elapsed, 2),
+               'throughput': round(len(results) / elapsed, 2), 'routes': {}}
+    for route, entries in sorted(routes.items()):
+        ok = sorted(seconds for status, seconds in entries if status == '200')
+        summary['routes'][route] = {
+            'count': len(entries),
+            'errors': len(entries) - len(ok),
+            'p50': round(statistics.median(ok), 3) if ok else None,
+            'p95': round(percentile(ok, 0.95), 3) if ok else None,
+            'p99': round(percentile(ok, 0.99), 3) if ok else None,
+        }
+    statuses = {}
+    for _, status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    summary['statuses'] = statuses
+    summary['error_rate'] = round(1 - statuses.get('200', 0) / len(results), 4) if results else 0
+    replies = [body for _, body in sent]
+    summary['replies'] = {
+        'sent': len(replies),
+        'apologies': sum('Lo siento' in body for body in replies),
+        'shed': sum(body in (BUSY_MESSAGE, RATE_LIMITED_MESSAGE) for body in replies),
+    }
+    summary['stand_in_calls'] = {'openai_chat': apps['openai']['chat_calls'], 'openai_429': apps['openai']['rate_limited'],
+                                 'whisper': apps['openai']['calls'],
+                                 'off': apps['off']['calls'], 'fda': apps['fda']['calls'],
+                                 'gdocs': apps['gdocs']['calls']}
+    return summary
+
+
+def print_summary(summary: dict):
+    print(f"{summary['messages']} messages in {summary['seconds']} s: {summary['throughput']} msg/s, "
+          f"error rate {summary['error_rate']:.1%} {summary['statuses']}")
+    print(f"{'route':14}{'count':>7}{'errors':>8}{'p50':>8}{'p95':>8}{'p99':>8}")
+    for route, stats in summary['routes'].items():
+        cells = ''.join(f"{stats[q]:8.2f}" if stats[q] is not None else f"{'-':>8}" for q in ('p50', 'p95', 'p99'))
+        print(f"{route:14}{stats['count']:7}{stats['errors']:8}{cells}")
+    replies = summary['replies']
+    print(f"replies sent {replies['sent']}, apologies {replies['apologies']}, busy/rate-limited {replies['shed']}")
+    print("stand-in calls: " + ', '.join(f"{k} {v}" for k, v in summary['stand_in_calls'].items()))
+
+
+async def run(args) -> dict:
+    services = dict(DEFAULT_SERVICES)
+    services.update(dict(args.service))
+    corpus = load_corpus(args.corpus)
+    apps, urls, runners = await start_stand_ins(services, args.openai_rpm)
+    port = args.port or free_port()
+    log_dir = tempfile.mkdtemp(prefix='replay_logs_')
+    server = start_app(urls, port, args.workers, log_dir)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            await wait_ready(session, url, server)
+            start = time.monotonic()
+            results = await replay(session, url, corpus, args, apps['twilio'], urls['twilio'])
+            elapsed = time.monotonic() - start
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+        for runner in runners:
+            await runner.cleanup()
+    summary = summarize(results, elapsed, apps['twilio']['sent'], apps)
+    summary['config'] = {'rate': args.rate, 'concurrency': args.concurrency, 'workers': args.workers,
+                         'services': services, 'openai_rpm': args.openai_rpm, 'app_logs': log_dir}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--messages", type=int, default=150, help="messages to send, cycling through the corpus")
+    parser.add_argument("--rate", type=float, default=2.0, help="messages per second; 0 replays the recorded timing")
+    parser.add_argument("--concurrency", type=int, default=32, help="most requests open at once")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120, help="per-request timeout, seconds")
+    parser.add_argument("--service", type=parse_service, action='append', default=[],
+                        metavar="NAME=LATENCY[/JITTER[/ERROR_RATE]]", help=f"one of {', '.join(DEFAULT_SERVICES)}")
+    parser.add_argument("--openai-rpm", type=int, default=0,
+                        help="per-model requests per minute the OpenAI stand-in allows before answering 429")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--anonymize", metavar="RECORDED", help="print RECORDED as an anonymized corpus and exit")
+    args = parser.parse_args()
+    if args.anonymize:
+        anonymize(args.anonymize)
+        return
+
+    summary = asyncio.run(run(args))
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""Local stand-ins for the external services the bot talks to.
+
+Each factory returns an aiohttp application with configurable latency so
+benchmarks can run offline. Use `start_server` to bind one to a free port.
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+FIXTURE_CATALOG = 'benchmarks/fixtures/catalog.jsonl'
+
+
+def _jittered(latency: float, jitter: float) -> float:
+    return max(0.0, latency + random.uniform(-jitter, jitter))
+
+
+_ERRORS = {429: web.HTTPTooManyRequests, 500: web.HTTPInternalServerError, 503: web.HTTPServiceUnavailable}
+
+
+async def _delay_or_fail(latency: float, jitter: float, error_rate: float, error_status: int = 503):
+    """Sleep the configured latency, then fail a fraction `error_rate` of requests with `error_status`."""
+    await asyncio.sleep(_jittered(latency, jitter))
+    if random.random() < error_rate:
+        raise _ERRORS[error_status]()
+
+
+def make_whisper_app(base_latency: float = 0.3, realtime_factor: float = 0.05,
+                     bytes_per_second: int = 3000, jitter: float = 0.0, error_rate: float = 0.0) -> web.Application:
+    """Whisper stand-in whose latency grows with the uploaded audio duration.
+
+    Duration is estimated from the upload size at the bitrate the bot encodes
+    with (24 kbit/s Opus, ~3000 bytes per second of audio).
+    """
+
+    async def transcriptions(request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form['file']
+        audio = upload.file.read()
+        seconds = len(audio) / bytes_per_second
+        await _delay_or_fail(base_latency + seconds * realtime_factor, jitter, error_rate)
+        request.app['calls'] += 1
+        return web.json_response({'text': f"call {request.app['calls']} transcribed {seconds:.1f} seconds of audio"})
+
+    app = web.Application(client_max_size=50 * 1024 * 1024)
+    app['calls'] = 0
+    app.router.add_post('/v1/audio/transcriptions', transcriptions)
+    return app
+
+
+def make_off_app(catalog_path: str = FIXTURE_CATALOG, latency: float = 0.05,
+                 jitter: float = 0.0, error_rate: float = 0.0) -> web.Application:
+    """Open Food Facts API v2 stand-in serving products from a JSONL catalog.
+
+    Supports product-by-barcode and a substring search over names and brands.
+    A fraction `error_rate` of requests fail with 503.
+    """
+    with open(catalog_path, encoding='utf-8') as f:
+        products = [json.loads(line) for line in f if line.strip()]
+    by_code = {p['code']: p for p in products}
+
+    async def maybe_fail():
+        await _delay_or_fail(latency, jitter, error_rate)
+
+    async def product(request: web.Request) -> web.Response:
+        await maybe_fail()
+        request.app['calls'] += 1
+        found = by_code.get(request.match_info['code'])
+        if not found:
+            return web.json_response({'status': 0, 'status_verbose': 'product not found'}, status=404)
+        return web.json_response({'status': 1, 'product': found})
+
+    async def search(request: web.Request) -> web.Response:
+        await maybe_fail()
+        request.app['calls'] += 1
+        terms = request.query.get('search_terms', '').lower()
+        page_size = int(request.query.get('page_size', '24'))
+        matches = [p for p in products if terms and terms in f"{p['product_name']} {p['brands']}".lower()]
+        return web.json_response({'count': len(matches), 'products': matches[:page_size]})
+
+    app = web.Application()
+    app['calls'] = 0
+    app.router.add_get('/api/v2/product/{code}.json', product)
+    app.router.add_get('/api/v2/search.json', search)
+    return app
+
+
+def make_fda_app(latency: float = 0.05, recall_rate: float = 0.05, jitter: float = 0.0,
+                 error_rate: float = 0.0) -> web.Application:
+    """openFDA food enforcement stand-in; a fraction `recall_rate` of searches match a recall."""
+
+    async def enforcement(request: web.Request) -> web.Response:
+        await _delay_or_fail(latency, jitter, error_rate)
+        request.app['calls'] += 1
+        # Deterministic per query so repeated runs agree
+        if random.Random(request.query.get('search', '')).random() >= recall_rate:
+            return web.json_response({'error': {'code': 'NOT_FOUND', 'message': 'No matches found!'}}, status=404)
+        return web.json_response({'results': [{'reason_for_recall': 'Undeclared allergen (stand-in)'}]})
+
+    app = web.Application()
+    app['calls'] = 0
+    app.router.add_get('/food/enforcement.json', enforcement)
+    return app
+
+
+def make_openai_app(latency: float = 1.0, jitter: float = 0.0, error_rate: float = 0.0, error_status: int = 503,
+                    reply_chars: int = 600, whisper: dict = None, rpm: int = 0) -> web.Application:
+    """OpenAI stand-in: chat completions (search models answer with a citation) plus Whisper.
+
+    Chat latency and failures are set here; `whisper` holds the make_whisper_app
+    arguments for /v1/audio/transcriptions, served from the same base URL as the SDK expects.
+    With `rpm`, each chat model allows that many requests per rolling minute, answers
+    with x-ratelimit-* headers and returns 429 beyond it, like the real API.
+    """
+    reply = ("🌿 Respuesta de prueba del asistente NOURA. " * (reply_chars // 44 + 1))[:reply_chars]
+    recent = {}
+
+    def rate_limit_headers(model: str) -> dict:
+        if not rpm:
+            return {}
+        now = time.monotonic()
+        window = recent.setdefault(model, [])
+        window[:] = [t for t in window if now - t < 60]
+        reset = f"{60 - (now - window[0]):.3f}s" if window else "0s"
+        headers = {'x-ratelimit-limit-requests': str(rpm), 'x-ratelimit-reset-requests': reset,
+                   'x-ratelimit-remaining-requests': str(max(0, rpm - len(window) - 1))}
+        if len(window) >= rpm:
+            headers['retry-after-ms'] = str(int((60 - (now - window[0])) * 1000))
+            raise web.HTTPTooManyRequests(headers=headers)
+        window.append(now)
+        return headers
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        body = await request.json()
+        model = body.get('model', 'gpt-4o-mini')
+        try:
+            headers = rate_limit_headers(model)
+        except web.HTTPTooManyRequests:
+            request.app['rate_limited'] += 1
+            raise
+        await _delay_or_fail(latency, jitter, error_rate, error_status)
+        request.app['chat_calls'] += 1
+        prompt_chars = len(json.dumps(body.get('messages', []), ensure_ascii=False))
+        message = {'role': 'assistant', 'content': reply}
+        if 'search' in model:
+            message['annotations'] = [{'type': 'url_citation', 'url_citation': {
+                'url': 'https://example.org/fuente', 'title': 'Fuente de prueba', 'start_index': 0, 'end_index': 10}}]
+        completion_tokens = len(reply) // 4
+        return web.json_response({
+            'id': f"chatcmpl-{uuid.uuid4().hex[:24]}", 'object': 'chat.completion', 'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_chars // 4, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_chars // 4 + completion_tokens,
+                      'prompt_tokens_details': {'cached_tokens': 0}},
+        }, headers=headers)
+
+    app = make_whisper_app(**(whisper or {}))
+    app['chat_calls'] = 0
+    app['rate_limited'] = 0
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    return app
+
+
+def _twilio_error(status: int, code: int, message: str) -> web.Response:
+    return web.json_response({'code': code, 'message': message, 'status': status,
+                              'more_info': f"https://www.twilio.com/docs/errors/{code}"}, status=status)
+
+
+def make_twilio_app(latency: float = 0.15, jitter: float = 0.0, error_rate: float = 0.0,
+                    media_latency: float = 0.1, media: dict = None, rate: float = 0,
+                    invalid_numbers: set = None) -> web.Application:
+    """Twilio REST stand-in: accepts outgoing messages and serves inbound media.
+
+    `media` maps a content type to the bytes served for it; the content type of each
+    media URL is registered in app['media_types'] (path -> type) before it is fetched.
+    A few path-derived bytes are appended so every URL serves a different file, as real
+    uploads do (content-hash caches such as the transcript cache only hit on repeats).
+    Sent message bodies (or "content:<ContentSid>") are kept in app['sent'].
+
+    With `rate`, messages beyond `rate` per second get Twilio's 429 (error 20429),
+    counted in app['rate_limited']; numbers in `invalid_numbers` get a 400 (error 21211).
+    """
+
+    async def create_message(request: web.Request) -> web.Response:
+        await _delay_or_fail(latency, jitter, error_rate)
+        form = await request.post()
+        if form.get('To', '').replace('whatsapp:', '') in request.app['invalid_numbers']:
+            return _twilio_error(400, 21211, f"The 'To' number {form.get('To')} is not a valid phone number.")
+        if rate:
+            now = time.monotonic()
+            window = request.app['window']
+            while window and window[0] <= now - 1:
+                window.popleft()
+            if len(window) >= rate:
+                request.app['rate_limited'] += 1
+                return _twilio_error(429, 20429, "Too Many Requests")
+            window.append(now)
+        body = f"content:{form['ContentSid']}" if 'ContentSid' in form else form.get('Body', '')
+        request.app['sent'].append((form.get('To'), body))
+        sid = f"SM{uuid.uuid4().hex}"
+        return web.json_response({'sid': sid, 'account_sid': request.match_info['account'], 'status': 'queued',
+                                  'to': form.get('To'), 'from': form.get('From'), 'body': form.get('Body', ''),
+                                  'num_segments': '1', 'direction': 'outbound-api'}, status=201)
+
+    async def get_media(request: web.Request) -> web.Response:
+        await asyncio.sleep(_jittered(media_latency, jitter))
+        content_type = request.app['media_types'].get(request.path)
+        if content_type not in request.app['media']:
+            raise web.HTTPNotFound()
+        body = request.app['media'][content_type] + hashlib.sha1(request.path.encode()).digest()
+        return web.Response(body=body, content_type=content_type)
+
+    app = web.Application()
+    app['sent'] = []
+    app['rate_limited'] = 0
+    app['window'] = collections.deque()
+    app['invalid_numbers'] = invalid_numbers or set()
+    app['media'] = media or {}
+    app['media_types'] = {}
+    app.router.add_post('/2010-04-01/Accounts/{account}/Messages.json', create_message)
+    app.router.add_get('/2010-04-01/Accounts/{account}/Messages/{message}/Media/{media}', get_media)
+    return app
+
+
+def make_gdocs_app(prompt: str, latency: float = 0.3, jitter: float = 0.0, error_rate: float = 0.0) -> web.Application:
+    """Google Docs API stand-in serving `prompt` as every document, plus the OAuth token endpoint."""
+
+    async def token(request: web.Request) -> web.Response:
+        return web.json_response({'access_token': 'stand-in', 'expires_in': 3600, 'token_type': 'Bearer'})
+
+    async def document(request: web.Request) -> web.Response:
+        await _delay_or_fail(latency, jitter, error_rate)
+        request.app['calls'] += 1
+        paragraphs = [{'paragraph': {'elements': [{'textRun': {'content': line + '\n'}}]}}
+                      for line in prompt.split('\n')]
+        return web.json_response({'documentId': request.match_info['document'], 'body': {'content': paragraphs}})
+
+    app = web.Application()
+    app['calls'] = 0
+    app.router.add_post('/token', token)
+    app.router.add_get('/v1/documents/{document}', document)
+    return app
+
+
+async def start_server(app: web.Application, host: str = '127.0.0.1', port: int = 0):
+    """Start `app` and return (runner, base_url). Call `await runner.cleanup()` when done."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}"
+
+
+async def _serve(port: int):
+    off_runner, off_url = await start_server(make_off_app(), port=port)
+    fda_runner, fda_url = await start_server(make_fda_app(), port=port + 1)
+    print(f"OFF_BASE_URL={off_url}/api/v2")
+    print(f"FDA_BASE_URL={fda_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await off_runner.cleanup()
+        await fda_runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the OFF and FDA stand-ins until interrupted")
+    parser.add_argument("--port", type=int, default=8081, help="OFF port; FDA uses the next one")
+    try:
+        asyncio.run(_serve(parser.parse_args().port))
+    except KeyboardInterrupt:
+        pass
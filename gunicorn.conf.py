@@ -0,0 +1,26 @@
+import gc
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:3002")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "240"))
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# Import the app (and the heavy SDKs) once in the master and fork workers from it.
+# Workers then boot in milliseconds and share the imported modules copy-on-write.
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# litellm fetches its model price map over the network on import unless told not to
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from app.main import warm_shared_state
+
+    warm_shared_state()
+    # Move everything allocated so far out of the GC's tracked generations so
+    # collections in the workers do not touch (and copy) the shared pages
+    gc.freeze()
@@ -0,0 +1,43 @@
+# Test de la caché de respuestas: las preguntas de seguimiento no se comparten entre usuarios
+import sys
+
+import pytest
+
+sys.path.append('.')
+
+from app import answer_cache_utils
+from app.answer_cache_utils import lookup_answer
+
+NUTELLA_TURN = [
+    {"role": "user", "content": "Nutella"},
+    {"role": "assistant", "content": "Nutella: crema de avellanas con cacao, alta en azúcar..."},
+]
+
+
+@pytest.fixture(autouse=True)
+def no_redis(monkeypatch):
+    monkeypatch.setattr(answer_cache_utils, 'ANSWER_CACHE', True)
+    monkeypatch.setattr(answer_cache_utils, '_count', lambda *args, **kwargs: None)
+    monkeypatch.setattr(answer_cache_utils, 'get_cookies', lambda *args, **kwargs: None)
+
+
+@pytest.mark.parametrize("query", [
+    "¿tiene gluten?",
+    "¿es vegano?",
+    "¿cuántas calorías tiene?",
+    "¿es apto para diabéticos?",
+    "¿y eso?",
+])
+def test_follow_ups_are_not_cached(query):
+    key, entry = lookup_answer("prompt", query, NUTELLA_TURN, {"country": "CO"}, "medium")
+    assert key is None and entry is None
+
+
+def test_first_question_is_cached():
+    key, entry = lookup_answer("prompt", "¿dónde compro leche sin lactosa?", [], {"country": "CO"}, "medium")
+    assert key is not None and entry is None
+
+
+def test_images_are_not_cached():
+    key, _ = lookup_answer("prompt", "¿qué es esto?", [], {"country": "CO"}, "medium", has_images=True)
+    assert key is None
@@ -0,0 +1,31 @@
+# Test de la cola por usuario con varios workers contra un Redis local (REDIS_HOST/REDIS_PORT)
+import os
+import subprocess
+import sys
+
+import pytest
+import redis
+
+sys.path.append('.')
+
+
+def _redis_available() -> bool:
+    try:
+        return redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'), port=int(os.getenv('REDIS_PORT', 6379)),
+                           socket_connect_timeout=1).ping()
+    except redis.exceptions.RedisError:
+        return False
+
+
+@pytest.mark.skipif(not _redis_available(), reason="needs a local Redis (REDIS_HOST/REDIS_PORT)")
+def test_queue_multiworker():
+    """
+    4 workers de 8 consumidores (más que los 6 hilos del executor por defecto), uno muerto
+    con SIGKILL a mitad: ningún mensaje perdido, cada usuario en orden y uno a la vez, y los
+    usuarios con pocos mensajes no esperan detrás del que manda muchos.
+    """
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.queue_multiworker', '--workers', '4',
+                             '--concurrency', '8', '--default-threads', '6'],
+                            capture_output=True, text=True, timeout=360)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert result.stdout.rstrip().endswith('OK')